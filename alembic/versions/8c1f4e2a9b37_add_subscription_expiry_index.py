@@ -0,0 +1,28 @@
+"""add subscription expiry index
+
+Revision ID: 8c1f4e2a9b37
+Revises: 3e20a661e8cf
+Create Date: 2025-12-08 10:12:44.318201
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8c1f4e2a9b37'
+down_revision: Union[str, Sequence[str], None] = '3e20a661e8cf'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_subscriptions_status_current_period_end', 'subscriptions', ['status', 'current_period_end'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_subscriptions_status_current_period_end', table_name='subscriptions')
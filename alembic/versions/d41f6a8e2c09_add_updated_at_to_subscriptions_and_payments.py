@@ -0,0 +1,32 @@
+"""add updated_at to subscriptions and payments
+
+Revision ID: d41f6a8e2c09
+Revises: a3e9c7d21b54
+Create Date: 2025-12-12 14:22:51.604318
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd41f6a8e2c09'
+down_revision: Union[str, Sequence[str], None] = 'a3e9c7d21b54'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('subscriptions', sa.Column('updated_at', sa.DateTime(timezone=True),
+                  server_default=sa.text('now()'), nullable=False))
+    op.add_column('payments', sa.Column('updated_at', sa.DateTime(timezone=True),
+                  server_default=sa.text('now()'), nullable=False))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('payments', 'updated_at')
+    op.drop_column('subscriptions', 'updated_at')
@@ -0,0 +1,47 @@
+"""
+Access-log cost on the request path.
+
+Times what the event loop pays per request: the previous f-string plus
+``logger.info`` into a synchronous loguru file sink, against
+``AccessLog.record`` at full and 1% sampling (writes happen on its thread).
+
+    python -m benchmarks.access_log [requests]
+"""
+import sys
+import tempfile
+import time
+from pathlib import Path
+from loguru import logger
+from src.access_log import AccessLog
+
+
+def per_call(fn, requests: int) -> float:
+    start = time.perf_counter()
+    for i in range(requests):
+        fn(i)
+    return (time.perf_counter() - start) / requests * 1e6
+
+
+def main(requests: int = 50_000) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        logger.remove()
+        logger.add(Path(tmp) / "app.log", level="DEBUG")
+
+        def loguru_line(i: int) -> None:
+            logger.info(f"GET /billing/plans from 10.0.0.1 -> 200 ({i / 1000:.2f}ms)")
+
+        full = AccessLog(path=str(Path(tmp) / "access.log"))
+        sampled = AccessLog({2: 0.01}, path=str(Path(tmp) / "sampled.log"))
+
+        print(f"loguru f-string, sync file sink: {per_call(loguru_line, requests):>6.2f} µs/request")
+        print(f"AccessLog.record, 100%:          "
+              f"{per_call(lambda i: full.record('GET', '/billing/plans', 200, i / 1000, '10.0.0.1'), requests):>6.2f} µs/request")
+        print(f"AccessLog.record, 1% of 2xx:     "
+              f"{per_call(lambda i: sampled.record('GET', '/billing/plans', 200, i / 1000, '10.0.0.1'), requests):>6.2f} µs/request")
+        full.close()
+        sampled.close()
+        print(f"dropped (queue full): {full.dropped}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,50 @@
+"""
+Render benchmark for the email templates.
+
+Compares fastapi-mail's per-send path (new Jinja environment, template
+lookup and full context on every message) with the precompiled
+``src.mail.templates`` cache.
+
+    python -m benchmarks.email_templates [iterations]
+"""
+import sys
+import timeit
+from datetime import datetime
+from src.config import settings
+from src.mail import STATIC_CONTEXT, templates
+from src.utils import conf
+
+
+SUBSCRIPTION = {
+    "plan": "Pro", "price": 19.99, "start_date": "2025-01-01", "end_date": "2025-02-01",
+    "user_name": "jane",
+}
+
+DYNAMIC_CONTEXT = {
+    "verify_email.html": {"verification_url": f"{settings.app_url}/verify?token=x"},
+    "reset_password.html": {"reset_url": f"{settings.app_url}/auth/password-reset?token=x"},
+    "otp.html": {"otp_code": "123456"},
+    "subscribe_email.html": SUBSCRIPTION,
+    "update_subscribe_email.html": {**SUBSCRIPTION, "next_billing_date": "2025-02-01", "email_type": "Renewed"},
+    "delete_subscripe.html": SUBSCRIPTION,
+    "payment_failed.html": SUBSCRIPTION,
+}
+
+
+def render_per_send(name: str, context: dict) -> str:
+    full_context = {**STATIC_CONTEXT, "year": datetime.now().year, **context}
+    return conf.template_engine().get_template(name).render(**full_context)
+
+
+def main(iterations: int = 2000) -> None:
+    templates.load()
+    print(f"{'template':<30}{'per-send µs':>14}{'cached µs':>12}{'speedup':>10}")
+    for name, context in DYNAMIC_CONTEXT.items():
+        assert render_per_send(name, context) == templates.render(name, context)
+        baseline = timeit.timeit(lambda: render_per_send(name, context), number=iterations)
+        cached = timeit.timeit(lambda: templates.render(name, context), number=iterations)
+        print(f"{name:<30}{baseline / iterations * 1e6:>14.1f}{cached / iterations * 1e6:>12.1f}{baseline / cached:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,78 @@
+"""
+Response serialization benchmark.
+
+Compares FastAPI's ``response_model`` path (``serialize_response`` into
+Python objects, then ``JSONResponse``'s ``json.dumps``) with
+``src.responses.dump_json`` on a ``GET /billing/payments/me``-style list of
+``Payment`` rows and a login response.
+
+    python -m benchmarks.json_responses [iterations] [rows]
+"""
+import asyncio
+import json
+import sys
+import time
+from datetime import datetime, timezone
+from uuid import uuid4
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute, serialize_response
+from src.auth.models import Provider, User
+from src.auth.schemas import UserLoginResponse
+from src.billing.models import Payment, PaymentProvider, PaymentStatus
+from src.billing.schemas import PaymentResponse
+from src.responses import dump_json
+
+
+def payments(rows: int) -> list[Payment]:
+    now = datetime.now(timezone.utc)
+    return [
+        Payment(id=uuid4(), user_id=uuid4(), subscription_id=uuid4(), provider=PaymentProvider.STRIPE,
+                provider_invoice_id=f"in_{i}", amount_cents=1999, currency="usd",
+                status=PaymentStatus.SUCCEEDED, created_at=now, updated_at=now)
+        for i in range(rows)
+    ]
+
+
+def response_field(tp):
+    app = FastAPI()
+
+    @app.get("/", response_model=tp)
+    async def endpoint():
+        pass
+
+    route = next(route for route in app.routes if isinstance(route, APIRoute))
+    return route.response_field
+
+
+async def with_response_model(field, content) -> bytes:
+    return JSONResponse(await serialize_response(field=field, response_content=content)).body
+
+
+async def bench(label: str, tp, content, iterations: int) -> None:
+    field = response_field(tp)
+    assert json.loads(await with_response_model(field, content)) == json.loads(dump_json(tp, content))
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await with_response_model(field, content)
+    baseline = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        dump_json(tp, content)
+    fast = time.perf_counter() - start
+
+    print(label)
+    print(f"  response_model + json.dumps: {baseline / iterations * 1e6:>9.1f} µs")
+    print(f"  dump_json:                   {fast / iterations * 1e6:>9.1f} µs  ({baseline / fast:.1f}x)")
+
+
+async def main(iterations: int = 2000, rows: int = 100) -> None:
+    await bench(f"payments list, {rows} rows", list[PaymentResponse], payments(rows), iterations)
+    user = User(id=uuid4(), email="jane@example.com", username="jane", provider=Provider.LOCAL)
+    await bench("login response", UserLoginResponse, {"token": "x" * 200, "user": user}, iterations)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(*(int(arg) for arg in sys.argv[1:3])))
@@ -0,0 +1,68 @@
+"""
+Production logging cost per stdlib record.
+
+Compares the previous pipeline (frame-walking ``InterceptHandler`` into a
+``serialize=True`` loguru sink) with the current one (``InterceptHandler``
+without caller info into ``json_sink``), logging through a stdlib logger as
+uvicorn and libraries do. Sinks run inline (no ``enqueue``) and write to
+``/dev/null`` so the whole CPU cost is counted.
+
+    python -m benchmarks.logging_pipeline [records]
+"""
+import io
+import logging
+import os
+import sys
+import time
+from loguru import logger
+from src.logging import InterceptHandler, json_sink
+
+
+class LegacyInterceptHandler(logging.Handler):
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            level = logger.level(record.levelname).name
+        except ValueError:
+            level = record.levelno
+
+        frame, depth = logging.currentframe(), 2
+        while frame and frame.f_code.co_filename == logging.__file__:
+            frame = frame.f_back  # type: ignore
+            depth += 1
+
+        logger.opt(depth=depth, exception=record.exc_info).log(level, record.getMessage())
+
+
+def run(handler: logging.Handler, records: int) -> float:
+    stdlib = logging.getLogger("benchmark")
+    stdlib.handlers = [handler]
+    stdlib.propagate = False
+    stdlib.setLevel(logging.INFO)
+    start = time.perf_counter()
+    for i in range(records):
+        stdlib.info("GET /billing/plans from %s -> %s", "10.0.0.1", 200)
+    return (time.perf_counter() - start) / records * 1e6
+
+
+def main(records: int = 20_000) -> None:
+    with open(os.devnull, "w") as devnull:
+        logger.remove()
+        logger.add(devnull, serialize=True, backtrace=False, diagnose=False)
+        legacy = run(LegacyInterceptHandler(), records)
+
+        logger.remove()
+        stdout = sys.stdout
+        sys.stdout = io.TextIOWrapper(open(os.devnull, "wb"))
+        try:
+            logger.add(json_sink, format="{message}", backtrace=False, diagnose=False)
+            current = run(InterceptHandler(caller_info=False), records)
+        finally:
+            sys.stdout = stdout
+        logger.remove()
+
+    print(f"frame walk + serialize=True: {legacy:>6.2f} µs/record")
+    print(f"no frame walk + json_sink:   {current:>6.2f} µs/record  ({legacy / current:.1f}x)")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,84 @@
+"""
+Middleware overhead benchmark.
+
+Calls a trivial endpoint directly through the ASGI interface, with no
+middleware, with the previous ``@app.middleware("http")`` logger plus
+``SlowAPIMiddleware`` (both ``BaseHTTPMiddleware``), and with the pure ASGI
+``RequestLoggingMiddleware`` plus ``RateLimitMiddleware``. Log sinks are
+removed so only the middleware machinery is measured; without ``REDIS_URL``
+both limiters count in memory.
+
+    python -m benchmarks.middleware [requests]
+"""
+import asyncio
+import sys
+import time
+from fastapi import FastAPI, Request
+from loguru import logger
+from slowapi import Limiter
+from slowapi.middleware import SlowAPIMiddleware
+from slowapi.util import get_remote_address
+from src.middleware import RateLimitMiddleware, RequestLoggingMiddleware
+from src.rate_limiter import RateLimiter
+
+
+def build_app(stack: str) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/ping")
+    async def ping():
+        return {"ok": True}
+
+    if stack == "base_http":
+        app.state.limiter = Limiter(key_func=get_remote_address, default_limits=["1000000/minute"])
+        app.add_middleware(SlowAPIMiddleware)
+
+        @app.middleware("http")
+        async def log_requests(request: Request, call_next):
+            start = time.perf_counter()
+            response = await call_next(request)
+            duration = (time.perf_counter() - start) * 1000
+            client_host = request.client.host if request.client else "unknown"
+            logger.info(f"{request.method} {request.url.path} from {client_host} -> "
+                        f"{response.status_code} ({duration:.2f}ms)")
+            return response
+
+    elif stack == "asgi":
+        app.state.limiter = RateLimiter(get_remote_address, "1000000/minute", {})
+        app.add_middleware(RateLimitMiddleware)
+        app.add_middleware(RequestLoggingMiddleware)
+    return app
+
+
+async def run(app: FastAPI, requests: int) -> float:
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": "/ping", "raw_path": b"/ping", "root_path": "", "query_string": b"",
+        "headers": [(b"host", b"testserver")], "client": ("127.0.0.1", 50000), "server": ("testserver", 80),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    for _ in range(100):
+        await app(dict(scope), receive, send)
+    start = time.perf_counter()
+    for _ in range(requests):
+        await app(dict(scope), receive, send)
+    return (time.perf_counter() - start) / requests * 1e6
+
+
+async def main(requests: int = 5000) -> None:
+    logger.remove()
+    baseline = await run(build_app("none"), requests)
+    print(f"no middleware:                     {baseline:>7.1f} µs/request")
+    for stack, label in (("base_http", "BaseHTTPMiddleware (before)"), ("asgi", "pure ASGI (after)")):
+        took = await run(build_app(stack), requests)
+        print(f"{label:<34} {took:>7.1f} µs/request  (+{took - baseline:.1f} µs)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(*(int(arg) for arg in sys.argv[1:2])))
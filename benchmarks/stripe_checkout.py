@@ -0,0 +1,71 @@
+"""
+Checkout throughput against the local Stripe emulator.
+
+Runs ``checkouts`` concurrent customer + checkout session creations through
+``StripeAPI`` against the emulator served on a local port, adding ``latency``
+seconds to every Stripe response, and waits for the resulting signed webhooks.
+
+    python -m benchmarks.stripe_checkout [checkouts] [latency]
+"""
+import asyncio
+import sys
+import time
+import httpx
+from fastapi import FastAPI, Request
+from benchmarks.stripe_emulator import StripeEmulator
+from src.billing.stripe_client import StripeAPI
+from src.billing.webhooks import construct_event
+from src.config import settings
+
+
+async def run(checkouts: int, latency: float) -> None:
+    received = 0
+    receiver = FastAPI()
+
+    @receiver.post("/webhook")
+    async def webhook(request: Request):
+        nonlocal received
+        construct_event(await request.body(), request.headers["Stripe-Signature"], settings.stripe_webhook_secret)
+        received += 1
+
+    emulator = StripeEmulator(webhook_url="http://app/webhook", webhook_rate=1000, api_latency=latency,
+                              webhook_transport=httpx.ASGITransport(receiver))
+    async with emulator.serve() as base_url:
+        api = StripeAPI(
+            "sk_test_benchmark",
+            max_concurrency=settings.stripe_max_concurrency,
+            rate=settings.stripe_rate_limit,
+            max_retries=0,
+            timeout=30,
+            base_url=base_url,
+        )
+        product = await api.call("products.create", params={"name": "Pro"})
+        price = await api.call("prices.create", params={
+            "product": product.id, "unit_amount": 1999, "currency": "usd", "recurring": {"interval": "month"},
+        })
+
+        async def checkout(i: int) -> None:
+            customer = await api.call("customers.create", params={"email": f"user{i}@example.com"},
+                                      idempotency_key=f"user:{i}:customer")
+            await api.call("checkout.sessions.create", params={
+                "mode": "subscription", "customer": customer.id, "client_reference_id": str(i),
+                "line_items": [{"price": price.id, "quantity": 1}],
+            })
+
+        start = time.perf_counter()
+        await asyncio.gather(*(checkout(i) for i in range(checkouts)))
+        api_done = time.perf_counter() - start
+        await emulator.drain()
+        total = time.perf_counter() - start
+
+        print(f"{checkouts} checkouts, {latency * 1000:.0f} ms Stripe latency, "
+              f"concurrency {api.max_concurrency}, {api.rate:g} req/s")
+        print(f"API calls: {api_done:.2f}s ({checkouts * 2 / api_done:.1f} req/s)")
+        print(f"webhooks:  {received} delivered, all done after {total:.2f}s")
+        await api.close()
+    await emulator.close()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    asyncio.run(run(int(args[0]) if args else 100, float(args[1]) if len(args) > 1 else 0.05))
@@ -0,0 +1,388 @@
+"""
+Local stand-in for the parts of the Stripe API the billing code uses.
+
+Serves Product, Price, Customer, Checkout Session and Subscription endpoints
+from memory, honours ``Idempotency-Key``, and delivers correctly signed
+webhook events (``checkout.session.completed``, ``invoice.payment_succeeded``,
+``customer.subscription.deleted``) at a configurable rate and latency.
+
+Point the app at it with ``STRIPE_API_BASE=http://localhost:12111``, or serve
+it from a test or benchmark with ``async with emulator.serve() as base_url``
+and pass ``base_url`` to ``StripeAPI``:
+
+    python -m benchmarks.stripe_emulator --webhook-url http://localhost:8000/billing/stripe/webhook
+"""
+import argparse
+import asyncio
+import copy
+import itertools
+import logging
+import secrets
+import socket
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator
+from urllib.parse import parse_qsl
+import httpx
+import orjson
+from fastapi import FastAPI, Request, Response
+from src.billing.stripe_client import TokenBucket
+from src.billing.webhooks import sign_payload
+from src.config import settings
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 12111
+SUBSCRIPTION_PERIOD = 30 * 24 * 3600
+
+
+def decode_form(body: bytes) -> dict[str, Any]:
+    """Decode stripe-python's form encoding (``a[b][0][c]=v``) into nested dicts and lists."""
+    root: dict[str, Any] = {}
+    for key, value in parse_qsl(body.decode(), keep_blank_values=True):
+        parts = key.replace("]", "").split("[")
+        node = root
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+    return _lists(root)
+
+
+def _lists(node: Any) -> Any:
+    if not isinstance(node, dict):
+        return node
+    if node and all(key.isdigit() for key in node):
+        return [_lists(node[key]) for key in sorted(node, key=int)]
+    return {key: _lists(value) for key, value in node.items()}
+
+
+def _int(value: Any) -> int | None:
+    return int(value) if value not in (None, "") else None
+
+
+def _bool(value: Any) -> bool:
+    return value in (True, "true")
+
+
+class StripeEmulator:
+    def __init__(
+        self,
+        webhook_url: str | None = None,
+        webhook_secret: str = settings.stripe_webhook_secret,
+        webhook_rate: float = 100,
+        webhook_latency: float = 0.0,
+        api_latency: float = 0.0,
+        auto_complete_checkout: bool = True,
+        webhook_transport: httpx.AsyncBaseTransport | None = None,
+    ) -> None:
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.webhook_rate = webhook_rate
+        self.webhook_latency = webhook_latency
+        self.api_latency = api_latency
+        self.auto_complete_checkout = auto_complete_checkout
+        self.webhook_transport = webhook_transport
+
+        self.objects: dict[str, dict[str, Any]] = {}
+        self.delivered: list[dict[str, Any]] = []
+        self._idempotent: dict[str, dict[str, Any]] = {}
+        self._ids = itertools.count(1)
+        self._queue: asyncio.Queue | None = None
+        self._sender: asyncio.Task | None = None
+        self.app = self._build_app()
+
+
+    def _new_id(self, prefix: str) -> str:
+        return f"{prefix}_emu{next(self._ids):08d}{secrets.token_hex(4)}"
+
+
+    def _store(self, prefix: str, obj: dict[str, Any]) -> dict[str, Any]:
+        obj = {"id": self._new_id(prefix), "created": int(time.time()), "livemode": False, **obj}
+        self.objects[obj["id"]] = obj
+        return obj
+
+
+    def _error(self, status_code: int, message: str) -> Response:
+        body = {"error": {"type": "invalid_request_error", "message": message}}
+        return Response(orjson.dumps(body), status_code=status_code, media_type="application/json")
+
+
+    # -- webhooks -----------------------------------------------------------
+
+    def emit(self, event_type: str, data_object: dict[str, Any]) -> dict[str, Any]:
+        event = {
+            "id": self._new_id("evt"),
+            "object": "event",
+            "type": event_type,
+            "created": int(time.time()),
+            "livemode": False,
+            "data": {"object": copy.deepcopy(data_object)},
+        }
+        if self.webhook_url:
+            if self._sender is None or self._sender.done():
+                self._queue = asyncio.Queue()
+                self._sender = asyncio.create_task(self._deliver())
+            self._queue.put_nowait((time.monotonic() + self.webhook_latency, event))  # type: ignore[union-attr]
+        return event
+
+
+    async def _deliver(self) -> None:
+        bucket = TokenBucket(self.webhook_rate, capacity=max(1, self.webhook_rate))
+        async with httpx.AsyncClient(transport=self.webhook_transport) as client:
+            while True:
+                due, event = await self._queue.get()  # type: ignore[union-attr]
+                await asyncio.sleep(max(0.0, due - time.monotonic()))
+                await bucket.acquire()
+                payload = orjson.dumps(event)
+                try:
+                    await client.post(
+                        self.webhook_url,  # type: ignore[arg-type]
+                        content=payload,
+                        headers={
+                            "Content-Type": "application/json",
+                            "Stripe-Signature": sign_payload(payload, self.webhook_secret),
+                        },
+                    )
+                    self.delivered.append(event)
+                except httpx.HTTPError:
+                    logger.exception("Webhook delivery of %s failed", event["id"])
+                finally:
+                    self._queue.task_done()  # type: ignore[union-attr]
+
+
+    async def drain(self) -> None:
+        """Wait until every emitted webhook has been delivered."""
+        if self._queue is not None:
+            await self._queue.join()
+
+
+    async def close(self) -> None:
+        if self._sender is not None:
+            self._sender.cancel()
+            self._sender = None
+
+
+    @asynccontextmanager
+    async def serve(self, host: str = "127.0.0.1", port: int = 0) -> AsyncIterator[str]:
+        """Serve the API over HTTP on this loop (a free port by default) and yield its base URL."""
+        import uvicorn
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        server = uvicorn.Server(uvicorn.Config(self.app, log_level="warning", lifespan="off"))
+        task = asyncio.create_task(server.serve(sockets=[sock]))
+        try:
+            while not server.started:
+                if task.done():
+                    task.result()
+                await asyncio.sleep(0.01)
+            yield f"http://{host}:{sock.getsockname()[1]}"
+        finally:
+            server.should_exit = True
+            await task
+            sock.close()
+
+
+    # -- checkout flow ------------------------------------------------------
+
+    def complete_checkout(self, session: dict[str, Any]) -> dict[str, Any]:
+        """Pay a checkout session: create the subscription and emit its events."""
+        price = self.objects.get(session["line_items"][0]["price"], {})
+        now = int(time.time())
+        subscription = self._store("sub", {
+            "object": "subscription",
+            "status": "active",
+            "customer": session["customer"],
+            "cancel_at_period_end": False,
+            "canceled_at": None,
+            "metadata": session.get("subscription_data", {}).get("metadata", {}),
+            "items": {"object": "list", "data": [{
+                "object": "subscription_item",
+                "price": price.get("id"),
+                "current_period_start": now,
+                "current_period_end": now + SUBSCRIPTION_PERIOD,
+            }]},
+        })
+        session.update(status="complete", payment_status="paid", subscription=subscription["id"])
+        invoice = self._store("in", {
+            "object": "invoice",
+            "billing_reason": "subscription_create",
+            "customer": session["customer"],
+            "amount_paid": price.get("unit_amount", 0),
+            "currency": price.get("currency", "usd"),
+            "lines": {"object": "list", "data": [{
+                "object": "line_item",
+                "amount": price.get("unit_amount", 0),
+                "period": {"start": now, "end": now + SUBSCRIPTION_PERIOD},
+                "parent": {
+                    "type": "subscription_item_details",
+                    "subscription_item_details": {"subscription": subscription["id"]},
+                },
+            }]},
+        })
+        self.emit("checkout.session.completed", session)
+        self.emit("invoice.payment_succeeded", invoice)
+        return subscription
+
+
+    def _cancel_subscription(self, subscription: dict[str, Any]) -> dict[str, Any]:
+        subscription.update(status="canceled", canceled_at=int(time.time()))
+        self.emit("customer.subscription.deleted", subscription)
+        return subscription
+
+
+    # -- API ----------------------------------------------------------------
+
+    def _build_app(self) -> FastAPI:
+        @asynccontextmanager
+        async def lifespan(app: FastAPI):
+            yield
+            await self.close()
+
+        app = FastAPI(title="Stripe emulator", lifespan=lifespan)
+
+        @app.middleware("http")
+        async def stripe_semantics(request: Request, call_next):
+            if self.api_latency:
+                await asyncio.sleep(self.api_latency)
+            key = request.headers.get("Idempotency-Key")
+            cache_key = f"{request.method} {request.url.path} {key}"
+            if key and cache_key in self._idempotent:
+                cached = self._idempotent[cache_key]
+                return Response(cached["body"], status_code=cached["status"],
+                                media_type="application/json", headers={"Idempotent-Replayed": "true"})
+            response = await call_next(request)
+            if key and request.method == "POST":
+                body = b"".join([chunk async for chunk in response.body_iterator])
+                self._idempotent[cache_key] = {"status": response.status_code, "body": body}
+                return Response(body, status_code=response.status_code, media_type="application/json")
+            return response
+
+        def get(object_id: str, kind: str) -> dict[str, Any] | None:
+            obj = self.objects.get(object_id)
+            return obj if obj and obj["object"] == kind else None
+
+        def update(obj: dict[str, Any], params: dict[str, Any]) -> dict[str, Any]:
+            for key, value in params.items():
+                if key == "metadata":
+                    obj.setdefault("metadata", {}).update(value)
+                elif key in ("active", "cancel_at_period_end"):
+                    obj[key] = _bool(value)
+                else:
+                    obj[key] = value
+            return obj
+
+        def ok(obj: dict[str, Any]) -> Response:
+            return Response(orjson.dumps(obj), media_type="application/json")
+
+        @app.post("/v1/products")
+        async def create_product(request: Request):
+            params = decode_form(await request.body())
+            return ok(self._store("prod", {"object": "product", "active": True, "metadata": {}, **params}))
+
+        @app.post("/v1/products/{product_id}")
+        async def update_product(product_id: str, request: Request):
+            product = get(product_id, "product")
+            if product is None:
+                return self._error(404, f"No such product: '{product_id}'")
+            return ok(update(product, decode_form(await request.body())))
+
+        @app.post("/v1/prices")
+        async def create_price(request: Request):
+            params = decode_form(await request.body())
+            if get(params.get("product", ""), "product") is None:
+                return self._error(400, f"No such product: '{params.get('product')}'")
+            params["unit_amount"] = _int(params.get("unit_amount"))
+            return ok(self._store("price", {"object": "price", "active": True, "metadata": {}, **params}))
+
+        @app.post("/v1/prices/{price_id}")
+        async def update_price(price_id: str, request: Request):
+            price = get(price_id, "price")
+            if price is None:
+                return self._error(404, f"No such price: '{price_id}'")
+            return ok(update(price, decode_form(await request.body())))
+
+        @app.post("/v1/customers")
+        async def create_customer(request: Request):
+            params = decode_form(await request.body())
+            return ok(self._store("cus", {"object": "customer", "metadata": {}, **params}))
+
+        @app.post("/v1/checkout/sessions")
+        async def create_checkout_session(request: Request):
+            params = decode_form(await request.body())
+            line_items = params.get("line_items") or []
+            if not line_items or get(line_items[0].get("price", ""), "price") is None:
+                return self._error(400, "line_items[0][price] must be an existing price")
+            session = self._store("cs", {"object": "checkout.session", "status": "open",
+                                         "payment_status": "unpaid", "subscription": None,
+                                         "metadata": {}, **params})
+            session["url"] = f"{request.base_url}checkout/{session['id']}"
+            response = ok(session)
+            if self.auto_complete_checkout:
+                self.complete_checkout(session)
+            return response
+
+        @app.post("/checkout/{session_id}/complete")
+        async def complete_checkout_session(session_id: str):
+            session = get(session_id, "checkout.session")
+            if session is None or session["status"] != "open":
+                return self._error(404, f"No open checkout session: '{session_id}'")
+            self.complete_checkout(session)
+            return ok(session)
+
+        @app.get("/v1/subscriptions/{subscription_id}")
+        async def retrieve_subscription(subscription_id: str):
+            subscription = get(subscription_id, "subscription")
+            if subscription is None:
+                return self._error(404, f"No such subscription: '{subscription_id}'")
+            return ok(subscription)
+
+        @app.post("/v1/subscriptions/{subscription_id}")
+        async def update_subscription(subscription_id: str, request: Request):
+            subscription = get(subscription_id, "subscription")
+            if subscription is None:
+                return self._error(404, f"No such subscription: '{subscription_id}'")
+            update(subscription, decode_form(await request.body()))
+            if subscription["cancel_at_period_end"]:
+                subscription["canceled_at"] = subscription["canceled_at"] or int(time.time())
+            return ok(subscription)
+
+        @app.delete("/v1/subscriptions/{subscription_id}")
+        async def cancel_subscription(subscription_id: str):
+            subscription = get(subscription_id, "subscription")
+            if subscription is None:
+                return self._error(404, f"No such subscription: '{subscription_id}'")
+            return ok(self._cancel_subscription(subscription))
+
+        return app
+
+
+def main() -> None:
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--webhook-url", help="where to POST signed webhook events")
+    parser.add_argument("--webhook-rate", type=float, default=100, help="max webhook deliveries per second")
+    parser.add_argument("--webhook-latency", type=float, default=0.0, help="seconds between an event and its delivery")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds added to every API response")
+    parser.add_argument("--manual-checkout", action="store_true",
+                        help="leave sessions open until POST /checkout/<id>/complete")
+    args = parser.parse_args()
+
+    emulator = StripeEmulator(
+        webhook_url=args.webhook_url,
+        webhook_rate=args.webhook_rate,
+        webhook_latency=args.webhook_latency,
+        api_latency=args.api_latency,
+        auto_complete_checkout=not args.manual_checkout,
+    )
+    uvicorn.run(emulator.app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,64 @@
+"""
+Webhook parsing benchmark.
+
+Compares ``stripe.Webhook.construct_event`` (str decode, signature check,
+full ``stripe.Event`` tree) plus the handler's dict access with
+``src.billing.webhooks.construct_event`` and the slim ``StripeInvoice`` view,
+on an invoice payload with many lines.
+
+    python -m benchmarks.stripe_webhook [iterations] [lines]
+"""
+import json
+import sys
+import timeit
+import stripe
+from src.billing.schemas import StripeInvoice
+from src.billing.webhooks import construct_event, sign_payload
+
+
+SECRET = "whsec_benchmark"
+
+
+def invoice_event(lines: int) -> bytes:
+    line = {
+        "id": "il_1", "object": "line_item", "amount": 1999, "currency": "usd", "description": "1 × Pro",
+        "metadata": {}, "period": {"start": 1700000000, "end": 1702592000},
+        "parent": {"type": "subscription_item_details",
+                   "subscription_item_details": {"subscription": "sub_1", "subscription_item": "si_1"}},
+        "pricing": {"price_details": {"price": "price_1", "product": "prod_1"}, "unit_amount_decimal": "1999"},
+    }
+    invoice = {
+        "id": "in_1", "object": "invoice", "amount_paid": 1999 * lines, "currency": "usd",
+        "billing_reason": "subscription_cycle", "customer": "cus_1", "customer_email": "jane@example.com",
+        "lines": {"object": "list", "data": [line] * lines, "has_more": False},
+    }
+    event = {"id": "evt_1", "object": "event", "type": "invoice.payment_succeeded", "data": {"object": invoice}}
+    return json.dumps(event).encode()
+
+
+def with_stripe_sdk(payload: bytes, header: str) -> str | None:
+    event = stripe.Webhook.construct_event(payload.decode("utf-8"), header, SECRET)
+    invoice = event["data"]["object"]
+    first_line = invoice.get("lines", {}).get("data", [])[0]
+    return first_line.get("parent", {}).get("subscription_item_details", {}).get("subscription")
+
+
+def with_slim_view(payload: bytes, header: str) -> str | None:
+    event = construct_event(payload, header, SECRET)
+    return StripeInvoice.model_validate(event["data"]["object"]).subscription_id
+
+
+def main(iterations: int = 500, lines: int = 50) -> None:
+    payload = invoice_event(lines)
+    header = sign_payload(payload, SECRET)
+    assert with_stripe_sdk(payload, header) == with_slim_view(payload, header) == "sub_1"
+
+    baseline = timeit.timeit(lambda: with_stripe_sdk(payload, header), number=iterations)
+    slim = timeit.timeit(lambda: with_slim_view(payload, header), number=iterations)
+    print(f"invoice with {lines} lines ({len(payload) / 1024:.1f} KiB)")
+    print(f"stripe.Webhook.construct_event: {baseline / iterations * 1e6:>10.1f} µs")
+    print(f"webhooks.construct_event + view: {slim / iterations * 1e6:>9.1f} µs  ({baseline / slim:.1f}x)")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
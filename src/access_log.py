@@ -0,0 +1,117 @@
+"""
+Sampled, structured access log.
+
+``RequestLoggingMiddleware`` hands every finished request to
+``access_log.record``, which samples it by status class and puts a small
+tuple on a bounded queue. A background thread drains the queue in batches and
+writes one JSON line per request, so formatting and I/O never run on the event
+loop. Records carry the sample rate so counts can be re-weighted downstream.
+
+Rates come from ``ACCESS_LOG_SAMPLE_RATES``, keyed by status class, e.g.
+``{"2": 0.01, "5": 1}`` keeps 1% of 2xx and every 5xx (unlisted classes are
+always logged). Requests that touched the database also carry the
+``src.db_stats`` totals: query count, DB time, pool wait and the slowest
+statement.
+"""
+import queue
+import random
+import sys
+import threading
+import time
+from typing import BinaryIO, Mapping
+import orjson
+from src.config import settings
+from src.db_stats import QueryStats
+
+
+_STOP = object()
+
+
+class AccessLog:
+    def __init__(self, sample_rates: Mapping[int, float] | None = None, path: str | None = None,
+                 batch_size: int = 1024, flush_interval: float = 0.5, max_queue: int = 10_000) -> None:
+        self.sample_rates = dict(sample_rates or {})
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+
+    def record(self, method: str, route: str, status: int, duration_ms: float, client: str,
+               db: QueryStats | None = None) -> None:
+        rate = self.sample_rates.get(status // 100, 1.0)
+        if rate < 1 and random.random() >= rate:
+            return
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait((time.time(), method, route, status, round(duration_ms, 2), client, rate, db))
+        except queue.Full:
+            # never block a request on logging
+            self.dropped += 1
+
+
+    def close(self, timeout: float = 5) -> None:
+        """Flush queued records and stop the writer thread."""
+        thread = self._thread
+        if thread is None:
+            return
+        self._queue.put(_STOP)
+        thread.join(timeout)
+        self._thread = None
+
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="access-log", daemon=True)
+                self._thread.start()
+
+
+    def _open(self) -> BinaryIO:
+        if self.path:
+            return open(self.path, "ab")
+        return sys.stdout.buffer
+
+
+    def _run(self) -> None:
+        stream = self._open()
+        try:
+            stopping = False
+            while not stopping:
+                try:
+                    batch = [self._queue.get(timeout=self.flush_interval)]
+                except queue.Empty:
+                    continue
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if _STOP in batch:
+                    batch = [item for item in batch if item is not _STOP]
+                    stopping = True
+                if batch:
+                    stream.write(b"".join(self._format(item) for item in batch))
+                    stream.flush()
+        finally:
+            if self.path:
+                stream.close()
+
+
+    @staticmethod
+    def _format(item: tuple) -> bytes:
+        ts, method, route, status, duration_ms, client, rate, db = item
+        line = {
+            "ts": ts, "method": method, "route": route, "status": status,
+            "duration_ms": duration_ms, "client": client, "sample_rate": rate,
+        }
+        if db is not None:
+            line.update(db.as_log_fields())
+        return orjson.dumps(line, option=orjson.OPT_APPEND_NEWLINE)
+
+
+access_log = AccessLog(settings.access_log_sample_rates, settings.access_log_path)
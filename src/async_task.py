@@ -0,0 +1,115 @@
+import asyncio
+import functools
+import inspect
+import logging
+from typing import Any, Awaitable, Callable
+from celery import Task
+from fastapi.concurrency import run_in_threadpool
+from celery.signals import worker_process_init, worker_process_shutdown, worker_shutdown
+
+
+logger = logging.getLogger(__name__)
+
+Hook = Callable[[], Awaitable[None]]
+
+_loop: asyncio.AbstractEventLoop | None = None
+_startup_hooks: list[Hook] = []
+_shutdown_hooks: list[Hook] = []
+
+
+def on_worker_startup(func: Hook) -> Hook:
+    """Register a coroutine that creates a shared async resource on the worker loop."""
+    _startup_hooks.append(func)
+    return func
+
+
+def on_worker_shutdown(func: Hook) -> Hook:
+    """Register a coroutine that closes a shared async resource before the loop stops."""
+    _shutdown_hooks.append(func)
+    return func
+
+
+def get_worker_loop() -> asyncio.AbstractEventLoop:
+    """
+    Return the long-lived event loop of this worker process, creating it
+    (and running the startup hooks) on first use.
+    """
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+        for hook in _startup_hooks:
+            _loop.run_until_complete(hook())
+    return _loop
+
+
+def run_async(awaitable: Awaitable[Any]) -> Any:
+    return get_worker_loop().run_until_complete(awaitable)
+
+
+def close_worker_loop() -> None:
+    global _loop
+    if _loop is None or _loop.is_closed():
+        return
+
+    for hook in reversed(_shutdown_hooks):
+        try:
+            _loop.run_until_complete(hook())
+        except Exception:
+            logger.exception("Worker shutdown hook failed")
+
+    _loop.run_until_complete(_loop.shutdown_asyncgens())
+    _loop.close()
+    _loop = None
+
+
+async def enqueue(task: Task, *args: Any, **kwargs: Any) -> bool:
+    """
+    Publish ``task`` from async code without blocking the event loop on the
+    broker. A broker outage is logged instead of raised, so the request that
+    already committed its work still succeeds; returns whether it was queued.
+    """
+    try:
+        await run_in_threadpool(task.delay, *args, **kwargs)
+    except Exception:
+        logger.exception("Could not queue task %s", getattr(task, "name", task))
+        return False
+    return True
+
+
+class AsyncTask(Task):
+    """
+    Celery task base that lets the task body be an ``async def``.
+
+    Coroutines run on one event loop per worker process instead of a fresh
+    loop per invocation, so connections opened by one task (SMTP, httpx,
+    asyncpg) can be reused by the next. Use with the prefork or solo pool.
+
+    The coroutine is driven inside ``run`` itself, so ``autoretry_for`` and
+    the other retry options see its exceptions.
+    """
+    abstract = True
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        run = cls.__dict__.get("run")
+        func = run.__func__ if isinstance(run, staticmethod) else run
+        if not inspect.iscoroutinefunction(func):
+            return
+
+        @functools.wraps(func)
+        def run_sync(*args, **kwargs):
+            return run_async(func(*args, **kwargs))
+
+        cls.run = staticmethod(run_sync) if isinstance(run, staticmethod) else run_sync
+
+
+@worker_process_init.connect
+def _start_worker_loop(**kwargs) -> None:
+    get_worker_loop()
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def _stop_worker_loop(**kwargs) -> None:
+    close_worker_loop()
@@ -0,0 +1,7 @@
+# Login throttle: failed attempts allowed per scope within the window before
+# backoff starts; each further failure locks the scope for twice as long
+LOGIN_THROTTLE_FREE_FAILURES = {"email": 5, "ip": 20, "subnet": 100}
+LOGIN_THROTTLE_BASE_DELAY = 1  # seconds
+LOGIN_THROTTLE_MAX_DELAY = 900  # seconds
+LOGIN_THROTTLE_WINDOW = 3600  # seconds after the last failure until the count resets
+LOGIN_THROTTLE_LOCAL_MAX_KEYS = 100_000
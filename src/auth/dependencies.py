@@ -1,9 +1,10 @@
 from typing import Annotated
-from fastapi import Depends
+from fastapi import Depends, Request
 from src.auth.repository import UserRepository , LoginCodeRepository
 from src.database import db_dependency
 from src.auth_bearer import user_dependency, non_active_user_dependency
-from src.auth.emails import Emails
+from src.auth.throttle import LoginAttempts, login_throttle
+from src.rate_limiter import client_ip
 
 
 #DATABASE DEBENDCIES 
@@ -18,7 +19,7 @@ def get_code_repo(db: db_dependency) -> LoginCodeRepository:
 code_dependency = Annotated[LoginCodeRepository, Depends(get_code_repo)]
 
 
-async def get_email_service():
-    return Emails()
+def get_login_attempts(request: Request) -> LoginAttempts:
+    return LoginAttempts(login_throttle, client_ip(request))
 
-email_dependency = Annotated[Emails, Depends(get_email_service)]
\ No newline at end of file
+login_attempts_dependency = Annotated[LoginAttempts, Depends(get_login_attempts)]
@@ -1,6 +1,5 @@
-from datetime import datetime
-from fastapi_mail import FastMail, MessageSchema, MessageType
-from src.utils import conf
+from fastapi_mail import MessageSchema, MessageType
+from src.mail import mailer
 from src.config import settings
 from src.jwt import generate_token
 
@@ -16,16 +15,10 @@ class Emails:
         message = MessageSchema(
             subject="Email Verification",
             recipients=[email],  # list of recipients # type: ignore
-            template_body={
-                "app_name": settings.app_name, "expires_in": settings.validation_token_expire,
-                "app_url": settings.app_url, "verification_url": verify_url,
-                "support_email": "support@fast_api.com", "company_address": "1234 Street, City, Country",
-                "year": datetime.now().year
-                },
+            template_body={"verification_url": verify_url},
             subtype=MessageType.html
         )
-        fm = FastMail(conf)
-        await fm.send_message(message, template_name="verify_email.html")
+        await mailer.send_message(message, template_name="verify_email.html")
 
 
     @staticmethod
@@ -39,17 +32,11 @@ class Emails:
         message = MessageSchema(
             subject="Password Reset",
             recipients=[email],  # list of recipients #type: ignore
-            template_body={
-                "app_name": settings.app_name, "expires_in": settings.validation_token_expire,
-                "app_url": settings.app_url, "reset_url": verify_url,
-                "support_email": "support@fast_api.com", "company_address": "1234 Street, City, Country",
-                "year": datetime.now().year
-                },
+            template_body={"reset_url": verify_url},
             subtype=MessageType.html
         )
 
-        fm = FastMail(conf)
-        await fm.send_message(message, template_name="reset_password.html")
+        await mailer.send_message(message, template_name="reset_password.html")
 
 
     @staticmethod
@@ -60,14 +47,8 @@ class Emails:
         message = MessageSchema(
             subject="Login Code",
             recipients=[email],  # list of recipients #type: ignore
-           template_body={
-                "app_name": settings.app_name, "expires_in": settings.validation_token_expire,
-                "app_url": settings.app_url, "otp_code": code,
-                "support_email": "support@fast_api.com", "company_address": "1234 Street, City, Country",
-                "year": datetime.now().year
-                },
+            template_body={"otp_code": code},
             subtype=MessageType.html
         )
 
-        fm = FastMail(conf)
-        await fm.send_message(message, template_name="otp.html")
\ No newline at end of file
+        await mailer.send_message(message, template_name="otp.html")
\ No newline at end of file
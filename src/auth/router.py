@@ -1,27 +1,30 @@
-from fastapi import APIRouter, Response, BackgroundTasks, status, Request
+from fastapi import APIRouter, Response, status, Request
 from fastapi.responses import RedirectResponse
 from src.auth import schemas, utils
 from src.auth.service import UserService
-from src.auth.dependencies import repo_dependency, email_dependency, code_dependency
+from src.auth.dependencies import repo_dependency, code_dependency, login_attempts_dependency
+from src.async_task import enqueue
 from src.auth_bearer import  user_dependency, non_active_user_dependency
 from src.dependencies import token_depedency
 from src.rate_limiter import limiter
+from src.responses import ModelResponse
+from src.tasks import send_verification_email_task, send_password_reset_email_task, send_login_code_task
 
 
 router = APIRouter()
 
 @router.post("/register", response_model=schemas.UserRead, status_code=status.HTTP_201_CREATED)
-async def register_user(user_data: schemas.UserCreateRequest, repo: repo_dependency,
-                        background: BackgroundTasks, email: email_dependency):
+async def register_user(user_data: schemas.UserCreateRequest, repo: repo_dependency):
     user = await UserService.register_user(user_data, repo)
-    background.add_task(email.send_verification_email, user.email, user.id) 
-    return user
+    await enqueue(send_verification_email_task, user.email, str(user.id))
+    return ModelResponse(schemas.UserRead, user, status_code=status.HTTP_201_CREATED)
 
 
 @router.post("/login", response_model=schemas.UserLoginResponse, status_code=status.HTTP_200_OK)
 async def login_user(user_data: schemas.UserLoginRequest, repo: repo_dependency, token_repo: token_depedency,
-                    response: Response):
-    access_token, user, refresh_token = await UserService.login_user(user_data, repo, token_repo)
+                     attempts: login_attempts_dependency):
+    access_token, user, refresh_token = await UserService.login_user(user_data, repo, token_repo, attempts)
+    response = ModelResponse(schemas.UserLoginResponse, {"token": access_token, "user": user})
     response.set_cookie(
         key="refresh_token",
         value=refresh_token,
@@ -31,7 +34,7 @@ async def login_user(user_data: schemas.UserLoginRequest, repo: repo_dependency,
         max_age=7*24*60*60
     )
 
-    return {"token": access_token, "user": user}
+    return response
 
 
 @router.post("/refresh-token", response_model=schemas.RefreshTokenResponse, status_code=status.HTTP_200_OK)
@@ -57,20 +60,18 @@ async def verify_email(token: str, repo: repo_dependency):
 
 
 @router.post("/request/verify", response_model=schemas.MessageResponse, status_code=status.HTTP_202_ACCEPTED)
-async def request_verify_email(current_user: non_active_user_dependency, 
-                               background: BackgroundTasks, email: email_dependency):
+async def request_verify_email(current_user: non_active_user_dependency):
     if current_user.is_verified: 
         return {"message": "Email is already verified"}
-    background.add_task(email.send_verification_email, current_user.email, current_user.id) 
+    await enqueue(send_verification_email_task, current_user.email, str(current_user.id))
     return {"message": "New Verification Email has been sent"}
 
 
 @router.post("/forget-password", response_model=schemas.MessageResponse, status_code=status.HTTP_202_ACCEPTED)
-async def forget_password(data: schemas.ForgetPasswordRequest, repo: repo_dependency,
-                          background: BackgroundTasks, email: email_dependency):
+async def forget_password(data: schemas.ForgetPasswordRequest, repo: repo_dependency):
     user = await UserService.forget_password(data, repo)
     if user:
-        background.add_task(email.send_password_reset_email, user.email, user.id) 
+        await enqueue(send_password_reset_email_task, user.email, str(user.id))
     return {"message": "If an account with this email exists, a password reset link has been sent."}
 
 
@@ -82,26 +83,28 @@ async def new_password(data: schemas.NewPasswordRequest, repo: repo_dependency):
 
 
 @router.post("/change-password", response_model=schemas.MessageResponse, status_code=status.HTTP_200_OK)
-async def change_password(data: schemas.ChangePasswordRequest, repo: repo_dependency, current_user: user_dependency):
-    success = await UserService.change_password(data, repo, current_user)
+async def change_password(data: schemas.ChangePasswordRequest, repo: repo_dependency, current_user: user_dependency,
+                          attempts: login_attempts_dependency):
+    success = await UserService.change_password(data, repo, current_user, attempts)
     if success:
         return {"message": "Password has been changed successfuly"}
 
 
 @router.post("/request/login-code")
-async def request_login_code(data: schemas.LoginCodeRequest, user_repo:repo_dependency, code_repo: code_dependency,
-                            background: BackgroundTasks, email: email_dependency):
+async def request_login_code(data: schemas.LoginCodeRequest, user_repo:repo_dependency, code_repo: code_dependency):
     result = await UserService.login_code(data, user_repo, code_repo)
     if result:
         user, code = result
-        background.add_task(email.send_login_code, user.email, code) 
+        await enqueue(send_login_code_task, user.email, code)
     return {"message": "If an account with this email exists, a login code has been sent."}
     
 
 @router.post("/login/code", response_model=schemas.UserLoginResponse, status_code=status.HTTP_200_OK)
-async def login_with_code(data: schemas.LoginWithCodeRequest, response: Response,
-                        user_repo:repo_dependency, code_repo: code_dependency, token_repo: token_depedency):
-    access_token, user, refresh_token = await UserService.login_with_code(data, user_repo, code_repo, token_repo)
+async def login_with_code(data: schemas.LoginWithCodeRequest,
+                        user_repo:repo_dependency, code_repo: code_dependency, token_repo: token_depedency,
+                        attempts: login_attempts_dependency):
+    access_token, user, refresh_token = await UserService.login_with_code(data, user_repo, code_repo, token_repo, attempts)
+    response = ModelResponse(schemas.UserLoginResponse, {"token": access_token, "user": user})
     response.set_cookie(
         key="refresh_token",
         value=refresh_token,
@@ -110,7 +113,7 @@ async def login_with_code(data: schemas.LoginWithCodeRequest, response: Response
         samesite="lax",     # likely "none" in prod if cross-site
         max_age=7*24*60*60
     )
-    return {"token": access_token, "user": user}
+    return response
 
 
 @router.get("/google/login")
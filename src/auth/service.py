@@ -9,6 +9,7 @@ from src.utils import store_refresh_token_in_db, validate_refresh_token, revoke_
 from src.repository import RefreshTokenRepository
 from src.auth import utils, schemas
 from src.auth.repository import UserRepository, LoginCodeRepository
+from src.auth.throttle import LoginAttempts
 from src.auth.models import User, Provider
 
 
@@ -35,9 +36,14 @@ class UserService:
     
 
     @staticmethod
-    async def login_user(user_data: schemas.UserLoginRequest, repo: UserRepository, token_repo: RefreshTokenRepository) -> tuple[str, User, str]:
+    async def login_user(user_data: schemas.UserLoginRequest, repo: UserRepository, token_repo: RefreshTokenRepository,
+                         attempts: LoginAttempts | None = None) -> tuple[str, User, str]:
+        if attempts:
+            await attempts.check(user_data.email)
         user = await repo.get_by_email(user_data.email)
         if user and await verify_password(user_data.password, user.password):
+            if attempts:
+                await attempts.succeeded(user_data.email)
             if not user.is_active:
                 raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="User is disabled")
             data = {"sub": str(user.id), "email": user.email, "username": user.username}
@@ -47,6 +53,8 @@ class UserService:
             return access_token, user, refresh_token
     
         else:
+            if attempts:
+                await attempts.failed(user_data.email)
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid email or password",
@@ -128,8 +136,13 @@ class UserService:
 
 
     @staticmethod 
-    async def change_password(data: schemas.ChangePasswordRequest, repo: UserRepository, current_user: User) -> bool:
+    async def change_password(data: schemas.ChangePasswordRequest, repo: UserRepository, current_user: User,
+                              attempts: LoginAttempts | None = None) -> bool:
+        if attempts:
+            await attempts.check(current_user.email)
         if not await verify_password(data.old_password, current_user.password):
+            if attempts:
+                await attempts.failed(current_user.email)
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="Old password isn't correct."
@@ -155,9 +168,14 @@ class UserService:
 
 
     @staticmethod
-    async def login_with_code(data: schemas.LoginWithCodeRequest, user_repo: UserRepository, code_repo: LoginCodeRepository, token_repo: RefreshTokenRepository):
+    async def login_with_code(data: schemas.LoginWithCodeRequest, user_repo: UserRepository, code_repo: LoginCodeRepository, token_repo: RefreshTokenRepository,
+                              attempts: LoginAttempts | None = None):
+        if attempts:
+            await attempts.check(data.email)
         user = await user_repo.get_by_email(data.email)
         if not user:
+            if attempts:
+                await attempts.failed(data.email)
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Invalid code or email."
@@ -165,6 +183,8 @@ class UserService:
         
         login_code = await code_repo.get_latest_for_user(user.id)
         if not login_code:
+            if attempts:
+                await attempts.failed(data.email)
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Invalid code or email."
@@ -178,12 +198,16 @@ class UserService:
             )
         
         if not await verify_password(data.code, login_code.code_hash):
+            if attempts:
+                await attempts.failed(data.email)
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Invalid code or email."
             )
         
         await code_repo.delete(user.id)
+        if attempts:
+            await attempts.succeeded(data.email)
 
         if not user.is_active:
                 raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="User is disabled")
@@ -0,0 +1,245 @@
+"""
+Login throttling ahead of password verification.
+
+Every failed password or login-code check counts against the email, the
+client IP and its subnet (/24, or /48 for IPv6). Once a scope has used its
+free failures (``LOGIN_THROTTLE_FREE_FAILURES``) within the window, each
+further failure locks it for ``LOGIN_THROTTLE_BASE_DELAY`` seconds, doubling
+up to ``LOGIN_THROTTLE_MAX_DELAY``. Locked attempts are refused with a 429
+after one pipelined Redis round trip (``PTTL`` of each lock key), before any
+database lookup or Argon2 work, so credential stuffing can't saturate the
+CPU. A successful login clears the email's count (not the IP's). Without
+Redis the counts are kept per process.
+"""
+import hashlib
+import ipaddress
+import logging
+import math
+import time
+from collections import OrderedDict
+from fastapi import HTTPException, status
+from redis.exceptions import RedisError
+from src.auth.constants import (
+    LOGIN_THROTTLE_BASE_DELAY, LOGIN_THROTTLE_FREE_FAILURES, LOGIN_THROTTLE_LOCAL_MAX_KEYS,
+    LOGIN_THROTTLE_MAX_DELAY, LOGIN_THROTTLE_WINDOW,
+)
+from src.cache import REDIS_FAILURE_COOLDOWN, get_redis
+from src.metrics import LOGIN_THROTTLE_REJECTIONS
+
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "login"
+REDIS_WARNING_INTERVAL = 30  # seconds between "falling back" warnings
+
+# KEYS: failure counter and lock key per scope, in pairs; ARGV[1..n]: free failures per scope,
+# then base delay, max delay and window in ms. A lock is the key's existence and its PX; checks read
+# the PTTL, so the app and Redis clocks never get compared. Returns the longest lock set (ms), 0 if none
+FAILURE_SCRIPT = """
+local scopes = #KEYS / 2
+local base = tonumber(ARGV[scopes + 1])
+local max_delay = tonumber(ARGV[scopes + 2])
+local window = tonumber(ARGV[scopes + 3])
+local longest = 0
+for i = 1, scopes do
+    local failures = redis.call('INCR', KEYS[2 * i - 1])
+    redis.call('PEXPIRE', KEYS[2 * i - 1], window)
+    local over = failures - tonumber(ARGV[i])
+    if over > 0 then
+        local delay = math.min(base * 2 ^ (over - 1), max_delay)
+        redis.call('SET', KEYS[2 * i], 1, 'PX', delay)
+        longest = math.max(longest, delay)
+    end
+end
+return longest
+"""
+
+
+def _subnet(ip: str) -> str | None:
+    try:
+        network = ipaddress.ip_network(ip, strict=False)
+    except ValueError:
+        return None
+    prefix = 24 if network.version == 4 else 48
+    return str(network.supernet(new_prefix=prefix)) if network.prefixlen > prefix else str(network)
+
+
+def _backoff(failures: int, free: int) -> float:
+    return min(LOGIN_THROTTLE_BASE_DELAY * 2 ** (failures - free - 1), LOGIN_THROTTLE_MAX_DELAY)
+
+
+class LocalLoginFailures:
+    """In-process failure counts and locks (same rules as ``FAILURE_SCRIPT``), LRU-bounded."""
+    def __init__(self, max_keys: int = LOGIN_THROTTLE_LOCAL_MAX_KEYS) -> None:
+        self.max_keys = max_keys
+        self._entries: OrderedDict[str, list[float]] = OrderedDict()  # key -> [failures, expires_at, locked_until]
+
+
+    def locked_for(self, key: str) -> float:
+        entry = self._entries.get(key)
+        return max(entry[2] - time.monotonic(), 0) if entry else 0
+
+
+    def fail(self, key: str, free: int) -> float:
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= now:
+            entry = [0, 0, 0]
+        entry[0] += 1
+        entry[1] = now + LOGIN_THROTTLE_WINDOW
+        delay = _backoff(int(entry[0]), free) if entry[0] > free else 0
+        if delay:
+            entry[2] = now + delay
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_keys:
+            self._entries.popitem(last=False)
+        return delay
+
+
+    def clear(self, key: str | None = None) -> None:
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+
+class LoginThrottle:
+    def __init__(self) -> None:
+        self.enabled = True
+        self._local = LocalLoginFailures()
+        self._script = None
+        self._script_client = None
+        self._redis_retry_at = 0.0
+        self._warned_at = 0.0
+
+
+    @staticmethod
+    def scopes(email: str, client: str) -> dict[str, str]:
+        """Throttled identities of an attempt: the (hashed, normalized) email, the client IP and its subnet."""
+        scopes = {
+            "email": hashlib.sha256(email.strip().lower().encode()).hexdigest()[:32],
+            "ip": client,
+        }
+        subnet = _subnet(client)
+        if subnet is not None and subnet != client:
+            scopes["subnet"] = subnet
+        return scopes
+
+
+    async def check(self, email: str, client: str) -> None:
+        """Raise 429 if any scope of the attempt is locked. Call before looking up or verifying anything."""
+        if not self.enabled:
+            return
+        scopes = self.scopes(email, client)
+        waits = await self._locked_for(scopes)
+        scope, wait = max(waits.items(), key=lambda item: item[1])
+        if wait > 0:
+            LOGIN_THROTTLE_REJECTIONS.labels(scope).inc()
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many failed login attempts. Try again later.",
+                headers={"Retry-After": str(max(math.ceil(wait), 1))},
+            )
+
+
+    async def failed(self, email: str, client: str) -> None:
+        if not self.enabled:
+            return
+        scopes = self.scopes(email, client)
+        redis = self._redis()
+        if redis is not None:
+            try:
+                if self._script_client is not redis:
+                    self._script = redis.register_script(FAILURE_SCRIPT)
+                    self._script_client = redis
+                keys = [key for scope, value in scopes.items()
+                        for key in (self._key("fail", scope, value), self._key("lock", scope, value))]
+                args = [LOGIN_THROTTLE_FREE_FAILURES[scope] for scope in scopes] + [
+                    LOGIN_THROTTLE_BASE_DELAY * 1000, LOGIN_THROTTLE_MAX_DELAY * 1000, LOGIN_THROTTLE_WINDOW * 1000,
+                ]
+                await self._script(keys=keys, args=args)  # type: ignore[misc]
+                return
+            except (RedisError, OSError):
+                self._redis_failed()
+        for scope, value in scopes.items():
+            self._local.fail(self._key("fail", scope, value), LOGIN_THROTTLE_FREE_FAILURES[scope])
+
+
+    async def succeeded(self, email: str, client: str) -> None:
+        """Forget the email's failures; the IP keeps its count so one valid account can't reset it."""
+        if not self.enabled:
+            return
+        value = self.scopes(email, client)["email"]
+        redis = self._redis()
+        if redis is not None:
+            try:
+                await redis.delete(self._key("fail", "email", value), self._key("lock", "email", value))
+                return
+            except (RedisError, OSError):
+                self._redis_failed()
+        self._local.clear(self._key("fail", "email", value))
+
+
+    def reset(self) -> None:
+        """Forget the in-process counts (Redis keys expire on their own)."""
+        self._local.clear()
+
+
+    async def _locked_for(self, scopes: dict[str, str]) -> dict[str, float]:
+        redis = self._redis()
+        if redis is not None:
+            try:
+                async with redis.pipeline(transaction=False) as pipe:
+                    for scope, value in scopes.items():
+                        pipe.pttl(self._key("lock", scope, value))
+                    ttls = await pipe.execute()
+            except (RedisError, OSError):
+                self._redis_failed()
+            else:
+                # -2: no lock; -1: a lock without expiry (never set by us), treat it as the longest one
+                return {
+                    scope: LOGIN_THROTTLE_MAX_DELAY if ttl == -1 else max(ttl, 0) / 1000
+                    for scope, ttl in zip(scopes, ttls)
+                }
+        return {scope: self._local.locked_for(self._key("fail", scope, value)) for scope, value in scopes.items()}
+
+
+    @staticmethod
+    def _key(kind: str, scope: str, value: str) -> str:
+        return f"{KEY_PREFIX}:{kind}:{scope}:{value}"
+
+
+    def _redis(self):
+        """The shared client, or None while cooling down from a failure (see ``REDIS_FAILURE_COOLDOWN``)."""
+        return get_redis() if time.monotonic() >= self._redis_retry_at else None
+
+
+    def _redis_failed(self) -> None:
+        now = time.monotonic()
+        self._redis_retry_at = now + REDIS_FAILURE_COOLDOWN
+        if now - self._warned_at > REDIS_WARNING_INTERVAL:
+            self._warned_at = now
+            logger.warning("Redis unavailable, login throttling is enforced per process")
+
+
+login_throttle = LoginThrottle()
+
+
+class LoginAttempts:
+    """``login_throttle`` bound to the client of the current request."""
+    def __init__(self, throttle: LoginThrottle, client: str) -> None:
+        self.throttle = throttle
+        self.client = client
+
+
+    async def check(self, email: str) -> None:
+        await self.throttle.check(email, self.client)
+
+
+    async def failed(self, email: str) -> None:
+        await self.throttle.failed(email, self.client)
+
+
+    async def succeeded(self, email: str) -> None:
+        await self.throttle.succeeded(email, self.client)
@@ -1,20 +1,21 @@
 from uuid import UUID
 from typing import Annotated
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import HTTPBearer
 from sqlalchemy import select
 
 from src.config import settings
 from src.database import db_dependency
-from src.jwt import verify_token
+from src.jwt import access_claims, verify_token
 from src.auth.models import User
 
 
 oauth2_schema = HTTPBearer()
 
 
-async def get_user(db : db_dependency, token: str = Depends(oauth2_schema)) -> User :
-    payload = verify_token(token.credentials, settings.access_secret_key)
+async def get_user(request: Request, db : db_dependency, token: str = Depends(oauth2_schema)) -> User :
+    # already verified by the rate limiter; verify again only to raise the right error
+    payload = access_claims(request) or verify_token(token.credentials, settings.access_secret_key)
     if payload is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -0,0 +1,116 @@
+"""
+In-process snapshot of the plan catalog.
+
+Plans change rarely, so listing plans, fetching one, and resolving a plan
+code at checkout are served from an immutable snapshot with the JSON
+bodies already serialized. Plan mutations rebuild the snapshot and publish
+its version to Redis. Other processes compare against that version every
+few seconds, or reload on a timer when Redis is unavailable.
+"""
+import logging
+import time
+from types import MappingProxyType
+from typing import Mapping
+from uuid import UUID
+from pydantic import TypeAdapter
+from redis.exceptions import RedisError
+from src.billing.constants import PLAN_CATALOG_CHECK_INTERVAL, PLAN_CATALOG_TTL
+from src.billing.repository import PlanRepository
+from src.billing.schemas import PlanOut, PlanSnapshot
+from src.cache import get_redis
+from src.http_cache import etag_for
+
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = "billing:plans:version"
+
+_plan_list_adapter = TypeAdapter(list[PlanOut])
+_snapshot_list_adapter = TypeAdapter(list[PlanSnapshot])
+
+
+class PlanCatalog:
+    """Immutable view of every plan, indexed by id and by (active) code."""
+    def __init__(self, plans: list[PlanSnapshot]) -> None:
+        active = [plan for plan in plans if plan.is_active]
+        self.by_id: Mapping[UUID, PlanSnapshot] = MappingProxyType({plan.id: plan for plan in plans})
+        self.by_code: Mapping[str, PlanSnapshot] = MappingProxyType({plan.code: plan for plan in active})
+
+        # GET /billing/plans and /billing/plans/{id}, serialized once
+        self.body = _plan_list_adapter.dump_json(active)  # type: ignore[arg-type]
+        self.etag = etag_for(self.body)
+        bodies = {}
+        for plan in plans:
+            body = PlanOut.model_validate(plan, from_attributes=True).model_dump_json().encode()
+            bodies[plan.id] = (body, etag_for(body))
+        self.plan_bodies: Mapping[UUID, tuple[bytes, str]] = MappingProxyType(bodies)
+
+        self.version = etag_for(_snapshot_list_adapter.dump_json(sorted(plans, key=lambda plan: str(plan.id)))).strip('"')
+
+
+class PlanCatalogCache:
+    def __init__(self) -> None:
+        self._catalog: PlanCatalog | None = None
+        self._loaded_at = 0.0
+        self._checked_at = 0.0
+
+
+    def invalidate(self) -> None:
+        self._catalog = None
+
+
+    async def rebuild(self, repo: PlanRepository, publish: bool = True) -> PlanCatalog:
+        plans = await repo.list_plans(active_only=False)
+        catalog = PlanCatalog([PlanSnapshot.model_validate(plan) for plan in plans])
+        self._catalog = catalog
+        self._loaded_at = self._checked_at = time.monotonic()
+        if publish:
+            await self._publish(catalog.version)
+        return catalog
+
+
+    async def get(self, repo: PlanRepository) -> PlanCatalog:
+        catalog = self._catalog
+        if catalog is None or await self._is_stale(catalog):
+            catalog = await self.rebuild(repo, publish=False)
+        return catalog
+
+
+    async def get_by_id(self, plan_id: UUID, repo: PlanRepository) -> PlanSnapshot | None:
+        return (await self.get(repo)).by_id.get(plan_id)
+
+
+    async def get_by_code(self, code: str, repo: PlanRepository) -> PlanSnapshot | None:
+        return (await self.get(repo)).by_code.get(code)
+
+
+    async def _is_stale(self, catalog: PlanCatalog) -> bool:
+        now = time.monotonic()
+        if now - self._checked_at < PLAN_CATALOG_CHECK_INTERVAL:
+            return False
+
+        redis = get_redis()
+        if redis is not None:
+            try:
+                published = await redis.get(VERSION_KEY)
+            except (RedisError, OSError):
+                logger.warning("Redis unavailable, plan catalog falls back to a %ss reload", PLAN_CATALOG_TTL)
+            else:
+                self._checked_at = now
+                return published is not None and published.decode() != catalog.version
+
+        return now - self._loaded_at >= PLAN_CATALOG_TTL
+
+
+    async def _publish(self, version: str) -> None:
+        redis = get_redis()
+        if redis is None:
+            return
+        try:
+            await redis.set(VERSION_KEY, version)
+        except (RedisError, OSError):
+            logger.warning("Could not publish plan catalog version, other processes reload within %ss",
+                           PLAN_CATALOG_TTL)
+
+
+plan_catalog = PlanCatalogCache()
@@ -0,0 +1,74 @@
+from datetime import timedelta
+from src.billing.models import SubscriptionStatus
+
+
+# Subscriptions in these states lose access once current_period_end has passed.
+# Only rows no provider manages are swept: Stripe renews after the period ends
+# and cancels through customer.subscription.deleted
+EXPIRABLE_STATUSES = (
+    SubscriptionStatus.ACTIVE,
+    SubscriptionStatus.TRIALING,
+    SubscriptionStatus.PENDING,
+    SubscriptionStatus.PAST_DUE,
+)
+
+EXPIRE_BATCH_SIZE = 500
+# how long past current_period_end a subscription is left alone before the sweep cancels it
+EXPIRE_GRACE_PERIOD = timedelta(days=1)
+
+# invoice.payment_succeeded billing_reason -> subscription email topic
+INVOICE_EMAIL_TOPICS = {
+    "subscription_create": "subscription",
+    "subscription_cycle": "subscription_update",
+}
+
+# outbox relay: rows claimed per transaction, and idle wait when the outbox is drained
+OUTBOX_BATCH_SIZE = 500
+OUTBOX_POLL_INTERVAL = 1.0
+
+# stored Stripe events: failed processing attempts before giving up, and how
+# long an event may sit unprocessed before the sweep re-enqueues it
+STRIPE_EVENT_MAX_ATTEMPTS = 5
+STRIPE_EVENT_REQUEUE_AFTER = timedelta(minutes=15)
+
+# Redis fast path for processed Stripe events; Stripe retries deliveries for up to 3 days
+STRIPE_EVENT_PROCESSED_TTL = timedelta(days=7)
+STRIPE_EVENT_LOCK_TTL = timedelta(minutes=5)
+
+# fallback cache of stripe.Subscription objects for events that lack period/metadata
+STRIPE_SUBSCRIPTION_CACHE_TTL = 60  # seconds
+STRIPE_SUBSCRIPTION_CACHE_SIZE = 1024
+
+# max age of a webhook signature timestamp, same default as stripe.Webhook
+STRIPE_WEBHOOK_TOLERANCE = 300  # seconds
+
+# in-process plan catalog: how often to compare it with the version other
+# processes published in Redis, and the max age when Redis is unavailable
+PLAN_CATALOG_CHECK_INTERVAL = 2  # seconds
+PLAN_CATALOG_TTL = 60  # seconds
+
+# Rate limits per plan tier on top of src.rate_limiter.ROUTE_LIMITS ("*" is the
+# tier's budget for routes without their own entry), and requests per UTC day
+# across all rate-limited routes (tiers without a quota are unmetered).
+# Anonymous callers get the untiered limits and no quota.
+TIER_ROUTE_LIMITS: dict[str, dict[str, str]] = {
+    "PRO": {
+        "*": "60/minute",
+        "/billing/plans": "300/minute",
+        "/billing/plans/{plan_id}": "300/minute",
+        "/billing/subscriptions/me": "120/minute",
+        "/billing/payments/me": "120/minute",
+    },
+    "VIP": {
+        "*": "300/minute",
+        "/billing/plans": "1000/minute",
+        "/billing/plans/{plan_id}": "1000/minute",
+        "/billing/subscriptions/me": "600/minute",
+        "/billing/payments/me": "600/minute",
+    },
+}
+DAILY_QUOTAS: dict[str, int] = {"FREE": 1_000, "PRO": 50_000}
+
+# how long a user's resolved plan tier is reused per process (upgrades apply within this)
+PLAN_TIER_CACHE_TTL = 30  # seconds
+PLAN_TIER_CACHE_SIZE = 10_000
@@ -1,6 +1,6 @@
 from typing import Annotated, Tuple
 from fastapi import Depends, HTTPException, status
-from src.billing.repository import PlanRepository, SubscriptionRepoistory, PaymentRepository
+from src.billing.repository import PlanRepository, SubscriptionRepoistory, PaymentRepository, StripeEventRepository
 from src.database import db_dependency
 from typing import Callable, Awaitable, Tuple
 from src.auth.models import User
@@ -25,6 +25,12 @@ def get_payment_repo(db: db_dependency)-> PaymentRepository:
 payment_dependency = Annotated[PaymentRepository, Depends(get_payment_repo)]
 
 
+def get_stripe_event_repo(db: db_dependency) -> StripeEventRepository:
+    return StripeEventRepository(db)
+
+stripe_event_dependency = Annotated[StripeEventRepository, Depends(get_stripe_event_repo)]
+
+
 def require_plan(min_plan: PlanTier):
     async def _dep(
         user: user_dependency,
@@ -1,14 +1,12 @@
-from datetime import datetime
-from fastapi_mail import FastMail, MessageSchema, MessageType
-from src.utils import conf
-from src.config import settings
+from fastapi_mail import MessageSchema, MessageType
+from src.mail import mailer
 import logging
 
 logger = logging.getLogger(__name__)
 
 class Emails:
     @staticmethod
-    async def send_subscription_email(subscription: dict):
+    def subscription_message(subscription: dict) -> tuple[MessageSchema, str]:
         message = MessageSchema(
             subject="Subscription Confirmation",
             recipients=[subscription["user"]["email"]],  # list of recipients # type: ignore
@@ -17,20 +15,14 @@ class Emails:
                 "price": subscription["price"],
                 "end_date": subscription["end_date"] if subscription["end_date"] else "N/A", 
                 "user_name": subscription["user"]["username"], 
-                "dashboard_url": settings.app_url,
-                "app_name": settings.app_name, "expires_in": settings.validation_token_expire,
-                "app_url": settings.app_url,
-                "support_email": "support@fast_api.com", "company_address": "1234 Street, City, Country",
-                "year": datetime.now().year
                 },
             subtype=MessageType.html
         )
-        fm = FastMail(conf)
-        await fm.send_message(message, template_name="subscribe_email.html")
+        return message, "subscribe_email.html"
 
 
     @staticmethod
-    async def send_subscription_update_email(subscription: dict):
+    def subscription_update_message(subscription: dict) -> tuple[MessageSchema, str]:
         # Fallbacks
         end_date = subscription.get("end_date") or "N/A"
         next_billing_date = subscription.get("next_billing_date") or end_date
@@ -48,26 +40,17 @@ class Emails:
 
                 "user_name": subscription["user"]["username"],
 
-                "dashboard_url": settings.app_url,
-                "app_name": settings.app_name,
-                "app_url": settings.app_url,
-
-                "support_email": "support@fast_api.com",
-                "company_address": "1234 Street, City, Country",
-                "year": datetime.now().year,
-
                 # Used in header & title: "Subscription {{email_type}}"
                 "email_type": email_type,
             },
             subtype=MessageType.html,
         )
 
-        fm = FastMail(conf)
-        await fm.send_message(message, template_name="update_subscribe_email.html")
+        return message, "update_subscribe_email.html"
 
 
     @staticmethod
-    async def send_cancel_subscription_email(subscription: dict):
+    def cancel_subscription_message(subscription: dict) -> tuple[MessageSchema, str]:
         message = MessageSchema(
             subject="Subscription Canceled",
             recipients=[subscription["user"]["email"]],  # list of recipients # type: ignore
@@ -76,21 +59,14 @@ class Emails:
                 "price": subscription["price"],
                 "end_date": subscription["end_date"] if subscription["end_date"] else "N/A", 
                 "user_name": subscription["user"]["username"], 
-                "dashboard_url": settings.app_url,
-                "app_name": settings.app_name, "expires_in": settings.validation_token_expire,
-                "app_url": settings.app_url,
-                "support_email": "support@fast_api.com", "company_address": "1234 Street, City, Country",
-                "year": datetime.now().year
                 },
             subtype=MessageType.html
         )
-        fm = FastMail(conf)
-        await fm.send_message(message, template_name="delete_subscripe.html")
-
+        return message, "delete_subscripe.html"
 
 
     @staticmethod
-    async def send_payment_failed_email(subscription: dict):
+    def payment_failed_message(subscription: dict) -> tuple[MessageSchema, str]:
         message = MessageSchema(
             subject="Invoice Payment Failed",
             recipients=[subscription["user"]["email"]],  # list of recipients # type: ignore
@@ -99,13 +75,51 @@ class Emails:
                 "price": subscription["price"],
                 "end_date": subscription["end_date"] if subscription["end_date"] else "N/A", 
                 "user_name": subscription["user"]["username"], 
-                "dashboard_url": settings.app_url,
-                "app_name": settings.app_name, "expires_in": settings.validation_token_expire,
-                "app_url": settings.app_url,
-                "support_email": "support@fast_api.com", "company_address": "1234 Street, City, Country",
-                "year": datetime.now().year
                 },
             subtype=MessageType.html
         )
-        fm = FastMail(conf)
-        await fm.send_message(message, template_name="payment_failed.html")
+        return message, "payment_failed.html"
+
+
+    @staticmethod
+    async def send_subscription_email(subscription: dict):
+        await mailer.send_message(*Emails.subscription_message(subscription))
+
+
+    @staticmethod
+    async def send_subscription_update_email(subscription: dict):
+        await mailer.send_message(*Emails.subscription_update_message(subscription))
+
+
+    @staticmethod
+    async def send_cancel_subscription_email(subscription: dict):
+        await mailer.send_message(*Emails.cancel_subscription_message(subscription))
+
+
+    @staticmethod
+    async def send_payment_failed_email(subscription: dict):
+        await mailer.send_message(*Emails.payment_failed_message(subscription))
+
+
+    @staticmethod
+    async def send_bulk(email_type: str, subscriptions: list[dict]) -> list[dict]:
+        """
+        Send one kind of subscription email to many recipients over a single
+        SMTP connection. Recipients the server rejects are logged and their
+        subscriptions returned; a dropped connection raises
+        ``BatchInterrupted`` with the positions that were not delivered.
+        """
+        build = getattr(Emails, MESSAGE_BUILDERS[email_type])
+        rejected = await mailer.send_messages([build(subscription) for subscription in subscriptions])
+        for _, message, exc in rejected:
+            logger.warning("Failed to send %s email to %s: %s", email_type, message["To"], exc)
+        return [subscriptions[position] for position, *_ in rejected]
+
+
+# email_type -> Emails message builder, used by send_bulk
+MESSAGE_BUILDERS = {
+    "subscription": "subscription_message",
+    "subscription_update": "subscription_update_message",
+    "cancel_subscription": "cancel_subscription_message",
+    "payment_failed": "payment_failed_message",
+}
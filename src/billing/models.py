@@ -1,10 +1,10 @@
 from uuid import uuid4, UUID as PyUUID
 from enum import Enum, IntEnum
-from datetime import timezone, datetime
+from datetime import timezone, datetime, date
 from src.database import Base
-from sqlalchemy import String, DateTime, ForeignKey, Integer, Enum as SAEnum, Boolean, UniqueConstraint
+from sqlalchemy import String, Text, Date, DateTime, ForeignKey, Integer, BigInteger, Enum as SAEnum, Boolean, UniqueConstraint, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import UUID, JSONB
 
 
 class SubscriptionStatus(str, Enum):
@@ -80,12 +80,21 @@ class Subscription(Base):
     current_period_end: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
     canceled_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
     cancel_at_period_end: Mapped[bool] = mapped_column(Boolean, default=False)
+    # row version for ETags on /billing/subscriptions/me
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True),
+                default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
 
 
     user = relationship("User", back_populates="subscriptions")
     plan = relationship("Plan", back_populates="subscriptions")
 
 
+    __table_args__ = (
+        # used by expire_subscriptions_task to find overdue rows without scanning history
+        Index("ix_subscriptions_status_current_period_end", "status", "current_period_end"),
+    )
+
+
 
 class Payment(Base):
     __tablename__ = "payments"
@@ -100,6 +109,8 @@ class Payment(Base):
     status: Mapped[PaymentStatus] = mapped_column(SAEnum(PaymentStatus))
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True),
                                     default=lambda: datetime.now(timezone.utc))
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True),
+                default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
     
 
     __table_args__ = (
@@ -109,4 +120,55 @@ class Payment(Base):
 
 
 
+class OutboxMessage(Base):
+    """
+    Notification staged in the same transaction as the billing change that
+    caused it; the outbox relay publishes it to Celery after commit.
+    """
+    __tablename__ = "outbox"
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    topic: Mapped[str] = mapped_column(String(50))
+    payload: Mapped[dict] = mapped_column(JSONB)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True),
+                                    default=lambda: datetime.now(timezone.utc))
+
+
+
+class StripeEvent(Base):
+    """
+    Verified Stripe webhook event, stored on receipt and processed later by
+    ``process_stripe_event_task``. The primary key is Stripe's event id.
+    """
+    __tablename__ = "stripe_events"
 
+    id: Mapped[str] = mapped_column(String(255), primary_key=True)
+    type: Mapped[str] = mapped_column(String(100))
+    payload: Mapped[dict] = mapped_column(JSONB)
+    received_at: Mapped[datetime] = mapped_column(DateTime(timezone=True),
+                                    default=lambda: datetime.now(timezone.utc))
+    processed_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    attempts: Mapped[int] = mapped_column(Integer(), default=0)
+    last_error: Mapped[str | None] = mapped_column(Text(), nullable=True)
+
+
+    __table_args__ = (
+        # the requeue sweep only ever looks at unprocessed events
+        Index("ix_stripe_events_unprocessed", "received_at", postgresql_where=processed_at.is_(None)),
+    )
+
+
+
+class ApiUsage(Base):
+    """
+    Rate-limited requests per user and UTC day. Redis holds the live counters
+    that enforce the daily quota; ``persist_api_usage_task`` copies them here.
+    """
+    __tablename__ = "api_usage"
+
+    user_id: Mapped[PyUUID] = mapped_column(UUID(as_uuid=True),
+            ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    day: Mapped[date] = mapped_column(Date(), primary_key=True)
+    requests: Mapped[int] = mapped_column(BigInteger(), default=0)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True),
+                default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
@@ -0,0 +1,65 @@
+"""
+Outbox relay: publishes staged billing notifications to Celery.
+
+Rows are claimed with ``FOR UPDATE SKIP LOCKED`` so several relays can run
+side by side, published as one bulk email task per topic, and deleted in the
+same transaction. Delivery is at-least-once: a crash between publish and
+commit re-publishes the batch.
+
+    python -m src.billing.outbox
+"""
+import logging
+import time
+from collections import defaultdict
+from sqlalchemy import select, delete
+from sqlalchemy.orm import Session
+from src.billing.models import OutboxMessage
+from src.billing.constants import OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL
+from src.billing.tasks import send_subscription_emails_task
+from src.database import SyncSessionLocal
+
+
+logger = logging.getLogger(__name__)
+
+
+def relay_outbox_batch(db: Session, limit: int = OUTBOX_BATCH_SIZE) -> int:
+    """Publish and remove up to ``limit`` outbox rows. Returns how many were relayed."""
+    messages = db.execute(
+        select(OutboxMessage)
+        .order_by(OutboxMessage.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    ).scalars().all()
+    if not messages:
+        return 0
+
+    by_topic: dict[str, list[dict]] = defaultdict(list)
+    for message in messages:
+        by_topic[message.topic].append(message.payload)
+
+    for topic, payloads in by_topic.items():
+        send_subscription_emails_task.delay(topic, payloads)
+
+    db.execute(delete(OutboxMessage).where(OutboxMessage.id.in_([message.id for message in messages])))
+    db.commit()
+    return len(messages)
+
+
+def run_relay(batch_size: int = OUTBOX_BATCH_SIZE, poll_interval: float = OUTBOX_POLL_INTERVAL) -> None:
+    logger.info("Outbox relay started")
+    while True:
+        try:
+            with SyncSessionLocal() as db:
+                relayed = relay_outbox_batch(db, batch_size)
+        except Exception:
+            # broker or database unavailable, rows stay in the outbox until the next pass
+            logger.exception("Outbox relay pass failed")
+            relayed = 0
+
+        if relayed < batch_size:
+            time.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run_relay()
@@ -0,0 +1,77 @@
+"""
+Plan tiers for rate limiting.
+
+The limiter asks ``resolve_tier`` for the tier of every authenticated
+request. It is looked up once per request (kept on ``request.state``) and
+cached per user for ``PLAN_TIER_CACHE_TTL`` seconds, so a busy user costs
+one small query per process and TTL. Users without a subscription that
+grants access are FREE; anonymous callers have no tier.
+
+``TIER_LIMITS`` and ``TIER_DAILY_QUOTAS`` are the defaults from
+``src.billing.constants`` merged with ``RATE_LIMIT_TIERS``/``DAILY_QUOTAS``.
+"""
+import time
+from collections import OrderedDict
+from uuid import UUID
+from starlette.requests import Request
+from src.billing.constants import DAILY_QUOTAS, PLAN_TIER_CACHE_SIZE, PLAN_TIER_CACHE_TTL, TIER_ROUTE_LIMITS
+from src.billing.models import PlanTier
+from src.billing.repository import SubscriptionRepoistory
+from src.config import settings
+from src.database import async_session
+from src.jwt import access_claims
+
+
+TIER_LIMITS: dict[str, dict[str, str]] = {
+    tier: {**TIER_ROUTE_LIMITS.get(tier, {}), **settings.rate_limit_tiers.get(tier, {})}
+    for tier in {*TIER_ROUTE_LIMITS, *settings.rate_limit_tiers}
+}
+TIER_DAILY_QUOTAS: dict[str, int] = {**DAILY_QUOTAS, **settings.daily_quotas}
+
+
+class PlanTierCache:
+    def __init__(self, ttl: float = PLAN_TIER_CACHE_TTL, max_size: int = PLAN_TIER_CACHE_SIZE) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self._tiers: OrderedDict[str, tuple[float, PlanTier]] = OrderedDict()
+
+
+    def get(self, user_id: str) -> PlanTier | None:
+        entry = self._tiers.get(user_id)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+
+    def set(self, user_id: str, tier: PlanTier) -> None:
+        self._tiers[user_id] = (time.monotonic() + self.ttl, tier)
+        self._tiers.move_to_end(user_id)
+        if len(self._tiers) > self.max_size:
+            self._tiers.popitem(last=False)
+
+
+    def clear(self) -> None:
+        self._tiers.clear()
+
+
+plan_tier_cache = PlanTierCache()
+
+
+async def resolve_tier(request: Request) -> str | None:
+    """Plan tier name of the request's authenticated user, None for anonymous requests."""
+    state = request.state
+    if hasattr(state, "plan_tier"):
+        return state.plan_tier
+
+    claims = access_claims(request)
+    tier_name = None
+    if claims is not None:
+        user_id = claims["sub"]
+        tier = plan_tier_cache.get(user_id)
+        if tier is None:
+            async with async_session() as db:
+                tier = await SubscriptionRepoistory(db).get_access_tier(UUID(user_id)) or PlanTier.FREE
+            plan_tier_cache.set(user_id, tier)
+        tier_name = tier.name
+    state.plan_tier = tier_name
+    return tier_name
@@ -1,10 +1,20 @@
+import logging
+from contextlib import asynccontextmanager
 from uuid import UUID
-from typing import List, Optional
-from datetime import datetime, timedelta, timezone
-from sqlalchemy import select
+from typing import AsyncIterator, List, Optional
+from datetime import date, datetime, timedelta, timezone
+from sqlalchemy import select, update, func
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import selectinload
-from sqlalchemy.ext.asyncio import AsyncSession
-from src.billing.models import Plan, Subscription, SubscriptionStatus, BillingPeriod, PaymentStatus, Payment, PaymentProvider
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+from src.billing.models import Plan, PlanTier, Subscription, SubscriptionStatus, BillingPeriod, PaymentStatus, Payment, PaymentProvider, StripeEvent, ApiUsage
+from src.billing.utils import subscription_outbox_message
+from src.billing.constants import STRIPE_EVENT_PROCESSED_TTL, STRIPE_EVENT_LOCK_TTL
+from src.cache import get_redis
+from redis.exceptions import RedisError
+
+
+logger = logging.getLogger(__name__)
 
 
 class PlanRepository:
@@ -95,6 +105,24 @@ class SubscriptionRepoistory:
         return result.scalar_one_or_none()
     
 
+    async def get_access_tier(self, user_id: UUID) -> PlanTier | None:
+        """Tier of the plan behind ``get_subscription_with_access``, in one query."""
+        now = datetime.now(timezone.utc)
+
+        result = await self.db.execute(
+            select(Plan.tier)
+            .join(Subscription, Subscription.plan_id == Plan.id)
+            .where(
+                Subscription.user_id == user_id,
+                Subscription.current_period_end > now,
+                Subscription.status.in_([SubscriptionStatus.ACTIVE, SubscriptionStatus.CANCELED]),
+            )
+            .order_by(Subscription.current_period_end.desc())
+            .limit(1)
+        )
+        return result.scalar_one_or_none()
+
+
     async def create_subscription(self, user_id: UUID, plan: Plan, provider: str, 
             provider_subscription_id: str, provider_customer_id: str) -> Subscription:
         old_sub = await self.get_subscription_with_access(user_id)
@@ -152,12 +180,18 @@ class SubscriptionRepoistory:
         provider_subscription_id: str,
         current_period_start: datetime,
         current_period_end: datetime,
+        notify: str | None = None,
     ) -> Subscription | None:
         result = await self.db.execute(
-            select(Subscription).where(
+            select(Subscription)
+            .where(
                 Subscription.provider == provider,
                 Subscription.provider_subscription_id == provider_subscription_id,
             )
+            .options(
+                selectinload(Subscription.user),
+                selectinload(Subscription.plan),
+            )
         )
         sub = result.scalar_one_or_none()
         if not sub:
@@ -166,6 +200,8 @@ class SubscriptionRepoistory:
         sub.status = SubscriptionStatus.ACTIVE  
         sub.started_at = current_period_start
         sub.current_period_end = current_period_end
+        if notify:
+            self.db.add(subscription_outbox_message(notify, sub))
 
         await self.db.commit()
         await self.db.refresh(sub)
@@ -186,12 +222,18 @@ class SubscriptionRepoistory:
         provider_subscription_id: str,
         canceled_at: datetime,
         current_period_end: datetime | None = None,
+        notify: str | None = None,
     ) -> Subscription | None:
         result = await self.db.execute(
-            select(Subscription).where(
+            select(Subscription)
+            .where(
                 Subscription.provider == provider,
                 Subscription.provider_subscription_id == provider_subscription_id,
             )
+            .options(
+                selectinload(Subscription.user),
+                selectinload(Subscription.plan),
+            )
         )
         sub = result.scalar_one_or_none()
         if not sub:
@@ -204,6 +246,8 @@ class SubscriptionRepoistory:
         
         if current_period_end is not None:
             sub.current_period_end = current_period_end
+        if notify:
+            self.db.add(subscription_outbox_message(notify, sub))
 
         await self.db.commit()
         await self.db.refresh(sub)
@@ -224,18 +268,26 @@ class SubscriptionRepoistory:
         provider: str,
         provider_subscription_id: str,
         sub_status: SubscriptionStatus,
+        notify: str | None = None,
     ):
         result = await self.db.execute(
-            select(Subscription).where(
+            select(Subscription)
+            .where(
                 Subscription.provider == provider,
                 Subscription.provider_subscription_id == provider_subscription_id,
             )
+            .options(
+                selectinload(Subscription.user),
+                selectinload(Subscription.plan),
+            )
         )
         sub = result.scalar_one_or_none()
         if not sub or sub.status == SubscriptionStatus.CANCELED:
             return None
         
         sub.status = sub_status  
+        if notify:
+            self.db.add(subscription_outbox_message(notify, sub))
         await self.db.commit()
         await self.db.refresh(sub)
         result = await self.db.execute(
@@ -266,21 +318,46 @@ class PaymentRepository:
         provider: PaymentProvider = PaymentProvider.STRIPE,
     ) -> Payment:
         
-        payment = Payment(
-            user_id=user_id,
-            subscription_id=subscription_id,
-            provider=provider,
-            provider_invoice_id=provider_invoice_id,
-            amount_cents=amount_cents,
-            currency=currency,
-            status=status,
+        # Stripe may deliver the same invoice more than once, keep the first payment
+        result = await self.db.execute(
+            insert(Payment)
+            .values(
+                user_id=user_id,
+                subscription_id=subscription_id,
+                provider=provider,
+                provider_invoice_id=provider_invoice_id,
+                amount_cents=amount_cents,
+                currency=currency,
+                status=status,
+            )
+            .on_conflict_do_nothing(constraint="uq_provider_invoice_id")
+            .returning(Payment.id)
         )
-        self.db.add(payment)
+        payment_id = result.scalar_one_or_none()
         await self.db.commit()
-        await self.db.refresh(payment)
-        return payment
+
+        if payment_id is None:
+            result = await self.db.execute(
+                select(Payment).where(
+                    Payment.provider == provider,
+                    Payment.provider_invoice_id == provider_invoice_id,
+                )
+            )
+        else:
+            result = await self.db.execute(select(Payment).where(Payment.id == payment_id))
+        return result.scalar_one()
     
 
+    async def get_payments_version(self, user_id: UUID) -> tuple[int, datetime | None]:
+        """Row count and latest ``updated_at`` of a user's payments, a cheap validator for the list."""
+        result = await self.db.execute(
+            select(func.count(Payment.id), func.max(Payment.updated_at))
+            .where(Payment.user_id == user_id)
+        )
+        count, last_updated = result.one()
+        return count, last_updated
+
+
     async def get_my_payments(self, user_id: UUID) -> list[Payment]:
         stmt = (
             select(Payment)
@@ -289,4 +366,164 @@ class PaymentRepository:
         )
 
         result = await self.db.execute(stmt)
-        return list(result.scalars().all())
\ No newline at end of file
+        return list(result.scalars().all())
+
+
+
+class StripeEventRepository:
+    """
+    Stored Stripe events. Processed event ids are also kept in Redis so a
+    redelivery is answered with one key lookup; Postgres stays the source
+    of truth whenever Redis is missing or has expired the key.
+    """
+    def __init__(self, db: AsyncSession) -> None:
+        self.db = db
+        self.redis = get_redis()
+
+
+    @staticmethod
+    def _processed_key(event_id: str) -> str:
+        return f"stripe:event:{event_id}:processed"
+
+
+    @staticmethod
+    def _lock_key(event_id: str) -> str:
+        return f"stripe:event:{event_id}:lock"
+
+
+    async def save(self, event_id: str, event_type: str, payload: dict) -> bool:
+        """Store a webhook event once; returns False if Stripe already delivered it."""
+        result = await self.db.execute(
+            insert(StripeEvent)
+            .values(id=event_id, type=event_type, payload=payload,
+                    received_at=datetime.now(timezone.utc), attempts=0)
+            .on_conflict_do_nothing(index_elements=[StripeEvent.id])
+        )
+        await self.db.commit()
+        return result.rowcount == 1
+
+
+    async def get(self, event_id: str) -> StripeEvent | None:
+        result = await self.db.execute(
+            select(StripeEvent).where(StripeEvent.id == event_id)
+        )
+        return result.scalar_one_or_none()
+
+
+    async def is_processed_cached(self, event_id: str) -> bool:
+        """Redis-only check, False when Redis does not know the event or is unavailable."""
+        if self.redis is None:
+            return False
+        try:
+            return bool(await self.redis.exists(self._processed_key(event_id)))
+        except (RedisError, OSError):
+            logger.warning("Redis unavailable, checking Stripe event %s in Postgres", event_id)
+            return False
+
+
+    async def claim(self, event_id: str) -> bool:
+        """
+        Take a short-lived processing lock so concurrent deliveries of the same
+        event are not handled twice. Without Redis every caller gets the claim.
+        """
+        if self.redis is None:
+            return True
+        try:
+            acquired = await self.redis.set(self._lock_key(event_id), 1, nx=True,
+                                            ex=int(STRIPE_EVENT_LOCK_TTL.total_seconds()))
+            return bool(acquired)
+        except (RedisError, OSError):
+            return True
+
+
+    async def release(self, event_id: str) -> None:
+        if self.redis is None:
+            return
+        try:
+            await self.redis.delete(self._lock_key(event_id))
+        except (RedisError, OSError):
+            pass
+
+
+    @asynccontextmanager
+    async def processing(self, event_id: str) -> AsyncIterator[Optional[StripeEvent]]:
+        """
+        Run the block (the event's handler) and mark the event processed in
+        one database transaction, so a failure anywhere in between leaves
+        neither behind and the retry starts clean. Yields the event row,
+        locked until the block is done, or None, and the block should do
+        nothing, if another run processed it first.
+
+        The session must be bound to a connection with
+        ``join_transaction_mode="create_savepoint"``: commits made by
+        repositories inside the block then only release savepoints.
+        """
+        connection = self.db.bind
+        if not isinstance(connection, AsyncConnection):
+            raise TypeError("StripeEventRepository.processing needs a session bound to a connection")
+
+        await self.db.rollback()  # end the session's own transaction so it joins the one below
+        async with connection.begin():
+            try:
+                event = await self.db.scalar(
+                    select(StripeEvent).where(StripeEvent.id == event_id).with_for_update()
+                )
+                pending = event if event is not None and event.processed_at is None else None
+                yield pending
+                if pending is not None:
+                    await self.db.execute(
+                        update(StripeEvent)
+                        .where(StripeEvent.id == event_id)
+                        .values(processed_at=datetime.now(timezone.utc), last_error=None)
+                    )
+                await self.db.commit()
+            except BaseException:
+                await self.db.rollback()
+                raise
+        await self.cache_processed(event_id)
+
+
+    async def cache_processed(self, event_id: str) -> None:
+        if self.redis is None:
+            return
+        try:
+            await self.redis.set(self._processed_key(event_id), 1,
+                                 ex=int(STRIPE_EVENT_PROCESSED_TTL.total_seconds()))
+        except (RedisError, OSError):
+            pass
+
+
+    async def mark_failed(self, event_id: str, error: str) -> None:
+        # the handler may have left the session mid-transaction
+        await self.db.rollback()
+        await self.db.execute(
+            update(StripeEvent)
+            .where(StripeEvent.id == event_id)
+            .values(attempts=StripeEvent.attempts + 1, last_error=error)
+        )
+        await self.db.commit()
+
+
+
+class ApiUsageRepository:
+    def __init__(self, db: AsyncSession) -> None:
+        self.db = db
+
+
+    async def save_counts(self, day: date, counts: dict[UUID, int]) -> None:
+        """Upsert one day's counters; counts only grow, so a late or repeated run never lowers them."""
+        if not counts:
+            return
+        stmt = insert(ApiUsage).values([
+            {"user_id": user_id, "day": day, "requests": requests} for user_id, requests in counts.items()
+        ])
+        await self.db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[ApiUsage.user_id, ApiUsage.day],
+                set_={
+                    "requests": func.greatest(ApiUsage.requests, stmt.excluded.requests),
+                    "updated_at": func.now(),
+                },
+            )
+        )
+        await self.db.commit()
@@ -3,9 +3,12 @@ from src.rate_limiter import limiter
 from fastapi import APIRouter, status, Request, Header
 from src.billing.service import PlanService, SubscriptionService, PaymentService
 from src.billing import schemas
-from src.billing.dependencies import plan_dependency, subscription_dependency, payment_dependency
+from src.billing.dependencies import plan_dependency, subscription_dependency, payment_dependency, stripe_event_dependency
 from src.auth.dependencies import repo_dependency
 from src.auth_bearer import  user_dependency, admin_user_dependency
+from src.billing.utils import plan_surrogate_keys, subscription_etag
+from src.responses import dump_json
+from src.http_cache import json_response, etag_matches, not_modified, PUBLIC_CACHE, PRIVATE_CACHE
 
 
 
@@ -13,9 +16,9 @@ router = APIRouter(prefix="/billing", tags=["billing"])
 
 
 @router.get("/plans", response_model=list[schemas.PlanOut], status_code=status.HTTP_200_OK)
-async def list_plans(plan_dep: plan_dependency):
-    result = await PlanService.retrive_plans(plan_dep)
-    return result
+async def list_plans(request: Request, plan_dep: plan_dependency):
+    catalog = await PlanService.retrive_plans(plan_dep)
+    return json_response(request, catalog.body, catalog.etag, PUBLIC_CACHE, plan_surrogate_keys())
 
 
 @router.post("/plans", response_model=schemas.PlanOut, status_code=status.HTTP_201_CREATED)
@@ -26,9 +29,9 @@ async def create_plan(data: schemas.PlanCreate, plan_dep: plan_dependency, admin
 
 
 @router.get("/plans/{plan_id}", response_model=schemas.PlanOut, status_code=status.HTTP_200_OK)
-async def get_plan(plan_id: UUID, plan_dep: plan_dependency):
-    plan = await PlanService.get_plan_by_id(plan_id, plan_dep)
-    return plan
+async def get_plan(plan_id: UUID, request: Request, plan_dep: plan_dependency):
+    body, etag = await PlanService.get_plan_body(plan_id, plan_dep)
+    return json_response(request, body, etag, PUBLIC_CACHE, plan_surrogate_keys(plan_id))
 
 
 @router.delete("/plans/{plan_id}", status_code=status.HTTP_204_NO_CONTENT)
@@ -43,15 +46,23 @@ async def update_plan(plan_id: UUID, data: schemas.PlanUpdate, plan_dep: plan_de
 
 
 @router.get("/payments/me", response_model=list[schemas.PaymentResponse], status_code=status.HTTP_200_OK)
-async def get_my_payments(user: user_dependency, payment_deb: payment_dependency):
+async def get_my_payments(request: Request, user: user_dependency, payment_deb: payment_dependency):
+    etag = await PaymentService.get_my_payments_etag(user, payment_deb)
+    if etag_matches(request, etag):
+        return not_modified(etag, PRIVATE_CACHE)
     payments = await PaymentService.get_my_payments(user, payment_deb)
-    return payments
+    body = dump_json(list[schemas.PaymentResponse], payments)
+    return json_response(request, body, etag, PRIVATE_CACHE)
 
 
 @router.get("/subscriptions/me", response_model=schemas.SubscriptionOut, status_code=status.HTTP_200_OK)
-async def get_my_subscription(user: user_dependency, sub_dep: subscription_dependency):
+async def get_my_subscription(request: Request, user: user_dependency, sub_dep: subscription_dependency):
     subscription = await SubscriptionService.get_user_subscription(user.id, sub_dep)
-    return subscription
+    etag = subscription_etag(subscription)
+    if etag_matches(request, etag):
+        return not_modified(etag, PRIVATE_CACHE)
+    body = dump_json(schemas.SubscriptionOut, subscription)
+    return json_response(request, body, etag, PRIVATE_CACHE)
 
 
 @router.post("/subscriptions/subscribe", response_model=schemas.CheckoutUrlResponse, status_code=status.HTTP_201_CREATED)
@@ -76,9 +87,9 @@ async def upgrade_subscription(data: schemas.SubscribeRequest, user: user_depend
 
 @router.post("/stripe/webhook")
 @limiter.exempt
-async def stripe_webhook(request: Request, sub_dep: subscription_dependency, plan_dep: plan_dependency,
-        payment_dep: payment_dependency, stripe_signature: str = Header(..., alias="Stripe-Signature")):
-    await SubscriptionService.stripe_webhook(request, stripe_signature, sub_dep, plan_dep, payment_dep)
+async def stripe_webhook(request: Request, event_dep: stripe_event_dependency,
+        stripe_signature: str = Header(..., alias="Stripe-Signature")):
+    await SubscriptionService.stripe_webhook(request, stripe_signature, event_dep)
     return True
 
 
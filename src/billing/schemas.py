@@ -1,8 +1,8 @@
 from uuid import UUID
 from datetime import datetime
-from typing import Optional
-from pydantic import BaseModel
-from src.billing.models import BillingPeriod, SubscriptionStatus, PaymentStatus, PaymentProvider, Plan
+from typing import Any, Optional
+from pydantic import BaseModel, model_validator
+from src.billing.models import BillingPeriod, SubscriptionStatus, PaymentStatus, PaymentProvider, Plan, PlanTier
 
 
 
@@ -39,6 +39,24 @@ class PlanOut(BaseModel):
         from_attributes = True
 
 
+class PlanSnapshot(BaseModel):
+    """Read-only copy of a plan row, held by the in-process plan catalog."""
+    id: UUID
+    name: str
+    code: str
+    price_cents: int
+    currency: str
+    billing_period: BillingPeriod
+    tier: PlanTier
+    is_active: bool
+    stripe_product_id: Optional[str] = None
+    stripe_price_id: Optional[str] = None
+
+    class Config:
+        from_attributes = True
+        frozen = True
+
+
 class SubscriptionOut(BaseModel):
     id: UUID
     status: SubscriptionStatus  
@@ -75,4 +93,49 @@ class PaymentResponse(BaseModel):
 
 
 class UserPaymentsResponse(BaseModel):
-    payments: list[PaymentResponse]
\ No newline at end of file
+    payments: list[PaymentResponse]
+
+# Slim views of Stripe webhook objects: only the fields StripeGateway reads,
+# everything else in the payload is ignored.
+
+class StripeCheckoutSession(BaseModel):
+    client_reference_id: Optional[str] = None
+    subscription: Optional[str] = None
+    customer: Optional[str] = None
+    metadata: dict[str, str] = {}
+
+
+class StripeInvoice(BaseModel):
+    id: Optional[str] = None
+    billing_reason: Optional[str] = None
+    amount_paid: Optional[int] = None
+    currency: Optional[str] = None
+    has_lines: bool = False
+    # taken from the first invoice line
+    subscription_id: Optional[str] = None
+    period_start: Optional[int] = None
+    period_end: Optional[int] = None
+
+    @model_validator(mode="before")
+    @classmethod
+    def _first_line(cls, data: Any) -> Any:
+        if not isinstance(data, dict) or "lines" not in data:
+            return data
+        lines = (data.get("lines") or {}).get("data") or []
+        view = {key: data.get(key) for key in ("id", "billing_reason", "amount_paid", "currency")}
+        if lines:
+            line = lines[0]
+            sub_details = (line.get("parent") or {}).get("subscription_item_details") or {}
+            period = line.get("period") or {}
+            view.update(
+                has_lines=True,
+                subscription_id=sub_details.get("subscription"),
+                period_start=period.get("start"),
+                period_end=period.get("end"),
+            )
+        return view
+
+
+class StripeSubscription(BaseModel):
+    id: Optional[str] = None
+    canceled_at: Optional[int] = None
@@ -1,28 +1,39 @@
-import stripe
 import logging
 from uuid import UUID
 from fastapi import HTTPException, status
-from fastapi.concurrency import run_in_threadpool
+from src.async_task import enqueue
 from src.config import settings
 from src.billing import schemas
 from src.billing.models import PaymentProvider
-from src.billing.repository import PlanRepository, SubscriptionRepoistory, PaymentRepository
-from src.billing.tasks import send_subscription_email_task, send_update_subscription_email_task, send_cancel_subscription_email_task, send_payment_failed_email_task
-from src.billing.utils import serialize_subscription
+from src.billing.repository import PlanRepository, SubscriptionRepoistory, PaymentRepository, StripeEventRepository
+from src.billing.tasks import process_stripe_event_task
 from src.billing.stripe_gateway import StripeGateway
+from src.billing.catalog import plan_catalog, PlanCatalog
+from src.billing.utils import plan_surrogate_keys
+from src.http_cache import row_etag
+from src.tasks import purge_surrogate_keys_task
+from src.billing.webhooks import construct_event, WebhookVerificationError
 from src.auth.models import User
 from src.auth.repository import UserRepository
 
 
 logger = logging.getLogger(__name__)
-stripe.api_key = settings.stripe_secret_key
 
 
 class PlanService:
     @staticmethod
-    async def retrive_plans(repo: PlanRepository):
-        plans = await repo.list_plans()
-        return plans
+    async def _plans_changed(repo: PlanRepository, plan_id: UUID | None = None) -> None:
+        """Rebuild the catalog and purge the CDN copies of the affected plan pages."""
+        await plan_catalog.rebuild(repo)
+        if not settings.cdn_purge_url:
+            return
+        # if the broker is down, CDN copies still expire on their own (s-maxage)
+        await enqueue(purge_surrogate_keys_task, plan_surrogate_keys(plan_id))
+
+
+    @staticmethod
+    async def retrive_plans(repo: PlanRepository) -> PlanCatalog:
+        return await plan_catalog.get(repo)
     
 
     @staticmethod
@@ -38,17 +49,29 @@ class PlanService:
                 "stripe_product_id": stripe_plan.stripe_product_id,
                 "stripe_price_id": stripe_plan.stripe_price_id
             })
+            await PlanService._plans_changed(repo)
             return updated_plan
         
+        await PlanService._plans_changed(repo)
         return result
 
 
     @staticmethod
     async def get_plan_by_id(plan_id: UUID, repo: PlanRepository):
-        plan = await repo.get_by_id(plan_id)
+        plan = await plan_catalog.get_by_id(plan_id, repo)
         if not plan: 
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No plan found for this id")
         return plan
+
+
+    @staticmethod
+    async def get_plan_body(plan_id: UUID, repo: PlanRepository) -> tuple[bytes, str]:
+        """Pre-serialized PlanOut body and its ETag."""
+        catalog = await plan_catalog.get(repo)
+        cached = catalog.plan_bodies.get(plan_id)
+        if not cached:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No plan found for this id")
+        return cached
     
 
     @staticmethod
@@ -59,6 +82,7 @@ class PlanService:
         
         update_data = await StripeGateway.update_plan_in_stripe(plan, data)
         result = await repo.update(plan, update_data)    
+        await PlanService._plans_changed(repo, plan_id)
         return result
     
 
@@ -72,6 +96,7 @@ class PlanService:
        
         await StripeGateway.soft_delete_plan_in_stripe(plan)
         await repo.soft_delete(plan)
+        await PlanService._plans_changed(repo, plan_id)
     
 
 
@@ -91,7 +116,7 @@ class SubscriptionService:
         exisitng_sub = await sub_repo.get_subscription_with_access(user.id)
         if exisitng_sub:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User already has an active subscription.")
-        plan = await plan_repo.get_by_code(plan_code)
+        plan = await plan_catalog.get_by_code(plan_code, plan_repo)
         if not plan:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No active plan found for this code.")
         
@@ -134,7 +159,7 @@ class SubscriptionService:
         if not current_sub:
             raise HTTPException(status_code=404, detail="No active subscription to upgrade.")
         
-        new_plan = await plan_repo.get_by_code(new_plan_code)
+        new_plan = await plan_catalog.get_by_code(new_plan_code, plan_repo)
         if not new_plan:
             raise HTTPException(status_code=404, detail="Plan not found.")
         
@@ -148,54 +173,81 @@ class SubscriptionService:
 
 
     @staticmethod
-    async def stripe_webhook(request, stripe_signature, sub_repo: SubscriptionRepoistory,
-        plan_repo: PlanRepository, payment_repo: PaymentRepository):
+    async def stripe_webhook(request, stripe_signature, event_repo: StripeEventRepository):
+        """
+        Verify and store the event, then hand it to the billing queue.
+        Processing happens in ``process_stripe_event_task`` so Stripe gets
+        its 200 without waiting on Stripe API calls or handler commits.
+        """
         payload = await request.body()
         try:
-            event = await run_in_threadpool(
-                stripe.Webhook.construct_event,
-                payload.decode("utf-8"),
-                stripe_signature,
-                settings.stripe_webhook_secret
-            )
-        except Exception as e:
+            event = construct_event(payload, stripe_signature, settings.stripe_webhook_secret)
+        except WebhookVerificationError as e:
             return {"error": str(e)}
-        
+
+        if await event_repo.is_processed_cached(event["id"]):
+            return
+
+        created = await event_repo.save(event["id"], event["type"], event)
+        if not created:
+            return
+
+        # if the broker is down the event stays stored and the requeue sweep picks it up
+        await enqueue(process_stripe_event_task, event["id"])
+
+
+    @staticmethod
+    async def process_stripe_event(event_id: str, event_repo: StripeEventRepository, sub_repo: SubscriptionRepoistory,
+        plan_repo: PlanRepository, payment_repo: PaymentRepository):
+        if await event_repo.is_processed_cached(event_id):
+            return
+        event = await event_repo.get(event_id)
+        if event is None or event.processed_at is not None:
+            return
+        if not await event_repo.claim(event_id):
+            # another worker is handling this delivery right now
+            return
+
+        try:
+            # the handler's changes (and the emails it stages) commit together with processed_at
+            async with event_repo.processing(event_id) as locked:
+                if locked is not None:
+                    await SubscriptionService.handle_stripe_event(locked.payload, sub_repo, plan_repo, payment_repo)
+        except Exception as exc:
+            await event_repo.mark_failed(event_id, repr(exc))
+            raise
+        finally:
+            await event_repo.release(event_id)
+
+
+    @staticmethod
+    async def handle_stripe_event(event: dict, sub_repo: SubscriptionRepoistory,
+        plan_repo: PlanRepository, payment_repo: PaymentRepository):
         event_type = event["type"]
         data_object = event["data"]["object"]
 
         if event_type == "checkout.session.completed":
-            session = data_object
-            sub = await StripeGateway.user_subscribe(session, sub_repo, plan_repo)
+            session = schemas.StripeCheckoutSession.model_validate(data_object)
+            await StripeGateway.user_subscribe(session, sub_repo, plan_repo)
             
             
         
+        # Emails for these events are staged in the outbox by the repository,
+        # in the same transaction as the subscription change
         if event_type == "invoice.payment_succeeded":
-            invoice = data_object
-            billing_reason = invoice.get("billing_reason")
+            invoice = schemas.StripeInvoice.model_validate(data_object)
             sub = await StripeGateway.handle_invoice_payment_succeeded(invoice, sub_repo)
             await StripeGateway.record_invoice_payment(invoice, sub, payment_repo)
-            if billing_reason == "subscription_cycle":
-                send_update_subscription_email_task.delay(serialize_subscription(sub)) #type: ignore
-            elif billing_reason == "subscription_create":
-                send_subscription_email_task.delay(serialize_subscription(sub)) #type: ignore
 
 
         if event_type == "customer.subscription.deleted":
-            stripe_subscription = data_object
-            sub = await StripeGateway.handle_subscription_deleted(stripe_subscription, sub_repo)
-            try:
-                send_cancel_subscription_email_task.delay(serialize_subscription(sub))
-            except Exception as exc:
-                logger.exception("Failed to enqueue cancel subscription email", exc_info=exc)
+            stripe_subscription = schemas.StripeSubscription.model_validate(data_object)
+            await StripeGateway.handle_subscription_deleted(stripe_subscription, sub_repo)
 
         
         if event_type == "invoice.payment_failed":
-            invoice = data_object
-            
-            sub = await StripeGateway.handle_invoice_payment_failed(invoice, sub_repo)
-            if sub:
-                send_payment_failed_email_task.delay(serialize_subscription(sub))
+            invoice = schemas.StripeInvoice.model_validate(data_object)
+            await StripeGateway.handle_invoice_payment_failed(invoice, sub_repo)
 
 
 
@@ -203,4 +255,10 @@ class PaymentService:
     @staticmethod
     async def get_my_payments(user: User, payment_repo: PaymentRepository):
         payments = await payment_repo.get_my_payments(user.id)
-        return payments
\ No newline at end of file
+        return payments
+
+
+    @staticmethod
+    async def get_my_payments_etag(user: User, payment_repo: PaymentRepository) -> str:
+        count, last_updated = await payment_repo.get_payments_version(user.id)
+        return row_etag(user.id, count, last_updated.isoformat() if last_updated else None)
\ No newline at end of file
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Any
+import stripe
+from opentelemetry import trace
+from opentelemetry.trace import SpanKind
+from src.config import settings
+from src.metrics import STRIPE_REQUEST_DURATION
+
+
+logger = logging.getLogger(__name__)
+tracer = trace.get_tracer(__name__)
+
+# Backoff for 429s, which stripe-python only retries when Stripe sets stripe-should-retry
+RATE_LIMIT_INITIAL_DELAY = 0.5
+RATE_LIMIT_MAX_DELAY = 8.0
+
+
+class TokenBucket:
+    """Allows ``rate`` calls per second on average, with bursts of up to ``capacity``."""
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+    async def acquire(self) -> None:
+        while True:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+    def pause(self, seconds: float) -> None:
+        """Stripe said we are over the limit, hand out no tokens for ``seconds``."""
+        self._refill()
+        self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+
+class StripeAPI:
+    """
+    Async access to the Stripe API over one keep-alive HTTP pool.
+
+    Calls are bounded by a semaphore and a token bucket, connection errors,
+    409s and 5xx are retried by stripe-python with jittered backoff, and
+    429s are retried here after draining the bucket. The HTTP pool belongs
+    to the event loop that opened it, so the client is rebuilt when used
+    from a new loop.
+    """
+    def __init__(self, api_key: str, max_concurrency: int, rate: float, max_retries: int, timeout: float,
+                 base_url: str | None = None) -> None:
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self._client: stripe.StripeClient | None = None
+        self._http: stripe.HTTPXClient | None = None
+        self._slots: asyncio.Semaphore | None = None
+        self._bucket: TokenBucket | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+
+    async def _bind_loop(self) -> stripe.StripeClient:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop or self._client is None:
+            await self._close_stale_pool()
+            self._http = stripe.HTTPXClient(timeout=self.timeout)
+            self._client = stripe.StripeClient(
+                self.api_key,
+                max_network_retries=self.max_retries,
+                http_client=self._http,
+                base_addresses={"api": self.base_url} if self.base_url else None,
+            )
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+            self._bucket = TokenBucket(self.rate, capacity=self.max_concurrency)
+            self._loop = loop
+        return self._client
+
+
+    async def _close_stale_pool(self) -> None:
+        http, self._http = self._http, None
+        if http is None:
+            return
+        try:
+            await http.close_async()
+        except Exception:
+            # its connections belong to a loop that is gone, nothing left to flush
+            logger.debug("Could not close the Stripe HTTP pool of a previous event loop", exc_info=True)
+
+
+    def _method(self, client: stripe.StripeClient, path: str):
+        # "checkout.sessions.create" -> client.v1.checkout.sessions.create_async
+        *services, name = path.split(".")
+        target: Any = client.v1
+        for service in services:
+            target = getattr(target, service)
+        return getattr(target, f"{name}_async")
+
+
+    async def call(self, path: str, *args: Any, params: dict | None = None,
+                   idempotency_key: str | None = None) -> Any:
+        client = await self._bind_loop()
+        method = self._method(client, path)
+        options: dict[str, Any] = {}
+        if idempotency_key:
+            options["idempotency_key"] = idempotency_key
+
+        # one span per logical call; time queued for a slot or token shows up as a gap before the HTTP span
+        with tracer.start_as_current_span(f"stripe {path}", kind=SpanKind.CLIENT,
+                                          attributes={"stripe.operation": path}) as span:
+            return await self._call(method, path, args, params, options, span)
+
+
+    async def _call(self, method, path: str, args: tuple, params: dict | None, options: dict, span) -> Any:
+        attempt = 0
+        while True:
+            async with self._slots:  # type: ignore[union-attr]
+                # after a 429 the bucket is in debt, so this also holds back other callers
+                await self._bucket.acquire()  # type: ignore[union-attr]
+                start = time.perf_counter()
+                outcome = "error"
+                try:
+                    result = await method(*args, params=params, options=options)
+                    outcome = "ok"
+                    return result
+                except stripe.RateLimitError:
+                    outcome = "rate_limited"
+                    if attempt >= self.max_retries:
+                        raise
+                    delay = min(RATE_LIMIT_INITIAL_DELAY * 2 ** attempt, RATE_LIMIT_MAX_DELAY)
+                    delay *= random.uniform(0.5, 1)
+                    logger.warning("Stripe rate limit hit on %s, retrying in %.2fs", path, delay)
+                    self._bucket.pause(delay)  # type: ignore[union-attr]
+                    attempt += 1
+                    span.set_attribute("stripe.rate_limit_retries", attempt)
+                finally:
+                    STRIPE_REQUEST_DURATION.labels(path, outcome).observe(time.perf_counter() - start)
+
+
+    async def close(self) -> None:
+        http, self._http = self._http, None
+        self._client = None
+        self._loop = None
+        if http is not None:
+            await http.close_async()
+
+
+def idempotency_key(*parts: Any) -> str:
+    return ":".join(str(part) for part in parts)
+
+
+stripe_api = StripeAPI(
+    settings.stripe_secret_key,
+    max_concurrency=settings.stripe_max_concurrency,
+    rate=settings.stripe_rate_limit,
+    max_retries=settings.stripe_max_network_retries,
+    timeout=settings.stripe_timeout,
+    base_url=settings.stripe_api_base,
+)
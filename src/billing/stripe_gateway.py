@@ -1,15 +1,18 @@
+import time
+import asyncio
 import stripe
 from datetime import datetime, timezone
 from fastapi import HTTPException, status
-from fastapi.concurrency import run_in_threadpool
 from src.auth.models import User
 from src.auth.repository import UserRepository
 from src.billing.models import Plan, Subscription, PaymentProvider, PaymentStatus, SubscriptionStatus
 from src.billing.repository import PlanRepository, SubscriptionRepoistory, PaymentRepository
-from src.billing.schemas import PlanUpdate
-from src.config import settings
+from src.billing.schemas import PlanUpdate, StripeCheckoutSession, StripeInvoice, StripeSubscription
+from src.billing.constants import INVOICE_EMAIL_TOPICS, STRIPE_SUBSCRIPTION_CACHE_TTL, STRIPE_SUBSCRIPTION_CACHE_SIZE
+from src.billing.stripe_client import stripe_api, idempotency_key
 
-stripe.api_key = settings.stripe_secret_key
+# stripe subscription id -> (expires_at, subscription), see StripeGateway.retrieve_subscription
+_subscription_cache: dict[str, tuple[float, stripe.Subscription]] = {}
 
 
 class StripeGateway:
@@ -17,15 +20,23 @@ class StripeGateway:
     async def save_plan_to_stripe(plan: Plan):
         try:
             if not plan.stripe_product_id:
-                product = await run_in_threadpool(stripe.Product.create, name=plan.name)
+                product = await stripe_api.call(
+                    "products.create",
+                    params={"name": plan.name},
+                    idempotency_key=idempotency_key("plan", plan.id, "product"),
+                )
                 plan.stripe_product_id = product.id
 
             if not plan.stripe_price_id:
-                price = await run_in_threadpool(stripe.Price.create,
-                    unit_amount=plan.price_cents,   # in cents
-                    currency=plan.currency,
-                    recurring={"interval": "month"},
-                    product=plan.stripe_product_id,
+                price = await stripe_api.call(
+                    "prices.create",
+                    params={
+                        "unit_amount": plan.price_cents,   # in cents
+                        "currency": plan.currency,
+                        "recurring": {"interval": "month"},
+                        "product": plan.stripe_product_id,
+                    },
+                    idempotency_key=idempotency_key("plan", plan.id, "price", plan.price_cents, plan.currency, "month"),
                 )
                 plan.stripe_price_id = price.id
 
@@ -45,38 +56,54 @@ class StripeGateway:
         if "name" in update_data:
             product_update_data["name"] = update_data["name"]
 
+        calls = []
         if product_update_data:
-            await run_in_threadpool(
-                stripe.Product.update, plan.stripe_product_id, **product_update_data) # type: ignore
+            calls.append(stripe_api.call("products.update", plan.stripe_product_id, params=product_update_data))
 
 
          # 2️⃣ If price-related fields changed → create new price
+        new_price = None
         if any(key in update_data for key in ["price_cents", "billing_period", "currency"]):
-            new_price = await run_in_threadpool(
-                stripe.Price.create,
-                product=plan.stripe_product_id,
-                unit_amount=update_data.get("price_cents", plan.price_cents),
-                currency=update_data.get("currency", plan.currency),
-                recurring={
+            price_params = {
+                "product": plan.stripe_product_id,
+                "unit_amount": update_data.get("price_cents", plan.price_cents),
+                "currency": update_data.get("currency", plan.currency),
+                "recurring": {
                     "interval": update_data.get("billing_period", plan.billing_period)
                 },
+            }
+            new_price = stripe_api.call(
+                "prices.create",
+                params=price_params,
+                idempotency_key=idempotency_key("plan", plan.id, "price", price_params["unit_amount"],
+                                                price_params["currency"], price_params["recurring"]["interval"]),
             )
-            update_data["stripe_price_id"] = new_price.id
+            calls.append(new_price)
+
+        # the product rename and the new price do not depend on each other
+        results = await asyncio.gather(*calls)
+        if new_price is not None:
+            update_data["stripe_price_id"] = results[-1].id
 
         return update_data
 
         
     @staticmethod
     async def soft_delete_plan_in_stripe(plan: Plan):
-        await run_in_threadpool(stripe.Product.update, plan.stripe_product_id, active=False)  # type: ignore
-        await run_in_threadpool(stripe.Price.modify, plan.stripe_price_id, active=False)
+        await asyncio.gather(
+            stripe_api.call("products.update", plan.stripe_product_id, params={"active": False}),
+            stripe_api.call("prices.update", plan.stripe_price_id, params={"active": False}),
+        )
 
 
     @staticmethod
     async def ensure_customer(user: User, user_repo: UserRepository) -> User:
         if not user.stripe_customer_id:
-            customer = await run_in_threadpool(stripe.Customer.create,email=user.email,
-                metadata={"user_id": str(user.id)})
+            customer = await stripe_api.call(
+                "customers.create",
+                params={"email": user.email, "metadata": {"user_id": str(user.id)}},
+                idempotency_key=idempotency_key("user", user.id, "customer"),
+            )
             user = await user_repo.update(user, stripe_customer_id = customer['id'])
         
         return user
@@ -96,43 +123,66 @@ class StripeGateway:
         if old_stripe_sub_id:
             metadata["upgrade_from_subscription_id"] = old_stripe_sub_id
 
-        session = await run_in_threadpool(
-            stripe.checkout.Session.create,
-            mode="subscription",
-            customer=user.stripe_customer_id,        
-            line_items=[{
-                "price": plan.stripe_price_id,
-                "quantity": 1,
-            }],
-            success_url="https://yourapp.com/success?session_id={CHECKOUT_SESSION_ID}",
-            cancel_url="https://yourapp.com/cancel",
-            client_reference_id=str(user.id),  
-            subscription_data={"metadata": metadata},
+        session = await stripe_api.call(
+            "checkout.sessions.create",
+            params={
+                "mode": "subscription",
+                "customer": user.stripe_customer_id,
+                "line_items": [{
+                    "price": plan.stripe_price_id,
+                    "quantity": 1,
+                }],
+                "success_url": "https://yourapp.com/success?session_id={CHECKOUT_SESSION_ID}",
+                "cancel_url": "https://yourapp.com/cancel",
+                "client_reference_id": str(user.id),
+                "subscription_data": {"metadata": metadata},
+                # copied onto the session so checkout.session.completed carries it
+                "metadata": metadata,
+            },
+            # a double-submitted checkout within the same minute gets the same session back
+            idempotency_key=idempotency_key("checkout", user.id, plan.id, old_stripe_sub_id, int(time.time() // 60)),
         )
 
         return session.url
 
 
     @staticmethod
-    async def user_subscribe(session, sub_repo: SubscriptionRepoistory, plan_repo: PlanRepository) -> Subscription:
-        user_id = session.get("client_reference_id")
-        new_stripe_sub_id = session.get("subscription")
-        customer_id = session.get("customer")
-        stripe_subscription = await run_in_threadpool(
-            stripe.Subscription.retrieve,
-            new_stripe_sub_id,
-        )
-        sub_metadata = stripe_subscription.get("metadata", {}) or {}
+    async def retrieve_subscription(stripe_subscription_id: str) -> stripe.Subscription:
+        """
+        Subscription retrieve behind a short-lived per-process cache,
+        for events whose payload lacks the fields we need.
+        """
+        now = time.monotonic()
+        cached = _subscription_cache.get(stripe_subscription_id)
+        if cached and cached[0] > now:
+            return cached[1]
+
+        stripe_subscription = await stripe_api.call("subscriptions.retrieve", stripe_subscription_id)
+        if len(_subscription_cache) >= STRIPE_SUBSCRIPTION_CACHE_SIZE:
+            _subscription_cache.pop(next(iter(_subscription_cache)))
+        _subscription_cache[stripe_subscription_id] = (now + STRIPE_SUBSCRIPTION_CACHE_TTL, stripe_subscription)
+        return stripe_subscription
+
+
+    @staticmethod
+    async def user_subscribe(session: StripeCheckoutSession, sub_repo: SubscriptionRepoistory,
+        plan_repo: PlanRepository) -> Subscription:
+        user_id = session.client_reference_id
+        new_stripe_sub_id = session.subscription
+        customer_id = session.customer
+        sub_metadata = session.metadata
+        if not sub_metadata.get("plan_id"):
+            # sessions created before the metadata was copied onto them
+            stripe_subscription = await StripeGateway.retrieve_subscription(new_stripe_sub_id)
+            sub_metadata = stripe_subscription.get("metadata", {}) or {}
         old_stripe_sub_id = sub_metadata.get("upgrade_from_subscription_id")
         plan_id = sub_metadata.get("plan_id")
         plan = await plan_repo.get_by_id(plan_id) #type: ignore
         if not plan:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="error happened")
         if old_stripe_sub_id:
-            await run_in_threadpool(
-                stripe.Subscription.delete,
-                old_stripe_sub_id,
-            )
+            await stripe_api.call("subscriptions.cancel", old_stripe_sub_id)
+            _subscription_cache.pop(old_stripe_sub_id, None)
             await sub_repo.cancel_subscription(
                 provider=PaymentProvider.STRIPE,
                 provider_subscription_id=old_stripe_sub_id,
@@ -144,10 +194,10 @@ class StripeGateway:
 
 
     @staticmethod
-    async def record_invoice_payment(invoice, subscription: Subscription, payment_repo: PaymentRepository):
-        amount_cents = invoice.get("amount_paid")
-        currency = (invoice.get("currency") or "usd").upper()
-        provider_invoice_id = invoice.get("id")
+    async def record_invoice_payment(invoice: StripeInvoice, subscription: Subscription, payment_repo: PaymentRepository):
+        amount_cents = invoice.amount_paid
+        currency = (invoice.currency or "usd").upper()
+        provider_invoice_id = invoice.id
 
         await payment_repo.create_payment(
             user_id=subscription.user_id,
@@ -164,11 +214,11 @@ class StripeGateway:
     async def cancel_subscription_at_period_end(sub: Subscription) -> tuple[datetime, datetime | None]:
         stripe_subscription = None
         if sub.provider == PaymentProvider.STRIPE and sub.provider_subscription_id:
-            stripe_subscription = await run_in_threadpool(
-                    stripe.Subscription.modify,
-                    sub.provider_subscription_id,
-                    cancel_at_period_end=True,
-                )
+            stripe_subscription = await stripe_api.call(
+                "subscriptions.update",
+                sub.provider_subscription_id,
+                params={"cancel_at_period_end": True},
+            )
         
         now = datetime.now(timezone.utc)
         canceled_at = now
@@ -189,65 +239,55 @@ class StripeGateway:
 
 
     @staticmethod
-    async def handle_invoice_payment_succeeded(invoice, sub_repo: SubscriptionRepoistory):
+    async def handle_invoice_payment_succeeded(invoice: StripeInvoice, sub_repo: SubscriptionRepoistory):
 
-        lines = invoice.get("lines", {}).get("data", [])
-        if not lines:
+        if not invoice.has_lines:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="no lines in invoice")
-        first_line = lines[0]
-        parent = first_line.get("parent", {})
-        sub_details = parent.get("subscription_item_details", {}) or {}
-        stripe_subscription_id = sub_details.get("subscription")
+        stripe_subscription_id = invoice.subscription_id
 
         if not stripe_subscription_id:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No subscrition found.")
         
-        stripe_subscription = await run_in_threadpool(
-            stripe.Subscription.retrieve,
-            stripe_subscription_id,
-        )
-        subscription_details = stripe_subscription.get("items", {}).get("data", [])
-        current_period_start = datetime.fromtimestamp(
-             subscription_details[0].get("current_period_start"),
-             tz=timezone.utc,
-        )    
-        current_period_end = datetime.fromtimestamp(
-            subscription_details[0].get("current_period_end"),
-            tz=timezone.utc,
-        )
+        period_start, period_end = invoice.period_start, invoice.period_end
+        if not (period_start and period_end):
+            stripe_subscription = await StripeGateway.retrieve_subscription(stripe_subscription_id)
+            subscription_details = stripe_subscription.get("items", {}).get("data", [])
+            period_start = subscription_details[0].get("current_period_start")
+            period_end = subscription_details[0].get("current_period_end")
+
+        current_period_start = datetime.fromtimestamp(period_start, tz=timezone.utc)
+        current_period_end = datetime.fromtimestamp(period_end, tz=timezone.utc)
         sub = await sub_repo.update_subscription_period(
             provider=PaymentProvider.STRIPE,
             provider_subscription_id=stripe_subscription_id,
             current_period_start=current_period_start,
             current_period_end=current_period_end,
+            notify=INVOICE_EMAIL_TOPICS.get(invoice.billing_reason), # type: ignore
         )
         return sub
     
 
     @staticmethod
-    async def handle_invoice_payment_failed(invoice, sub_repo: SubscriptionRepoistory):
-        lines = invoice.get("lines", {}).get("data", [])
-        if not lines:
+    async def handle_invoice_payment_failed(invoice: StripeInvoice, sub_repo: SubscriptionRepoistory):
+        if not invoice.has_lines:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="no lines in invoice")
-        first_line = lines[0]
-        parent = first_line.get("parent", {})
-        sub_details = parent.get("subscription_item_details", {}) or {}
-        stripe_subscription_id = sub_details.get("subscription")
+        stripe_subscription_id = invoice.subscription_id
         sub = await sub_repo.update_sub_status(
             provider=PaymentProvider.STRIPE,
             provider_subscription_id=stripe_subscription_id, #type:ignore
-            sub_status=SubscriptionStatus.PAST_DUE
+            sub_status=SubscriptionStatus.PAST_DUE,
+            notify="payment_failed",
         )
         return sub
 
 
     @staticmethod
-    async def handle_subscription_deleted(stripe_subscription, sub_repo: SubscriptionRepoistory):
-        stripe_subscription_id = stripe_subscription.get("id")
+    async def handle_subscription_deleted(stripe_subscription: StripeSubscription, sub_repo: SubscriptionRepoistory):
+        stripe_subscription_id = stripe_subscription.id
         if not stripe_subscription_id:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="customer.subscription.deleted without id")
         
-        canceled_at_ts = stripe_subscription.get("canceled_at")
+        canceled_at_ts = stripe_subscription.canceled_at
         if canceled_at_ts:
             canceled_at = datetime.fromtimestamp(canceled_at_ts, tz=timezone.utc)
         else:
@@ -261,6 +301,7 @@ class StripeGateway:
             provider_subscription_id=stripe_subscription_id,
             canceled_at=canceled_at,
             current_period_end=current_period_end,
+            notify="cancel_subscription",
         )
 
 
@@ -1,52 +1,215 @@
-import asyncio
+import logging
+from aiosmtplib import SMTPException
+from celery.utils.time import get_exponential_backoff_interval
 from src.celery_app import celery_app, beat_app
-from datetime import datetime, timezone
-from asgiref.sync import async_to_sync
-from sqlalchemy import update
+from src.async_task import AsyncTask
+from datetime import datetime, timedelta, timezone
+from uuid import UUID
+from fastapi import HTTPException
+from sqlalchemy import select, update, tuple_
+from sqlalchemy.orm import Session, selectinload
 from src import load_models
 from src.billing.emails import Emails
-from src.billing.models import Subscription, SubscriptionStatus
+from src.billing.models import Subscription, SubscriptionStatus, StripeEvent
+from src.billing.constants import (
+    EXPIRABLE_STATUSES, EXPIRE_BATCH_SIZE, EXPIRE_GRACE_PERIOD, STRIPE_EVENT_MAX_ATTEMPTS, STRIPE_EVENT_REQUEUE_AFTER,
+)
+from src.billing.repository import PlanRepository, SubscriptionRepoistory, PaymentRepository, StripeEventRepository, ApiUsageRepository
+from src.billing.utils import subscription_outbox_message
 
-from src.database import get_sync_session
+from src.cache import get_redis
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.database import SyncSessionLocal, async_session, engine
+from src.mail import BatchInterrupted
+from src.rate_limiter import quota_callers_key, quota_key
+from src.tasks import EMAIL_RETRY_OPTIONS
 
 
-email_service = Emails()
-
-@celery_app.task(name="send_subscription_email_task")
-def send_subscription_email_task(subscription: dict):
-    async_to_sync(email_service.send_subscription_email)(subscription)
-
+logger = logging.getLogger(__name__)
 
-@celery_app.task(name="send_update_subscription_email_task")
-def send_update_subscription_email_task(subscription: dict):
-    async_to_sync(email_service.send_subscription_update_email)(subscription)
 
+email_service = Emails()
 
-@celery_app.task(name="send_cancel_subscription_email_task")
-def send_cancel_subscription_email_task(subscription: dict):
-    async_to_sync(email_service.send_cancel_subscription_email)(subscription)
-
+@celery_app.task(name="send_subscription_email_task", base=AsyncTask)
+async def send_subscription_email_task(subscription: dict):
+    await email_service.send_subscription_email(subscription)
+
+
+@celery_app.task(name="send_update_subscription_email_task", base=AsyncTask)
+async def send_update_subscription_email_task(subscription: dict):
+    await email_service.send_subscription_update_email(subscription)
+
+
+@celery_app.task(name="send_cancel_subscription_email_task", base=AsyncTask)
+async def send_cancel_subscription_email_task(subscription: dict):
+    await email_service.send_cancel_subscription_email(subscription)
+
+
+@celery_app.task(name="send_payment_failed_email_task", base=AsyncTask)
+async def send_payment_failed_email_task(subscription: dict):
+    await email_service.send_payment_failed_email(subscription)
+
+
+@celery_app.task(name="send_subscription_emails_task", base=AsyncTask, bind=True, **EMAIL_RETRY_OPTIONS)
+async def send_subscription_emails_task(self, email_type: str, subscriptions: list[dict]):
+    """
+    Send one kind of subscription email to many recipients from a single task
+    message. The outbox row is gone once this is queued, so failures are
+    retried with the per-message email backoff, for the undelivered
+    recipients only.
+    """
+    try:
+        undelivered = await email_service.send_bulk(email_type, subscriptions)
+        error = SMTPException(f"{len(undelivered)} {email_type} emails rejected")
+    except BatchInterrupted as exc:
+        undelivered, error = [subscriptions[position] for position in exc.unsent], exc
+    if undelivered:
+        countdown = get_exponential_backoff_interval(
+            factor=EMAIL_RETRY_OPTIONS["retry_backoff"], retries=self.request.retries,
+            maximum=EMAIL_RETRY_OPTIONS["retry_backoff_max"], full_jitter=EMAIL_RETRY_OPTIONS["retry_jitter"],
+        )
+        raise self.retry(args=(email_type, undelivered), exc=error, countdown=countdown)
+
+
+# Named by module path so the src.billing.tasks.* route puts it on the billing queue.
+# HTTPException from a handler means the event itself is unusable, retrying won't help.
+@celery_app.task(base=AsyncTask, autoretry_for=(Exception,), dont_autoretry_for=(HTTPException,),
+                 retry_backoff=2, retry_backoff_max=600, retry_jitter=True, max_retries=STRIPE_EVENT_MAX_ATTEMPTS)
+async def process_stripe_event_task(event_id: str):
+    # imported here: the service module enqueues this task
+    from src.billing.service import SubscriptionService
+
+    # bound to one connection so the handler's commits can share a transaction with processed_at
+    async with engine.connect() as connection:
+        async with AsyncSession(bind=connection, join_transaction_mode="create_savepoint",
+                                expire_on_commit=False) as db:
+            await SubscriptionService.process_stripe_event(
+                event_id, StripeEventRepository(db), SubscriptionRepoistory(db), PlanRepository(db),
+                PaymentRepository(db),
+            )
+
+
+def expire_subscriptions_batch(db: Session, now: datetime, after: tuple | None, limit: int) -> tuple[list[Subscription], tuple | None]:
+    """
+    Lock and cancel the next batch of subscriptions whose period ended more
+    than ``EXPIRE_GRACE_PERIOD`` before ``now``, ordered by
+    (current_period_end, id). Rows linked to a provider subscription are left
+    to its webhooks, and rows locked by a concurrent run are skipped.
+    Returns the expired rows and the keyset position to continue from.
+    """
+    stmt = (
+        select(Subscription)
+        .where(
+            Subscription.status.in_(EXPIRABLE_STATUSES),
+            Subscription.current_period_end <= now - EXPIRE_GRACE_PERIOD,
+            Subscription.provider_subscription_id.is_(None),
+        )
+        .order_by(Subscription.current_period_end, Subscription.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True, of=Subscription)
+        .options(
+            selectinload(Subscription.user),
+            selectinload(Subscription.plan),
+        )
+    )
+    if after is not None:
+        stmt = stmt.where(tuple_(Subscription.current_period_end, Subscription.id) > after)
+
+    subscriptions = list(db.execute(stmt).scalars().all())
+    if not subscriptions:
+        return [], None
+
+    db.execute(
+        update(Subscription)
+        .where(Subscription.id.in_([sub.id for sub in subscriptions]))
+        .values(status=SubscriptionStatus.CANCELED, canceled_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    last = subscriptions[-1]
+    return subscriptions, (last.current_period_end, last.id)
 
-@celery_app.task(name="send_payment_failed_email_task")
-def send_payment_failed_email_task(subscription: dict):
-    async_to_sync(email_service.send_payment_failed_email)(subscription)
 
 @beat_app.task(name="expire_subscriptions_task")
-def expire_subscriptions_task():
-    # Will be implemented for credits in subs later
-    pass
-    # db = get_sync_session()
-
-    # now = datetime.now(timezone.utc)
-
-
-    # db.execute(
-    #     update(Subscription)
-    #     .where(Subscription.current_period_end <= now)
-    #     .where(Subscription.status != SubscriptionStatus.CANCELED)
-    #     .values(status=SubscriptionStatus.CANCELED)
-    # )
-
-    # db.commit()
-    # db.close()
-
+def expire_subscriptions_task(batch_size: int = EXPIRE_BATCH_SIZE) -> int:
+    """
+    Cancel subscriptions no provider manages once their period has ended
+    (plus ``EXPIRE_GRACE_PERIOD``), one committed batch at a time. Safe to run on several replicas at once (SKIP LOCKED), and a
+    crashed run only loses its in-flight batch, which the next run picks up.
+    Cancellation emails are staged in the outbox with each batch.
+    """
+    now = datetime.now(timezone.utc)
+    after = None
+    expired = 0
+
+    with SyncSessionLocal() as db:
+        while True:
+            subscriptions, after = expire_subscriptions_batch(db, now, after, batch_size)
+            if not subscriptions:
+                break
+
+            db.add_all([subscription_outbox_message("cancel_subscription", sub) for sub in subscriptions])
+            db.commit()
+            expired += len(subscriptions)
+
+            if len(subscriptions) < batch_size:
+                break
+
+    logger.info("Expired %s subscriptions", expired)
+    return expired
+
+
+@beat_app.task(name="requeue_stripe_events_task")
+def requeue_stripe_events_task(limit: int = 500) -> int:
+    """Re-enqueue stored Stripe events that were never processed (e.g. the broker was down on receipt)."""
+    cutoff = datetime.now(timezone.utc) - STRIPE_EVENT_REQUEUE_AFTER
+    with SyncSessionLocal() as db:
+        event_ids = db.execute(
+            select(StripeEvent.id)
+            .where(
+                StripeEvent.processed_at.is_(None),
+                StripeEvent.received_at <= cutoff,
+                StripeEvent.attempts < STRIPE_EVENT_MAX_ATTEMPTS,
+            )
+            .order_by(StripeEvent.received_at)
+            .limit(limit)
+        ).scalars().all()
+
+    for event_id in event_ids:
+        process_stripe_event_task.delay(event_id)
+
+    if event_ids:
+        logger.info("Re-enqueued %s Stripe events", len(event_ids))
+    return len(event_ids)
+
+
+@beat_app.task(name="persist_api_usage_task", base=AsyncTask)
+async def persist_api_usage_task() -> int:
+    """
+    Copy the daily quota counters from Redis into ``api_usage``, for today and
+    yesterday (whose last requests landed after the previous run). Redis stays
+    the source of truth for enforcement; without it nothing is persisted.
+    """
+    redis = get_redis()
+    if redis is None:
+        return 0
+
+    now = datetime.now(timezone.utc)
+    saved = 0
+    async with async_session() as db:
+        repo = ApiUsageRepository(db)
+        for day in (now - timedelta(days=1), now):
+            key_day = day.strftime("%Y%m%d")
+            callers = sorted(caller.decode() for caller in await redis.smembers(quota_callers_key(key_day)))
+            if not callers:
+                continue
+            counts = await redis.mget([quota_key(key_day, caller) for caller in callers])
+            usage = {
+                UUID(caller.removeprefix("user:")): int(count)
+                for caller, count in zip(callers, counts)
+                if count is not None and caller.startswith("user:")
+            }
+            await repo.save_counts(day.date(), usage)
+            saved += len(usage)
+
+    logger.info("Persisted API usage for %s users", saved)
+    return saved
@@ -1,5 +1,7 @@
 from datetime import datetime, timezone
-from src.billing.models import Subscription
+from uuid import UUID
+from src.billing.models import Subscription, OutboxMessage
+from src.http_cache import row_etag
 
 
 
@@ -9,7 +11,7 @@ def serialize_subscription(subscription: Subscription) -> dict:
     ready to be sent to Celery tasks.
     """
     return {
-        "id": subscription.id,
+        "id": str(subscription.id),
         "user": {
             "email": subscription.user.email,
             "username": subscription.user.username
@@ -25,6 +27,28 @@ def serialize_subscription(subscription: Subscription) -> dict:
     }
 
 
+def subscription_outbox_message(topic: str, subscription: Subscription) -> OutboxMessage:
+    """
+    Outbox row for a subscription email of kind ``topic``. Add it to the
+    session before the commit that persists the subscription change.
+    """
+    return OutboxMessage(topic=topic, payload=serialize_subscription(subscription))
+
+
+def plan_surrogate_keys(plan_id: UUID | None = None) -> list[str]:
+    """CDN tags for the plan list page and, optionally, one plan's page."""
+    keys = ["plans"]
+    if plan_id is not None:
+        keys.append(f"plan-{plan_id}")
+    return keys
+
+
+def subscription_etag(subscription: Subscription) -> str:
+    # the body embeds the plan, so a plan edit must change it too
+    return row_etag(subscription.id, subscription.updated_at.isoformat(),
+                    subscription.plan.id, subscription.plan.updated_at.isoformat())
+
+
 def subscription_has_access(subscription: Subscription) -> bool:
     now = datetime.now(timezone.utc)
 
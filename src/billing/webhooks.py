@@ -0,0 +1,66 @@
+"""
+Stripe webhook verification on the raw request body.
+
+Implements Stripe's ``Stripe-Signature`` scheme (HMAC-SHA256 of
+``"{timestamp}.{body}"``) directly, so a delivery is checked in the event
+loop without decoding the body or building ``stripe.Event`` objects.
+"""
+import hashlib
+import hmac
+import time
+import orjson
+from src.billing.constants import STRIPE_WEBHOOK_TOLERANCE
+
+
+class WebhookVerificationError(ValueError):
+    pass
+
+
+def _parse_signature_header(header: str) -> tuple[int, list[bytes]]:
+    timestamp = None
+    signatures = []
+    for item in header.split(","):
+        key, _, value = item.strip().partition("=")
+        if key == "t":
+            try:
+                timestamp = int(value)
+            except ValueError:
+                raise WebhookVerificationError("Invalid timestamp in signature header")
+        elif key == "v1":
+            signatures.append(value.encode())
+    if timestamp is None or not signatures:
+        raise WebhookVerificationError("Unable to extract timestamp and signatures from header")
+    return timestamp, signatures
+
+
+def _compute_signature(payload: bytes, secret: str, timestamp: int) -> str:
+    return hmac.new(secret.encode(), str(timestamp).encode() + b"." + payload, hashlib.sha256).hexdigest()
+
+
+def verify_signature(payload: bytes, header: str, secret: str,
+                     tolerance: int = STRIPE_WEBHOOK_TOLERANCE) -> None:
+    timestamp, signatures = _parse_signature_header(header)
+    expected = _compute_signature(payload, secret, timestamp).encode()
+
+    if not any(hmac.compare_digest(expected, signature) for signature in signatures):
+        raise WebhookVerificationError("No signatures found matching the expected signature for payload")
+    if tolerance and abs(time.time() - timestamp) > tolerance:
+        raise WebhookVerificationError("Timestamp outside the tolerance zone")
+
+
+def construct_event(payload: bytes, header: str, secret: str) -> dict:
+    """Verify a delivery and return the event as plain dicts and lists."""
+    verify_signature(payload, header, secret)
+    try:
+        event = orjson.loads(payload)
+    except orjson.JSONDecodeError:
+        raise WebhookVerificationError("Invalid payload")
+    if not isinstance(event, dict) or "id" not in event or "type" not in event:
+        raise WebhookVerificationError("Invalid payload")
+    return event
+
+
+def sign_payload(payload: bytes, secret: str, timestamp: int | None = None) -> str:
+    """Build a ``Stripe-Signature`` header value, as Stripe would send it."""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    return f"t={timestamp},v1={_compute_signature(payload, secret, timestamp)}"
@@ -0,0 +1,39 @@
+import logging
+from redis.asyncio import Redis
+from src.config import settings
+
+
+logger = logging.getLogger(__name__)
+
+# Redis is a fast path in front of Postgres; a slow or missing Redis must not
+# stall requests, so keep timeouts short and let callers fall back.
+REDIS_TIMEOUT = 0.5
+# After a failure, callers with a local fallback skip Redis this long instead
+# of paying a timeout on every request while it is down
+REDIS_FAILURE_COOLDOWN = 5.0
+
+_client: Redis | None = None
+_unavailable = False
+
+
+def get_redis() -> Redis | None:
+    """Shared Redis client for this process, or None if REDIS_URL is not usable."""
+    global _client, _unavailable
+    if _client is None and not _unavailable:
+        try:
+            _client = Redis.from_url(
+                settings.redis_url,
+                socket_timeout=REDIS_TIMEOUT,
+                socket_connect_timeout=REDIS_TIMEOUT,
+            )
+        except ValueError:
+            logger.warning("REDIS_URL is not a redis:// URL, Redis fast paths are disabled")
+            _unavailable = True
+    return _client
+
+
+async def close_redis() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -1,6 +1,13 @@
-from celery import Celery
+from celery import Celery, signals
 from celery.schedules import crontab
 from src.config import settings
+from src.async_task import on_worker_startup, on_worker_shutdown
+from src.database import engine
+from src.mail import mailer, templates
+from src.cache import close_redis
+from src.billing.stripe_client import stripe_api
+from src import metrics  # noqa: F401  (Celery signal handlers for task metrics)
+from src.tracing import setup_tracing, shutdown_tracing
 
 
 celery_app = Celery(
@@ -24,9 +31,71 @@ celery_app.conf.task_routes = {
 }
 
 
+@signals.worker_process_init.connect
+def init_tracing(**kwargs):
+    # per forked process: the span exporter runs a background thread
+    setup_tracing("worker")
+
+
+def _is_solo_pool(worker) -> bool:
+    return "solo" in str(getattr(worker, "pool_cls", "")).lower()
+
+
+@signals.worker_init.connect
+def init_tracing_solo_pool(sender=None, **kwargs):
+    # the solo pool never forks, so worker_process_init does not fire
+    if _is_solo_pool(sender):
+        setup_tracing("worker")
+
+
+@signals.worker_process_shutdown.connect
+def flush_traces(**kwargs):
+    shutdown_tracing()
+
+
+@signals.worker_shutdown.connect
+def flush_traces_solo_pool(sender=None, **kwargs):
+    if _is_solo_pool(sender):
+        shutdown_tracing()
+
+
+@on_worker_startup
+async def compile_email_templates():
+    templates.load()
+
+
+@on_worker_shutdown
+async def dispose_async_engine():
+    # asyncpg connections belong to the worker loop, close them before it stops
+    await engine.dispose()
+
+
+@on_worker_shutdown
+async def close_smtp_pool():
+    await mailer.close()
+
+
+@on_worker_shutdown
+async def close_stripe_client():
+    await stripe_api.close()
+
+
+@on_worker_shutdown
+async def close_redis_client():
+    await close_redis()
+
+
 beat_app.conf.beat_schedule = {
     "expire-subscriptions-every-hour": {
         "task": "expire_subscriptions_task",
         "schedule": crontab(minute=0, hour="*"),  
     },
+    "requeue-stripe-events-every-5-minutes": {
+        "task": "requeue_stripe_events_task",
+        "schedule": crontab(minute="*/5"),
+    },
+    "persist-api-usage-every-5-minutes": {
+        "task": "persist_api_usage_task",
+        "schedule": crontab(minute="*/5"),
+    },
 }
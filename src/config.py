@@ -13,6 +13,11 @@ class Settings(BaseSettings):
     app_debug: bool = True
     app_url: str
 
+    # Logging
+    log_level: str = "DEBUG"
+    log_format: str | None = None  # "pretty" | "json"; default: pretty only in development/local
+    log_file: str | None = "logs/app.log"
+
     # Database
     database_url: str = Field(default=..., alias="DATABASE_URL")
     sync_database_url: str = Field(default=..., alias="SYNC_DATABASE_URL")
@@ -34,6 +39,8 @@ class Settings(BaseSettings):
     smtp_port: int = Field(default=...)
     smtp_user: str = Field(default=...)
     smtp_password: str = Field(default=...)
+    smtp_pool_size: int = 4
+    smtp_pool_max_idle: float = 30  # seconds before a pooled connection is health-checked
 
 
     #SOCIAL_LOGIN
@@ -58,10 +65,46 @@ class Settings(BaseSettings):
     celery_worker_url: str = Field(default=...)
     celery_beat_url: str = Field(default=...)
 
+    # CDN purge endpoint taking a space-separated Surrogate-Key header (Fastly style); unset disables purging
+    cdn_purge_url: str | None = None
+    cdn_purge_token: str | None = None
+
+    # Rate limits ("5/minute") per route template, on top of src.rate_limiter.ROUTE_LIMITS
+    rate_limit_default: str = "5/minute"
+    rate_limits: dict[str, str] = {}
+    rate_limit_local_max_keys: int = 100_000  # in-process budgets kept while Redis is down (LRU)
+    # Per plan tier ("PRO"): route template or "*" -> limit, and requests per UTC day (0 = unmetered);
+    # merged over src.billing.constants.TIER_ROUTE_LIMITS / DAILY_QUOTAS
+    rate_limit_tiers: dict[str, dict[str, str]] = {}
+    daily_quotas: dict[str, int] = {}
+    # Proxies/load balancers (CIDRs) whose X-Forwarded-For is trusted for the client IP
+    trusted_proxies: list[str] = []
+
+    # Access log: sample rate per status class ({2: 0.01, 5: 1}), JSON lines to stdout or this file
+    access_log_sample_rates: dict[int, float] = {}
+    access_log_path: str | None = None
+    # Add a Server-Timing header (DB time, query count, pool wait, app time) to every response
+    server_timing_enabled: bool = False
+    # Celery workers serve /metrics on this port (the API serves it on its own port)
+    celery_metrics_port: int | None = None
+    # The API's /metrics answers these networks (CIDRs), or any client sending "Authorization: Bearer <token>"
+    metrics_allowed_networks: list[str] = ["127.0.0.0/8", "::1/128"]
+    metrics_token: str | None = None
+
+    # Tracing: "otlp" | "file" | "console", unset disables; ratio of new traces kept (head sampling)
+    tracing_exporter: str | None = None
+    tracing_sample_ratio: float = 0.1
+    tracing_file: str = "logs/traces.jsonl"
+
 
     stripe_webhook_secret: str = Field(default=...)
     stripe_public_key: str = Field(default=...)
     stripe_secret_key: str = Field(default=...)
+    stripe_max_concurrency: int = 10
+    stripe_rate_limit: float = 20  # requests per second, Stripe allows 25 in test mode
+    stripe_max_network_retries: int = 3
+    stripe_timeout: float = 30
+    stripe_api_base: str | None = None  # e.g. http://localhost:12111 for benchmarks.stripe_emulator
 
 
     model_config = SettingsConfigDict(env_file=".env")
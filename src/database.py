@@ -4,9 +4,10 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from src.config import settings
+from src.db_stats import TimedAsyncAdaptedQueuePool
 
 
-engine = create_async_engine(settings.database_url, echo=True)
+engine = create_async_engine(settings.database_url, echo=True, poolclass=TimedAsyncAdaptedQueuePool)
 
 
 async_session = sessionmaker(
@@ -0,0 +1,103 @@
+"""
+Per-request database statistics.
+
+``RequestLoggingMiddleware`` opens a ``QueryStats`` for each request in a
+context variable. SQLAlchemy cursor events, registered here on every
+``Engine``, add each statement's count and time to it (the async engine's
+greenlets inherit the request's context), and ``TimedAsyncAdaptedQueuePool``
+adds the time spent waiting for a pooled connection. The totals go into the
+access log record and, with ``SERVER_TIMING_ENABLED``, a ``Server-Timing``
+header.
+"""
+import time
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from src.metrics import DB_POOL_WAIT, observe_pool
+
+
+SLOWEST_STATEMENT_CHARS = 200
+
+
+class QueryStats:
+    __slots__ = ("queries", "db_ms", "pool_ms", "slowest_ms", "slowest_statement")
+
+    def __init__(self) -> None:
+        self.queries = 0
+        self.db_ms = 0.0
+        self.pool_ms = 0.0
+        self.slowest_ms = 0.0
+        self.slowest_statement: str | None = None
+
+
+    def add_query(self, statement: str, duration_ms: float) -> None:
+        self.queries += 1
+        self.db_ms += duration_ms
+        if duration_ms > self.slowest_ms:
+            self.slowest_ms = duration_ms
+            self.slowest_statement = statement
+
+
+    def server_timing(self) -> str:
+        return (f'db;dur={self.db_ms:.2f};desc="{self.queries} queries", '
+                f'db-pool;dur={self.pool_ms:.2f}')
+
+
+    def as_log_fields(self) -> dict:
+        return {
+            "db_queries": self.queries,
+            "db_ms": round(self.db_ms, 2),
+            "db_pool_ms": round(self.pool_ms, 2),
+            "db_slowest_ms": round(self.slowest_ms, 2),
+            "db_slowest": self.slowest_statement[:SLOWEST_STATEMENT_CHARS] if self.slowest_statement else None,
+        }
+
+
+request_stats: ContextVar[QueryStats | None] = ContextVar("request_stats", default=None)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if request_stats.get() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = request_stats.get()
+    starts = conn.info.get("query_start")
+    if stats is None or not starts:
+        return
+    stats.add_query(statement, (time.perf_counter() - starts.pop()) * 1000)
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(exception_context):
+    # a failed statement never reaches after_cursor_execute
+    starts = exception_context.connection.info.get("query_start") if exception_context.connection else None
+    if starts:
+        starts.pop()
+
+
+class TimedAsyncAdaptedQueuePool(AsyncAdaptedQueuePool):
+    """
+    Async queue pool that adds checkout wait time to the current request's
+    stats and keeps the pool metrics up to date.
+    """
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            DB_POOL_WAIT.observe(waited)
+            observe_pool(self)
+            stats = request_stats.get()
+            if stats is not None:
+                stats.pool_ms += waited * 1000
+
+
+    def _do_return_conn(self, record):
+        super()._do_return_conn(record)
+        observe_pool(self)
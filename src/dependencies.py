@@ -1,12 +1,31 @@
+import hmac
+import ipaddress
 from typing import Annotated
-from fastapi import Depends
+from fastapi import Depends, HTTPException, Request, status
+from src.config import settings
 from src.database import db_dependency 
+from src.rate_limiter import client_address
 from src.repository import RefreshTokenRepository
 
 
+METRICS_ALLOWED_NETWORKS = tuple(ipaddress.ip_network(network) for network in settings.metrics_allowed_networks)
+
+
 
 
 def get_refresh_token_repo(db: db_dependency) -> RefreshTokenRepository:
     return RefreshTokenRepository(db)
 
-token_depedency = Annotated[RefreshTokenRepository, Depends(get_refresh_token_repo)]
\ No newline at end of file
+token_depedency = Annotated[RefreshTokenRepository, Depends(get_refresh_token_repo)]
+
+
+def require_metrics_access(request: Request) -> None:
+    """Serve /metrics only to ``METRICS_ALLOWED_NETWORKS`` or to callers presenting ``METRICS_TOKEN``."""
+    token = settings.metrics_token
+    if token and hmac.compare_digest(request.headers.get("Authorization", "").encode(), f"Bearer {token}".encode()):
+        return
+    address = client_address(request)
+    if address is not None and address.version == 6 and address.ipv4_mapped:  # type: ignore[union-attr]
+        address = address.ipv4_mapped  # type: ignore[union-attr]
+    if address is None or not any(address in network for network in METRICS_ALLOWED_NETWORKS):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not allowed to read metrics")
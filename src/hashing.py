@@ -1,14 +1,26 @@
+import time
 from passlib.context import CryptContext
 from fastapi.concurrency import run_in_threadpool
+from src.metrics import PASSWORD_HASH_DURATION, PASSWORD_HASH_IN_PROGRESS
 
 
 pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
 
 
+async def _in_threadpool(operation: str, fn, *args):
+    start = time.perf_counter()
+    PASSWORD_HASH_IN_PROGRESS.inc()
+    try:
+        return await run_in_threadpool(fn, *args)
+    finally:
+        PASSWORD_HASH_IN_PROGRESS.dec()
+        PASSWORD_HASH_DURATION.labels(operation).observe(time.perf_counter() - start)
+
+
 async def hash_password(password: str) -> str : 
-    return await run_in_threadpool(pwd_context.hash, password) 
+    return await _in_threadpool("hash", pwd_context.hash, password)
 
 
 async def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return await run_in_threadpool(pwd_context.verify, plain_password, hashed_password) 
+    return await _in_threadpool("verify", pwd_context.verify, plain_password, hashed_password)
 
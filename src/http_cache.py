@@ -0,0 +1,76 @@
+"""
+Validators and cache headers for GET responses.
+
+Routes compute a strong ETag from data they already have (a pre-serialized
+body, or row ids and ``updated_at`` values), so a matching ``If-None-Match``
+is answered with 304 before anything is serialized.
+"""
+import hashlib
+from typing import Any, Iterable
+import httpx
+from fastapi import Request, Response, status
+from src.config import settings
+
+
+# Catalog pages: browsers revalidate after a minute; the CDN keeps them until
+# a plan change purges their surrogate keys
+PUBLIC_CACHE = "public, max-age=60, s-maxage=86400, stale-while-revalidate=300"
+# Per-user pages: never stored by shared caches, always revalidated by the client
+PRIVATE_CACHE = "private, no-cache"
+
+
+def etag_for(body: bytes) -> str:
+    """Strong ETag for a response body."""
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def row_etag(*parts: Any) -> str:
+    """Strong ETag from row versions (ids, ``updated_at``, counts) instead of the body."""
+    return etag_for("|".join(str(part) for part in parts).encode())
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """If-None-Match check, using the weak comparison RFC 9110 asks for on GET."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(candidate.strip().removeprefix("W/") == etag for candidate in header.split(","))
+
+
+def cache_headers(etag: str, cache_control: str | None = None,
+                  surrogate_keys: Iterable[str] | None = None) -> dict[str, str]:
+    headers = {"ETag": etag}
+    if cache_control:
+        headers["Cache-Control"] = cache_control
+    if surrogate_keys:
+        headers["Surrogate-Key"] = " ".join(surrogate_keys)
+    return headers
+
+
+def not_modified(etag: str, cache_control: str | None = None,
+                 surrogate_keys: Iterable[str] | None = None) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                    headers=cache_headers(etag, cache_control, surrogate_keys))
+
+
+async def purge_surrogate_keys(keys: list[str]) -> None:
+    """Ask the CDN to drop every cached page tagged with one of ``keys``."""
+    if not settings.cdn_purge_url:
+        return
+    headers = {"Surrogate-Key": " ".join(keys)}
+    if settings.cdn_purge_token:
+        headers["Fastly-Key"] = settings.cdn_purge_token
+    async with httpx.AsyncClient(timeout=10) as client:
+        response = await client.post(settings.cdn_purge_url, headers=headers)
+        response.raise_for_status()
+
+
+def json_response(request: Request, body: bytes, etag: str, cache_control: str | None = None,
+                  surrogate_keys: Iterable[str] | None = None) -> Response:
+    """Serve a serialized JSON body, or an empty 304 if the client already has it."""
+    if etag_matches(request, etag):
+        return not_modified(etag, cache_control, surrogate_keys)
+    return Response(body, media_type="application/json",
+                    headers=cache_headers(etag, cache_control, surrogate_keys))
@@ -1,5 +1,5 @@
 from uuid import uuid4
-from fastapi import HTTPException, status
+from fastapi import HTTPException, Request, status
 from datetime import datetime, timezone, timedelta
 from jose import jwt, JWTError, ExpiredSignatureError
 from src.config import settings
@@ -38,4 +38,21 @@ def verify_token(token: str, secret_key: str) -> dict:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token expired")
     
     except JWTError:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
\ No newline at end of file
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+
+
+def access_claims(request: Request) -> dict | None:
+    """
+    Claims of the request's bearer access token if it verifies, else None.
+    Decoded once per request: the rate limiter and ``get_user`` share the result.
+    """
+    state = request.state
+    if not hasattr(state, "access_claims"):
+        state.access_claims = None
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() == "bearer" and token:
+            try:
+                state.access_claims = verify_token(token, settings.access_secret_key)
+            except HTTPException:
+                pass
+    return state.access_claims
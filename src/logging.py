@@ -1,19 +1,39 @@
 import logging
 import sys
+import orjson
 from loguru import logger
+from src.config import settings
 
-LOG_LEVEL = "DEBUG"       # DEBUG in dev, INFO in prod
-APP_ENV = "local"            # "local" | "production" | "staging"
+
+# loguru names for the stdlib levels, looked up without taking loguru's lock
+_LEVELS = {
+    logging.CRITICAL: "CRITICAL",
+    logging.ERROR: "ERROR",
+    logging.WARNING: "WARNING",
+    logging.INFO: "INFO",
+    logging.DEBUG: "DEBUG",
+}
 
 
 class InterceptHandler(logging.Handler):
-    """Redirect standard logging (uvicorn, libraries) to loguru."""
+    """
+    Redirect standard logging (uvicorn, libraries) to loguru.
+
+    With ``caller_info`` the record is attributed to the code that called
+    ``logging``, which needs a frame walk per record; the JSON format only
+    uses the stdlib logger name, so it skips the walk.
+    """
+    def __init__(self, caller_info: bool = True) -> None:
+        super().__init__()
+        self.caller_info = caller_info
+
+
     def emit(self, record: logging.LogRecord) -> None:
-        try:
-            # Map logging level to loguru level
-            level = logger.level(record.levelname).name
-        except ValueError:
-            level = record.levelno
+        level = _LEVELS.get(record.levelno, record.levelno)
+
+        if not self.caller_info:
+            logger.bind(logger=record.name).opt(exception=record.exc_info).log(level, record.getMessage())
+            return
 
         # Find where the log message came from
         frame, depth = logging.currentframe(), 2
@@ -24,17 +44,42 @@ class InterceptHandler(logging.Handler):
         logger.opt(depth=depth, exception=record.exc_info).log(level, record.getMessage())
 
 
+def json_sink(message) -> None:
+    """One compact JSON line per record: time, level, logger, message, extras and exception."""
+    record = message.record
+    extra = record["extra"]
+    line = {
+        "ts": record["time"].timestamp(),
+        "level": record["level"].name,
+        "logger": extra.get("logger") or record["name"],
+        "msg": record["message"],
+    }
+    fields = {key: value for key, value in extra.items() if key != "logger"}
+    if fields:
+        line["extra"] = fields
+    if record["exception"] is not None:
+        # loguru appends the formatted traceback to the "{message}" format
+        line["exc"] = str(message)[len(record["message"]):].strip()
+    sys.stdout.buffer.write(orjson.dumps(line, default=str, option=orjson.OPT_APPEND_NEWLINE))
+    sys.stdout.buffer.flush()
+
 
 def setup_logging() -> None:
-    """Configure loguru for local dev + ready for production."""
+    """
+    Configure loguru from settings: ``LOG_LEVEL``, ``LOG_FORMAT`` ("pretty" or
+    "json"; defaults to pretty only when ``APP_ENV`` is development/local) and
+    ``LOG_FILE``.
+    """
     # 1) Remove default loguru handler
     logger.remove()
+    level = settings.log_level.upper()
+    log_format = settings.log_format or ("pretty" if settings.app_env in ("development", "local") else "json")
 
     # 2) Local development: pretty logs
-    if APP_ENV == "local":
+    if log_format == "pretty":
         logger.add(
             sys.stdout,
-            level=LOG_LEVEL,
+            level=level,
             backtrace=True,
             diagnose=True,
             enqueue=True,
@@ -46,29 +91,37 @@ def setup_logging() -> None:
             ),
         )
     else:
-        # Production-ish: JSON logs to stdout (good for Docker / log aggregation)
+        # Production: compact JSON lines to stdout (Docker / log aggregation)
         logger.add(
-            sys.stdout,
-            level=LOG_LEVEL,
+            json_sink,
+            level=level,
             backtrace=False,
             diagnose=False,
             enqueue=True,
-            serialize=True,  # <-- JSON
+            format="{message}",
         )
 
     # Optional: file logs (works for both envs)
-    logger.add(
-        "logs/app.log",
-        rotation="10 MB",
-        retention="7 days",
-        level=LOG_LEVEL,
-        encoding="utf-8",
-    )
+    if settings.log_file:
+        logger.add(
+            settings.log_file,
+            rotation="10 MB",
+            retention="7 days",
+            level=level,
+            encoding="utf-8",
+            enqueue=True,  # write from loguru's thread, not the event loop
+        )
 
     # 3) Redirect standard logging → loguru (uvicorn, fastapi internals, etc.)
-    logging.basicConfig(handlers=[InterceptHandler()], level=0, force=True)
+    handler = InterceptHandler(caller_info=log_format == "pretty")
+    logging.basicConfig(handlers=[handler], level=logging.getLevelName(level), force=True)
 
     # Important loggers to intercept
-    for name in ("uvicorn", "uvicorn.error", "uvicorn.access", "fastapi"):
-        logging.getLogger(name).handlers = [InterceptHandler()]
-        logging.getLogger(name).propagate = False
\ No newline at end of file
+    for name in ("uvicorn", "uvicorn.error", "fastapi"):
+        logging.getLogger(name).handlers = [handler]
+        logging.getLogger(name).propagate = False
+
+    # src.access_log records every request; uvicorn's own access lines would duplicate it
+    logging.getLogger("uvicorn.access").handlers = []
+    logging.getLogger("uvicorn.access").propagate = False
+    logging.getLogger("uvicorn.access").disabled = True
@@ -0,0 +1,234 @@
+import asyncio
+import time
+from datetime import datetime
+from contextlib import asynccontextmanager
+from email.message import Message
+from email.utils import formataddr
+from pathlib import Path
+from typing import Any, AsyncIterator
+import aiosmtplib
+from jinja2 import Environment, FileSystemLoader, Template
+from fastapi_mail import ConnectionConfig, MessageSchema
+from fastapi_mail.fastmail import email_dispatched
+from fastapi_mail.msg import MailMsg
+from src.config import settings
+from src.utils import conf
+
+
+# Errors after which the server has reset the envelope and the session is still usable
+REJECTED_ERRORS = (aiosmtplib.SMTPResponseException, aiosmtplib.SMTPRecipientsRefused)
+
+
+class BatchInterrupted(aiosmtplib.SMTPException):
+    """
+    The connection failed part way through ``send_messages``. ``unsent`` are
+    the positions of the messages that were rejected or never sent; the
+    others were delivered.
+    """
+    def __init__(self, unsent: list[int]) -> None:
+        super().__init__(f"SMTP batch interrupted with {len(unsent)} messages unsent")
+        self.unsent = unsent
+
+
+class EmailTemplates:
+    """
+    Compiles every email template once and renders it with the static
+    context (app name, support address, ...) already merged in, so each
+    message only supplies its own fields. The current ``year`` is added at
+    render time so long-running workers don't keep last year's footer.
+    """
+    def __init__(self, folder: str | Path, static_context: dict[str, Any]) -> None:
+        self.env = Environment(loader=FileSystemLoader(folder))
+        self.env.globals.update(static_context)
+        self._templates: dict[str, Template] = {}
+
+
+    def load(self) -> None:
+        for name in self.env.list_templates(extensions=["html"]):
+            self._templates[name] = self.env.get_template(name)
+
+
+    def render(self, name: str, context: dict[str, Any]) -> str:
+        template = self._templates.get(name)
+        if template is None:
+            template = self._templates[name] = self.env.get_template(name)
+        return template.render({"year": datetime.now().year, **context})
+
+
+class SMTPPool:
+    """
+    Bounded pool of connected, authenticated SMTP sessions.
+
+    Connections belong to the event loop that opened them, so the pool
+    rebinds (dropping idle sessions) if it is used from a new loop.
+    """
+    def __init__(self, config: ConnectionConfig, size: int, max_idle: float) -> None:
+        self.config = config
+        self.size = size
+        self.max_idle = max_idle
+        self._idle: list[tuple[aiosmtplib.SMTP, float]] = []
+        self._slots: asyncio.Semaphore | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+
+    def _bind_loop(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop or self._slots is None:
+            self._idle = []
+            self._slots = asyncio.Semaphore(self.size)
+            self._loop = loop
+        return self._slots
+
+
+    async def _connect(self) -> aiosmtplib.SMTP:
+        smtp = aiosmtplib.SMTP(
+            hostname=self.config.MAIL_SERVER,
+            port=self.config.MAIL_PORT,
+            timeout=self.config.TIMEOUT,
+            use_tls=self.config.MAIL_SSL_TLS,
+            start_tls=self.config.MAIL_STARTTLS,
+            validate_certs=self.config.VALIDATE_CERTS,
+            local_hostname=self.config.LOCAL_HOSTNAME,
+            cert_bundle=self.config.CERT_BUNDLE,
+        )
+        await smtp.connect()
+        if self.config.USE_CREDENTIALS:
+            await smtp.login(self.config.MAIL_USERNAME, self.config.MAIL_PASSWORD.get_secret_value())
+        return smtp
+
+
+    async def _checkout(self) -> aiosmtplib.SMTP:
+        now = time.monotonic()
+        while self._idle:
+            smtp, last_used = self._idle.pop()
+            if not smtp.is_connected:
+                continue
+            if now - last_used < self.max_idle:
+                return smtp
+            # idle long enough that the server may have dropped us
+            try:
+                await smtp.noop()
+                return smtp
+            except (aiosmtplib.SMTPException, OSError):
+                smtp.close()
+        return await self._connect()
+
+
+    @asynccontextmanager
+    async def connection(self, fresh: bool = False) -> AsyncIterator[aiosmtplib.SMTP]:
+        async with self._bind_loop():
+            smtp = await self._connect() if fresh else await self._checkout()
+            reusable = True
+            try:
+                yield smtp
+            except REJECTED_ERRORS:
+                raise
+            except BaseException:
+                reusable = False
+                raise
+            finally:
+                if reusable and smtp.is_connected:
+                    self._idle.append((smtp, time.monotonic()))
+                else:
+                    smtp.close()
+
+
+    async def close(self) -> None:
+        idle, self._idle = self._idle, []
+        for smtp, _ in idle:
+            try:
+                await smtp.quit()
+            except (aiosmtplib.SMTPException, OSError):
+                smtp.close()
+
+
+class MailTransport:
+    """
+    Renders fastapi-mail ``MessageSchema`` messages and sends them over
+    pooled SMTP connections instead of a new connection per message.
+    """
+    def __init__(self, config: ConnectionConfig, templates: EmailTemplates, pool_size: int, max_idle: float) -> None:
+        self.config = config
+        self.templates = templates
+        self.pool = SMTPPool(config, pool_size, max_idle)
+
+
+    async def build_message(self, message: MessageSchema, template_name: str | None = None) -> Message:
+        if template_name and message.template_body is not None:
+            message.template_body = self.templates.render(template_name, message.template_body)
+
+        sender = message.from_email or self.config.MAIL_FROM
+        if (from_name := message.from_name or self.config.MAIL_FROM_NAME) is not None:
+            sender = formataddr((from_name, sender))
+        return await MailMsg(message)._message(sender)
+
+
+    async def send_message(self, message: MessageSchema, template_name: str | None = None) -> None:
+        msg = await self.build_message(message, template_name)
+        for fresh in (False, True):
+            try:
+                async with self.pool.connection(fresh=fresh) as smtp:
+                    await self._send(smtp, msg)
+                return
+            except aiosmtplib.SMTPServerDisconnected:
+                # a pooled session died between checks, retry once on a new one
+                if fresh:
+                    raise
+
+
+    async def send_messages(self, messages: list[tuple[MessageSchema, str | None]]) -> list[tuple[int, Message, Exception]]:
+        """
+        Send many messages back to back over a single connection.
+        Returns the position, message and error of each message the server
+        rejected. Connection errors raise ``BatchInterrupted``.
+        """
+        pending = [(position, await self.build_message(message, template_name))
+                   for position, (message, template_name) in enumerate(messages)]
+        rejected: list[tuple[int, Message, Exception]] = []
+
+        for fresh in (False, True):
+            try:
+                async with self.pool.connection(fresh=fresh) as smtp:
+                    while pending:
+                        position, msg = pending[0]
+                        try:
+                            await self._send(smtp, msg)
+                        except REJECTED_ERRORS as exc:
+                            rejected.append((position, msg, exc))
+                        pending.pop(0)
+                return rejected
+            except aiosmtplib.SMTPServerDisconnected as exc:
+                if fresh:
+                    raise BatchInterrupted(self._unsent(rejected, pending)) from exc
+            except (aiosmtplib.SMTPException, OSError) as exc:
+                raise BatchInterrupted(self._unsent(rejected, pending)) from exc
+        return rejected
+
+
+    @staticmethod
+    def _unsent(rejected: list[tuple[int, Message, Exception]], pending: list[tuple[int, Message]]) -> list[int]:
+        return [position for position, *_ in rejected] + [position for position, _ in pending]
+
+
+    async def _send(self, smtp: aiosmtplib.SMTP, msg: Message) -> None:
+        if not self.config.SUPPRESS_SEND:
+            await smtp.send_message(msg)
+        email_dispatched.send(msg)
+
+
+    async def close(self) -> None:
+        await self.pool.close()
+
+
+STATIC_CONTEXT = {
+    "app_name": settings.app_name,
+    "app_url": settings.app_url,
+    "dashboard_url": settings.app_url,
+    "expires_in": settings.validation_token_expire,
+    "support_email": "support@fast_api.com",
+    "company_address": "1234 Street, City, Country",
+}
+
+
+templates = EmailTemplates(conf.TEMPLATE_FOLDER, STATIC_CONTEXT)  # type: ignore
+mailer = MailTransport(conf, templates, pool_size=settings.smtp_pool_size, max_idle=settings.smtp_pool_max_idle)
@@ -1,59 +1,47 @@
-import time
-from fastapi import FastAPI, Request, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import Depends, FastAPI
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from loguru import logger
-from slowapi.errors import RateLimitExceeded
-from slowapi.middleware import SlowAPIMiddleware
-from slowapi.util import get_remote_address
-from slowapi import _rate_limit_exceeded_handler
 from src.rate_limiter import limiter
+from src.access_log import access_log
+from src.metrics import metrics_response, mark_process_dead
+from src.middleware import RequestLoggingMiddleware, RateLimitMiddleware
 from src.logging import setup_logging
+from src.tracing import setup_tracing, instrument_app, shutdown_tracing
 from src.auth.router import router as auth_router
 from src.billing.router import router as billing_router
 from src.exceptions import validation_exception_handler
+from src.mail import mailer, templates
+from src.cache import close_redis
+from src.dependencies import require_metrics_access
+from src.billing.stripe_client import stripe_api
 
 
 setup_logging()
+setup_tracing("api")
 
-app = FastAPI()
 
-app.state.limiter = limiter
-
-app.add_middleware(SlowAPIMiddleware)
-
-
-
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    start = time.perf_counter()
-    method = request.method
-    path = request.url.path
-
-    client_host = request.client.host if request.client else "unknown"
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    templates.load()
+    yield
+    await mailer.close()
+    await stripe_api.close()
+    await close_redis()
+    access_log.close()
+    mark_process_dead()
+    shutdown_tracing()
 
-    try:
-        response = await call_next(request)
-    except Exception as e:
-        duration = (time.perf_counter() - start) * 1000
-        logger.exception(
-            f"{method} {path} from {client_host} -> CRASHED ({duration:.2f}ms): {e}"
-        )
-        raise
 
-    duration = (time.perf_counter() - start) * 1000
-    status = response.status_code
-
-    if status < 400:
-        logger.info(f"{method} {path} from {client_host} -> {status} ({duration:.2f}ms)")
-    elif status < 500:
-        logger.warning(f"{method} {path} from {client_host} -> {status} ({duration:.2f}ms)")
-    else:
-        logger.error(f"{method} {path} from {client_host} -> {status} ({duration:.2f}ms)")
-
-    return response
+app = FastAPI(lifespan=lifespan)
+instrument_app(app)
 
+app.state.limiter = limiter
 
+# Starlette runs the last added middleware first: CORS answers preflights
+# before they are logged or rate limited
+app.add_middleware(RateLimitMiddleware)
+app.add_middleware(RequestLoggingMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -67,3 +55,9 @@ app.add_exception_handler(RequestValidationError, validation_exception_handler)
 app.include_router(auth_router, tags=["auth"])
 app.include_router(billing_router)
 
+
+@app.get("/metrics", include_in_schema=False, dependencies=[Depends(require_metrics_access)])
+@limiter.exempt
+async def metrics():
+    return metrics_response()
+
@@ -0,0 +1,137 @@
+"""
+Prometheus metrics.
+
+Metrics are module-level ``prometheus_client`` objects updated where the
+work happens (request middleware, DB pool, password hashing, Stripe client,
+rate limiter, Celery signals). When ``PROMETHEUS_MULTIPROC_DIR`` is set (it
+must be an empty directory shared by all uvicorn/Celery processes of one
+host), every process writes its samples there and ``/metrics`` aggregates
+them; gauges use ``livesum`` so dead workers drop out once they are marked.
+"""
+import os
+import time
+from celery import signals
+from fastapi import Response
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest,
+    multiprocess, start_http_server,
+)
+from src.config import settings
+
+
+MULTIPROCESS = bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+
+# API
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Request latency by route template",
+    ["method", "route", "status"],
+)
+HTTP_REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress", "Requests being handled", multiprocess_mode="livesum",
+)
+RATE_LIMIT_REJECTIONS = Counter(
+    "rate_limit_rejections_total", "Requests rejected by the rate limiter", ["route"],
+)
+RATE_LIMIT_LOCAL_KEYS = Gauge(
+    "rate_limit_local_keys", "Budgets held in process memory while Redis is unavailable",
+    multiprocess_mode="livesum",
+)
+RATE_LIMIT_LOCAL_EVICTIONS = Counter(
+    "rate_limit_local_evictions_total", "In-process budgets evicted to stay under the key bound",
+    ["state"],  # "active" evictions forgave part of a caller's spent budget
+)
+LOGIN_THROTTLE_REJECTIONS = Counter(
+    "login_throttle_rejections_total", "Login attempts refused before password verification", ["scope"],
+)
+
+# Database pool (per process, summed across processes)
+DB_POOL_SIZE = Gauge("db_pool_size", "Configured pool size", multiprocess_mode="livesum")
+DB_POOL_CHECKED_OUT = Gauge("db_pool_checked_out", "Connections in use", multiprocess_mode="livesum")
+DB_POOL_OVERFLOW = Gauge("db_pool_overflow", "Connections above pool_size", multiprocess_mode="livesum")
+DB_POOL_WAIT = Histogram(
+    "db_pool_wait_seconds", "Time to check a connection out of the pool",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+
+# Password hashing (Argon2 runs in the threadpool)
+PASSWORD_HASH_IN_PROGRESS = Gauge(
+    "password_hash_in_progress", "Argon2 hash/verify calls queued or running", multiprocess_mode="livesum",
+)
+PASSWORD_HASH_DURATION = Histogram(
+    "password_hash_duration_seconds", "Argon2 hash/verify time including threadpool wait", ["operation"],
+)
+
+# Stripe
+STRIPE_REQUEST_DURATION = Histogram(
+    "stripe_request_duration_seconds", "Stripe API call latency", ["operation", "outcome"],
+)
+
+# Celery
+CELERY_QUEUE_LATENCY = Histogram(
+    "celery_task_queue_latency_seconds", "Time from publish to a worker starting the task", ["task"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900),
+)
+CELERY_TASK_DURATION = Histogram(
+    "celery_task_duration_seconds", "Task run time", ["task", "state"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+
+PUBLISHED_AT_HEADER = "published_at"
+_task_started: dict[str, float] = {}
+
+
+def registry() -> CollectorRegistry:
+    if not MULTIPROCESS:
+        return REGISTRY
+    collector_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collector_registry)
+    return collector_registry
+
+
+def metrics_response() -> Response:
+    return Response(generate_latest(registry()), media_type=CONTENT_TYPE_LATEST)
+
+
+def mark_process_dead() -> None:
+    """Drop this process's live gauges from the multiprocess aggregate."""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def observe_pool(pool) -> None:
+    DB_POOL_SIZE.set(pool.size())
+    DB_POOL_CHECKED_OUT.set(pool.checkedout())
+    DB_POOL_OVERFLOW.set(max(pool.overflow(), 0))
+
+
+@signals.before_task_publish.connect
+def _stamp_publish_time(headers=None, **kwargs):
+    if headers is not None:
+        headers[PUBLISHED_AT_HEADER] = time.time()
+
+
+@signals.task_prerun.connect
+def _task_prerun(task_id=None, task=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+    published_at = getattr(task.request, PUBLISHED_AT_HEADER, None)
+    if published_at:
+        CELERY_QUEUE_LATENCY.labels(task.name).observe(max(time.time() - published_at, 0))
+
+
+@signals.task_postrun.connect
+def _task_postrun(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        CELERY_TASK_DURATION.labels(task.name, state or "UNKNOWN").observe(time.perf_counter() - started)
+
+
+@signals.worker_init.connect
+def _serve_worker_metrics(**kwargs):
+    if settings.celery_metrics_port:
+        start_http_server(settings.celery_metrics_port, registry=registry())
+
+
+@signals.worker_process_shutdown.connect
+def _worker_process_shutdown(**kwargs):
+    mark_process_dead()
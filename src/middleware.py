@@ -0,0 +1,128 @@
+"""
+Pure ASGI middlewares for request logging and rate limiting.
+
+They wrap ``send`` instead of going through ``BaseHTTPMiddleware``, so a
+request costs no extra task or body stream, and streaming responses pass
+through chunk by chunk. Register them inside ``CORSMiddleware`` so preflight
+requests are answered before they are logged or counted.
+
+    python -m benchmarks.middleware
+"""
+import time
+from loguru import logger
+from starlette.datastructures import MutableHeaders
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import BaseRoute, Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from src.access_log import access_log
+from src.config import settings
+from src.db_stats import QueryStats, request_stats
+from src.metrics import HTTP_REQUEST_DURATION, HTTP_REQUESTS_IN_PROGRESS, RATE_LIMIT_REJECTIONS
+from src.rate_limiter import RateLimiter
+
+
+class RequestLoggingMiddleware:
+    """
+    Access-log record per request (method, route template, status, duration,
+    client, database stats) via ``src.access_log``; crashes are also logged with
+    their traceback. Optionally adds the ``Server-Timing`` header.
+    """
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+        stats = QueryStats()
+        token = request_stats.set(stats)
+        HTTP_REQUESTS_IN_PROGRESS.inc()
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if settings.server_timing_enabled:
+                    app_ms = (time.perf_counter() - start) * 1000
+                    headers = MutableHeaders(raw=list(message["headers"]))
+                    headers.append("Server-Timing", f"{stats.server_timing()}, app;dur={app_ms:.2f}")
+                    message["headers"] = headers.raw
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception as e:
+            logger.exception(f"{scope['method']} {scope['path']} -> CRASHED: {e}")
+            status = 500
+            raise
+        finally:
+            request_stats.reset(token)
+            HTTP_REQUESTS_IN_PROGRESS.dec()
+            duration = (time.perf_counter() - start) * 1000
+            # the router stores the matched route in the shared scope
+            route = scope.get("route")
+            client = scope.get("client")
+            # unmatched paths share one label so scanners can't blow up the series count
+            HTTP_REQUEST_DURATION.labels(scope["method"], route.path if route else "<unmatched>", status) \
+                .observe(duration / 1000)
+            access_log.record(scope["method"], route.path if route else scope["path"], status,
+                              duration, client[0] if client else "unknown", stats if stats.queries else None)
+
+
+def _find_route(routes: list[BaseRoute], scope: Scope) -> BaseRoute | None:
+    # last full match wins, like slowapi's _find_route_handler; the route carries the path template
+    found = None
+    for route in routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL and hasattr(route, "endpoint"):
+            found = route
+    return found
+
+
+class RateLimitMiddleware:
+    """
+    Spends one unit of the caller's budget for the matched route template
+    (``src.rate_limiter``), and of their daily quota, on every routed,
+    non-exempt request and adds the X-RateLimit/X-Quota headers to the
+    response, or answers 429 with ``Retry-After``.
+    """
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        app = scope["app"]
+        limiter: RateLimiter = app.state.limiter
+        route = _find_route(app.routes, scope) if limiter.enabled else None
+        if route is None or limiter.is_exempt(route.endpoint):  # type: ignore[attr-defined]
+            await self.app(scope, receive, send)
+            return
+
+        result = await limiter.check(Request(scope, receive=receive), route.path)  # type: ignore[attr-defined]
+        if not result.allowed:
+            # the router never sees this request, record the route for the access log and metrics
+            scope["route"] = route
+            RATE_LIMIT_REJECTIONS.labels(route.path).inc()  # type: ignore[attr-defined]
+            response = JSONResponse({"error": result.error()},
+                                    status_code=429, headers=result.headers())
+            await response(scope, receive, send)
+            return
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(raw=list(message["headers"]))
+                for name, value in result.headers().items():
+                    headers[name] = value
+                message["headers"] = headers.raw
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
@@ -1,17 +1,354 @@
-from slowapi import Limiter
-from slowapi.util import get_remote_address
+"""
+Rate limiting shared by every worker and replica.
 
+Each routed request spends from one budget per route template and caller:
+``ROUTE_LIMITS`` (overridable with ``RATE_LIMITS``) or ``RATE_LIMIT_DEFAULT``.
+Budgets are enforced with GCRA: a single Redis key per (route, caller) holds
+the theoretical arrival time and a Lua script checks and advances it in one
+round trip, using Redis' clock so replicas agree. Keys expire once the budget
+is full again. If Redis is missing or failing, the same algorithm runs in
+process memory (LRU-bounded) until it is back.
 
+Callers are identified by the verified ``sub`` of their access token, so
+rotating or forging tokens doesn't open new budgets, and otherwise by client
+IP (``X-Forwarded-For`` is honoured only from ``TRUSTED_PROXIES``; IPv6
+clients share their /64).
 
+Authenticated callers also get the limits of their plan tier and a daily
+quota (``src.billing.quotas``), counted by the same script: one counter per
+caller and UTC day, listed in a per-day set that ``persist_api_usage_task``
+copies to Postgres.
+"""
+import ipaddress
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Mapping
+from limits import RateLimitItem, parse
+from redis.exceptions import RedisError
+from starlette.requests import Request
+from src.cache import REDIS_FAILURE_COOLDOWN, get_redis
+from src.billing.quotas import TIER_DAILY_QUOTAS, TIER_LIMITS, resolve_tier
+from src.config import settings
+from src.jwt import access_claims
+from src.metrics import RATE_LIMIT_LOCAL_EVICTIONS, RATE_LIMIT_LOCAL_KEYS
 
-def user_or_ip(request):
-    auth = request.headers.get("Authorization")
-    if auth:
-        return auth  # rate limit per user token
-    return get_remote_address(request)
 
+logger = logging.getLogger(__name__)
 
-limiter = Limiter(key_func=user_or_ip, default_limits=["5/minute"])
+KEY_PREFIX = "rl"
+QUOTA_PREFIX = "quota"
+QUOTA_KEY_TTL_MS = 2 * 86_400_000  # yesterday's counters outlive midnight for the last persistence run
 
+# Budgets per route template; everything else gets RATE_LIMIT_DEFAULT
+ROUTE_LIMITS: dict[str, str] = {
+    "/login": "5/minute",
+    "/login/code": "5/minute",
+    "/request/login-code": "5/minute",
+    "/register": "5/minute",
+    "/forget-password": "5/minute",
+    "/billing/plans": "60/minute",
+    "/billing/plans/{plan_id}": "60/minute",
+    "/billing/subscriptions/me": "30/minute",
+    "/billing/payments/me": "30/minute",
+}
 
+# KEYS[1]: bucket key; ARGV[1]: ms between requests (period / amount); ARGV[2]: period in ms
+# With a daily quota (ARGV[3] > 0): KEYS[2] the day's counter, KEYS[3] the day's caller set,
+# ARGV[4] their ttl in ms, ARGV[5] the caller; requests are only counted when allowed
+# Returns {allowed, remaining, ms until a rejected caller may retry, ms until the budget is full again, quota used}
+GCRA_SCRIPT = """
+local quota = tonumber(ARGV[3])
+local used = 0
+if quota > 0 then
+    used = tonumber(redis.call('GET', KEYS[2])) or 0
+    if used >= quota then
+        return {0, 0, 0, 0, used}
+    end
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local emission = tonumber(ARGV[1])
+local period = tonumber(ARGV[2])
+local tat = tonumber(redis.call('GET', KEYS[1])) or now
+if tat < now then
+    tat = now
+end
+local new_tat = tat + emission
+local allow_at = new_tat - period
+if allow_at > now then
+    return {0, 0, math.ceil(allow_at - now), math.ceil(tat - now), used}
+end
+local ttl = math.ceil(new_tat - now)
+redis.call('SET', KEYS[1], tostring(new_tat), 'PX', ttl)
+if quota > 0 then
+    used = redis.call('INCR', KEYS[2])
+    if used == 1 then
+        redis.call('PEXPIRE', KEYS[2], ARGV[4])
+        redis.call('SADD', KEYS[3], ARGV[5])
+        redis.call('PEXPIRE', KEYS[3], ARGV[4])
+    end
+end
+return {1, math.floor((period - (new_tat - now)) / emission), 0, ttl, used}
+"""
 
+REDIS_WARNING_INTERVAL = 30  # seconds between "falling back" warnings
+
+TRUSTED_PROXIES = tuple(ipaddress.ip_network(network) for network in settings.trusted_proxies)
+
+
+def _client_address(address: ipaddress.IPv4Address | ipaddress.IPv6Address) -> str:
+    if address.version == 4:
+        return str(address)
+    if address.ipv4_mapped:  # type: ignore[union-attr]
+        return str(address.ipv4_mapped)  # type: ignore[union-attr]
+    return str(ipaddress.ip_network((address, 64), strict=False))  # one budget per /64
+
+
+def client_address(request: Request) -> ipaddress.IPv4Address | ipaddress.IPv6Address | None:
+    """
+    The address that reached the first trusted proxy: ``X-Forwarded-For`` is
+    read right to left, skipping ``TRUSTED_PROXIES``, and only if the peer
+    itself is one of them. None if the peer is not an IP address.
+    """
+    try:
+        address = ipaddress.ip_address(request.client.host if request.client else "unknown")
+    except ValueError:
+        return None
+    if TRUSTED_PROXIES and any(address in network for network in TRUSTED_PROXIES):
+        for hop in reversed(request.headers.get("X-Forwarded-For", "").split(",")):
+            try:
+                address = ipaddress.ip_address(hop.strip())
+            except ValueError:
+                break  # garbled or spoofed entry, keep the last hop we trust
+            if not any(address in network for network in TRUSTED_PROXIES):
+                break
+    return address
+
+
+def client_ip(request: Request) -> str:
+    """``client_address`` as a rate limit key, IPv6 clients grouped by /64."""
+    address = client_address(request)
+    if address is None:
+        return request.client.host if request.client else "unknown"
+    return _client_address(address)
+
+
+def user_or_ip(request: Request) -> str:
+    claims = access_claims(request)
+    if claims is not None:
+        return f"user:{claims['sub']}"
+    return f"ip:{client_ip(request)}"
+
+
+def quota_key(day: str, caller: str) -> str:
+    return f"{QUOTA_PREFIX}:{day}:{caller}"
+
+
+def quota_callers_key(day: str) -> str:
+    return f"{QUOTA_PREFIX}:callers:{day}"
+
+
+class Quota:
+    """A caller's request allowance for the current UTC day."""
+    __slots__ = ("caller", "limit", "day", "reset_after")
+
+    def __init__(self, caller: str, limit: int) -> None:
+        now = time.time()
+        self.caller = caller
+        self.limit = limit
+        self.day = time.strftime("%Y%m%d", time.gmtime(now))
+        self.reset_after = 86_400 - now % 86_400  # seconds until UTC midnight
+
+
+    @property
+    def key(self) -> str:
+        return quota_key(self.day, self.caller)
+
+
+class RateLimitResult:
+    __slots__ = ("allowed", "limit", "remaining", "retry_after", "reset_after", "quota", "quota_used")
+
+    def __init__(self, allowed: bool, limit: RateLimitItem, remaining: int, retry_after: float,
+                 reset_after: float, quota: Quota | None = None, quota_used: int = 0) -> None:
+        self.allowed = allowed
+        self.limit = limit
+        self.remaining = remaining
+        self.retry_after = retry_after  # seconds until a rejected caller may retry
+        self.reset_after = reset_after  # seconds until the budget is full again
+        self.quota = quota
+        self.quota_used = quota_used
+
+
+    @property
+    def quota_exceeded(self) -> bool:
+        return not self.allowed and self.quota is not None and self.quota_used >= self.quota.limit
+
+
+    def error(self) -> str:
+        if self.quota_exceeded:
+            return f"Daily quota exceeded: {self.quota.limit} per day"  # type: ignore[union-attr]
+        return f"Rate limit exceeded: {self.limit}"
+
+
+    def headers(self) -> dict[str, str]:
+        headers = {}
+        if not self.quota_exceeded:
+            headers["X-RateLimit-Limit"] = str(self.limit.amount)
+            headers["X-RateLimit-Remaining"] = str(self.remaining)
+            headers["X-RateLimit-Reset"] = str(math.ceil(self.reset_after))
+        if self.quota is not None:
+            headers["X-Quota-Limit"] = str(self.quota.limit)
+            headers["X-Quota-Remaining"] = str(max(self.quota.limit - self.quota_used, 0))
+            headers["X-Quota-Reset"] = str(math.ceil(self.quota.reset_after))
+        if not self.allowed:
+            retry_after = self.quota.reset_after if self.quota_exceeded else self.retry_after  # type: ignore[union-attr]
+            headers["Retry-After"] = str(math.ceil(retry_after))
+        return headers
+
+
+class LocalGCRA:
+    """
+    In-process GCRA with the same semantics as ``GCRA_SCRIPT``, used while Redis
+    is unavailable. Holds at most ``max_keys`` budgets and as many daily quota
+    counters, evicting the least recently used (a full budget is the same as a
+    missing key; an evicted counter starts again from zero).
+    """
+    def __init__(self, max_keys: int = 100_000) -> None:
+        self.max_keys = max_keys
+        self._tats: OrderedDict[str, float] = OrderedDict()
+        self._used: OrderedDict[str, int] = OrderedDict()
+
+
+    def hit(self, key: str, limit: RateLimitItem, quota: Quota | None = None) -> RateLimitResult:
+        used = self._used.get(quota.key, 0) if quota is not None else 0
+        if quota is not None and used >= quota.limit:
+            return RateLimitResult(False, limit, 0, 0, 0, quota, used)
+
+        now = time.monotonic()
+        period = limit.get_expiry()
+        emission = period / limit.amount
+        tat = max(self._tats.get(key, now), now)
+        new_tat = tat + emission
+        allow_at = new_tat - period
+        if allow_at > now:
+            self._tats.move_to_end(key)
+            return RateLimitResult(False, limit, 0, allow_at - now, tat - now, quota, used)
+        self._tats[key] = new_tat
+        self._tats.move_to_end(key)
+        if len(self._tats) > self.max_keys:
+            _, evicted_tat = self._tats.popitem(last=False)
+            RATE_LIMIT_LOCAL_EVICTIONS.labels("expired" if evicted_tat <= now else "active").inc()
+        if quota is not None:
+            used += 1
+            self._used[quota.key] = used
+            self._used.move_to_end(quota.key)
+            if len(self._used) > self.max_keys:
+                self._used.popitem(last=False)
+                RATE_LIMIT_LOCAL_EVICTIONS.labels("quota").inc()
+        RATE_LIMIT_LOCAL_KEYS.set(len(self._tats) + len(self._used))
+        return RateLimitResult(True, limit, int((period - (new_tat - now)) / emission), 0, new_tat - now,
+                               quota, used)
+
+
+    def clear(self) -> None:
+        self._tats.clear()
+        self._used.clear()
+        RATE_LIMIT_LOCAL_KEYS.set(0)
+
+
+class RateLimiter:
+    def __init__(self, key_func: Callable[[Request], str], default_limit: str,
+                 route_limits: Mapping[str, str], max_local_keys: int = 100_000,
+                 tier_func: Callable[[Request], Awaitable[str | None]] | None = None,
+                 tier_limits: Mapping[str, Mapping[str, str]] | None = None,
+                 daily_quotas: Mapping[str, int] | None = None) -> None:
+        self.key_func = key_func
+        self.tier_func = tier_func  # caller's tier name, None for anonymous callers
+        self.enabled = True
+        self.default_limit = parse(default_limit)
+        self.route_limits = {route: parse(limit) for route, limit in route_limits.items()}
+        self.tier_limits = {
+            tier: {route: parse(limit) for route, limit in limits.items()}
+            for tier, limits in (tier_limits or {}).items()
+        }
+        self.daily_quotas = {tier: quota for tier, quota in (daily_quotas or {}).items() if quota}
+        self._exempt: set[str] = set()
+        self._local = LocalGCRA(max_local_keys)
+        self._script = None
+        self._script_client = None
+        self._redis_retry_at = 0.0
+        self._warned_at = 0.0
+
+
+    def exempt(self, endpoint: Callable) -> Callable:
+        """Decorator: the route is never rate limited."""
+        self._exempt.add(f"{endpoint.__module__}.{endpoint.__name__}")
+        return endpoint
+
+
+    def is_exempt(self, endpoint: Callable) -> bool:
+        return f"{endpoint.__module__}.{endpoint.__name__}" in self._exempt
+
+
+    def limit_for(self, route: str, tier: str | None = None) -> RateLimitItem:
+        """The tier's limit for the route, else the route's own, else the tier's default ("*"), else the default."""
+        tier_limits = self.tier_limits.get(tier, {}) if tier else {}
+        if route in tier_limits:
+            return tier_limits[route]
+        if route in self.route_limits:
+            return self.route_limits[route]
+        return tier_limits.get("*", self.default_limit)
+
+
+    async def check(self, request: Request, route: str) -> RateLimitResult:
+        caller = self.key_func(request)
+        tier = await self.tier_func(request) if self.tier_func is not None else None
+        daily_quota = self.daily_quotas.get(tier) if tier else None
+        return await self.hit(f"{KEY_PREFIX}:{route}:{caller}", self.limit_for(route, tier),
+                              Quota(caller, daily_quota) if daily_quota else None)
+
+
+    async def hit(self, key: str, limit: RateLimitItem, quota: Quota | None = None) -> RateLimitResult:
+        redis = get_redis() if time.monotonic() >= self._redis_retry_at else None
+        if redis is not None:
+            try:
+                return await self._hit_redis(redis, key, limit, quota)
+            except (RedisError, OSError):
+                self._redis_failed()
+        return self._local.hit(key, limit, quota)
+
+
+    def reset(self) -> None:
+        """Forget the in-process budgets and counters (Redis keys expire on their own)."""
+        self._local.clear()
+
+
+    def _redis_failed(self) -> None:
+        """Use the in-process store for ``REDIS_FAILURE_COOLDOWN`` seconds before trying Redis again."""
+        now = time.monotonic()
+        self._redis_retry_at = now + REDIS_FAILURE_COOLDOWN
+        if now - self._warned_at > REDIS_WARNING_INTERVAL:
+            self._warned_at = now
+            logger.warning("Redis unavailable, rate limits and quotas are enforced per process")
+
+
+    async def _hit_redis(self, redis, key: str, limit: RateLimitItem, quota: Quota | None) -> RateLimitResult:
+        if self._script_client is not redis:
+            self._script = redis.register_script(GCRA_SCRIPT)
+            self._script_client = redis
+        period_ms = limit.get_expiry() * 1000
+        keys, args = [key], [period_ms / limit.amount, period_ms, 0]
+        if quota is not None:
+            keys += [quota.key, quota_callers_key(quota.day)]
+            args = [period_ms / limit.amount, period_ms, quota.limit, QUOTA_KEY_TTL_MS, quota.caller]
+        allowed, remaining, retry_ms, reset_ms, used = await self._script(keys=keys, args=args)  # type: ignore[misc]
+        return RateLimitResult(bool(allowed), limit, int(remaining), retry_ms / 1000, reset_ms / 1000,
+                               quota, int(used))
+
+
+limiter = RateLimiter(
+    user_or_ip, settings.rate_limit_default, {**ROUTE_LIMITS, **settings.rate_limits},
+    settings.rate_limit_local_max_keys, resolve_tier, TIER_LIMITS, TIER_DAILY_QUOTAS,
+)
@@ -0,0 +1,35 @@
+"""
+Fast JSON responses for hot routes.
+
+For a plain return value FastAPI validates it against ``response_model``,
+dumps the model back to Python objects and encodes those with ``json.dumps``.
+A route that returns ``ModelResponse`` opts out of that: the value (ORM rows,
+or dicts holding them) is validated once with ``from_attributes`` by a cached
+``TypeAdapter`` and written straight to bytes by pydantic-core. Routes keep
+``response_model`` for the OpenAPI schema.
+
+    python -m benchmarks.json_responses
+"""
+from functools import lru_cache
+from typing import Any, Mapping
+from fastapi import Response
+from pydantic import TypeAdapter
+
+
+@lru_cache(maxsize=None)
+def adapter_for(tp: Any) -> TypeAdapter:
+    return TypeAdapter(tp)
+
+
+def dump_json(tp: Any, value: Any) -> bytes:
+    """Serialize ``value`` as ``tp`` (a response model or e.g. ``list[Model]``) to JSON bytes."""
+    adapter = adapter_for(tp)
+    return adapter.dump_json(adapter.validate_python(value, from_attributes=True))
+
+
+class ModelResponse(Response):
+    media_type = "application/json"
+
+    def __init__(self, tp: Any, content: Any, status_code: int = 200,
+                 headers: Mapping[str, str] | None = None) -> None:
+        super().__init__(dump_json(tp, content), status_code=status_code, headers=headers)
@@ -1,7 +1,44 @@
 from .celery_app import celery_app
 from datetime import datetime
+import httpx
+from aiosmtplib import SMTPException
+from src.async_task import AsyncTask
+from src.auth.emails import Emails
+from src.http_cache import purge_surrogate_keys
+
+
+# SMTP hiccups are retried with jittered exponential backoff (2s, 4s, ... capped at 10 min)
+EMAIL_RETRY_OPTIONS = {
+    "autoretry_for": (SMTPException, OSError),
+    "retry_backoff": 2,
+    "retry_backoff_max": 600,
+    "retry_jitter": True,
+    "max_retries": 5,
+}
+
 
 @celery_app.task
 def expire_subscriptions():
     print(f"Checking for expired subscriptions at {datetime.utcnow()}")
     # TODO: fetch subscriptions from DB and mark expired
+
+
+@celery_app.task(base=AsyncTask, **EMAIL_RETRY_OPTIONS)
+async def send_verification_email_task(email: str, user_id: str):
+    await Emails.send_verification_email(email, user_id)
+
+
+@celery_app.task(base=AsyncTask, **EMAIL_RETRY_OPTIONS)
+async def send_password_reset_email_task(email: str, user_id: str):
+    await Emails.send_password_reset_email(email, user_id)
+
+
+@celery_app.task(base=AsyncTask, **EMAIL_RETRY_OPTIONS)
+async def send_login_code_task(email: str, code: str):
+    await Emails.send_login_code(email, code)
+
+
+@celery_app.task(base=AsyncTask, autoretry_for=(httpx.HTTPError,), retry_backoff=2,
+                 retry_backoff_max=300, retry_jitter=True, max_retries=5)
+async def purge_surrogate_keys_task(keys: list[str]):
+    await purge_surrogate_keys(keys)
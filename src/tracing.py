@@ -0,0 +1,99 @@
+"""
+OpenTelemetry tracing.
+
+``setup_tracing`` installs a tracer provider with parent-based head sampling
+(``TRACING_SAMPLE_RATIO`` of new traces; children follow their parent's
+decision) and a batch exporter: ``otlp`` (OTLP/HTTP, endpoint from the standard
+``OTEL_EXPORTER_OTLP_*`` variables), ``file`` (JSON lines in ``TRACING_FILE``)
+or ``console``. It then instruments SQLAlchemy, httpx (OAuth, Stripe, CDN
+purges) and Celery, which carries the trace context in task headers so
+worker spans join the request that enqueued them. ``TRACING_EXPORTER`` unset
+leaves everything uninstrumented.
+
+The API calls it at import and instruments the FastAPI app; Celery calls it
+in each worker process (after the fork, since the exporter runs a thread).
+"""
+import logging
+import threading
+from typing import Sequence
+from fastapi import FastAPI
+from opentelemetry import trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import ReadableSpan, TracerProvider
+from opentelemetry.sdk.trace.export import (
+    BatchSpanProcessor, ConsoleSpanExporter, SpanExporter, SpanExportResult,
+)
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+from src.config import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class JsonLinesSpanExporter(SpanExporter):
+    """Appends one JSON object per finished span to a local file."""
+    def __init__(self, path: str) -> None:
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        lines = "".join(span.to_json(indent=None) + "\n" for span in spans)
+        with self._lock:
+            self._file.write(lines)
+            self._file.flush()
+        return SpanExportResult.SUCCESS
+
+
+    def shutdown(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+def _exporter(kind: str) -> SpanExporter:
+    if kind == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        return OTLPSpanExporter()
+    if kind == "file":
+        return JsonLinesSpanExporter(settings.tracing_file)
+    if kind == "console":
+        return ConsoleSpanExporter()
+    raise ValueError(f"Unknown TRACING_EXPORTER {kind!r}, expected otlp, file or console")
+
+
+def setup_tracing(component: str, exporter: SpanExporter | None = None) -> TracerProvider | None:
+    """Install the tracer provider and library instrumentation for this process."""
+    if exporter is None and not settings.tracing_exporter:
+        return None
+
+    provider = TracerProvider(
+        resource=Resource.create({"service.name": settings.app_name, "service.component": component}),
+        sampler=ParentBased(TraceIdRatioBased(settings.tracing_sample_ratio)),
+    )
+    provider.add_span_processor(BatchSpanProcessor(exporter or _exporter(settings.tracing_exporter)))  # type: ignore[arg-type]
+    trace.set_tracer_provider(provider)
+
+    from opentelemetry.instrumentation.celery import CeleryInstrumentor
+    from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
+    from opentelemetry.instrumentation.sqlalchemy import SQLAlchemyInstrumentor
+    from src.database import engine, sync_engine
+
+    SQLAlchemyInstrumentor().instrument(engines=[engine.sync_engine, sync_engine], tracer_provider=provider)
+    HTTPXClientInstrumentor().instrument(tracer_provider=provider)
+    CeleryInstrumentor().instrument(tracer_provider=provider)
+    logger.info("Tracing %s spans to %s, sampling %s of new traces",
+                component, settings.tracing_exporter or type(exporter).__name__, settings.tracing_sample_ratio)
+    return provider
+
+
+def instrument_app(app: FastAPI) -> None:
+    if isinstance(trace.get_tracer_provider(), TracerProvider):
+        from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+        FastAPIInstrumentor.instrument_app(app, excluded_urls="metrics")
+
+
+def shutdown_tracing() -> None:
+    """Flush spans still waiting in the batch processor."""
+    provider = trace.get_tracer_provider()
+    if isinstance(provider, TracerProvider):
+        provider.shutdown()
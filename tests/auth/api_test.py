@@ -1,27 +1,29 @@
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import AsyncMock, MagicMock
 from httpx import AsyncClient
 from fastapi import status
+from src.main import app
 
 
 
 @pytest.mark.asyncio
-async def test_register_user_success(client: AsyncClient):
-    with patch("src.auth.emails.Emails.send_verification_email") as mock_send_email:
-        payload = {
-            "email": "sam@example.com",
-            "username": "sam",
-            "password": "password123"
-        }
+async def test_register_user_success(client: AsyncClient, mock_email_tasks):
+    payload = {
+        "email": "sam@example.com",
+        "username": "sam",
+        "password": "password123"
+    }
 
-        response = await client.post("/register", json=payload)
-        assert response.status_code == 201
-        mock_send_email.assert_called_once()
-        args, kwargs = mock_send_email.call_args
-        assert args[0] == "sam@example.com"
-        data = response.json()
-        assert data["email"] == payload["email"]
-        assert data["username"] == payload["username"]
+    response = await client.post("/register", json=payload)
+    assert response.status_code == 201
+    delay = mock_email_tasks["send_verification_email_task"].delay
+    delay.assert_called_once()
+    args, kwargs = delay.call_args
+    assert args[0] == "sam@example.com"
+    data = response.json()
+    assert data["email"] == payload["email"]
+    assert data["username"] == payload["username"]
+    assert args[1] == data["id"]
 
 
 @pytest.mark.asyncio
@@ -90,6 +92,21 @@ async def test_login_user_invalid_password(client: AsyncClient, active_user):
     assert response.json()["detail"] == "Invalid email or password"
 
 
+@pytest.mark.asyncio
+async def test_login_is_refused_without_verifying_after_repeated_failures(client: AsyncClient, active_user, monkeypatch):
+    wrong = {"email": active_user.email, "password": "wrongpassword"}
+    statuses = [(await client.post("/login", json=wrong)).status_code for _ in range(6)]
+    verify = AsyncMock()
+    monkeypatch.setattr("src.auth.service.verify_password", verify)
+
+    response = await client.post("/login", json={"email": active_user.email, "password": "123456"})
+
+    assert statuses == [status.HTTP_401_UNAUTHORIZED] * 6
+    assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    assert response.headers["Retry-After"] == "1"
+    verify.assert_not_called()
+
+
 @pytest.mark.asyncio
 async def test_login_user_inactive(client: AsyncClient, disabled_user):
     payload = {
@@ -159,4 +176,94 @@ async def test_change_password_success(client: AsyncClient, logged_in_user):
     headers = {"Authorization": f"Bearer {logged_in_user['token']}"}
     response = await client.post("/change-password", json=change_password_payload, headers=headers)
     assert response.status_code == status.HTTP_200_OK
-    assert response.json()["message"] == "Password has been changed successfuly"
\ No newline at end of file
+    assert response.json()["message"] == "Password has been changed successfuly"
+
+
+@pytest.mark.asyncio
+async def test_cors_preflight_skips_logging_and_rate_limit(client: AsyncClient, monkeypatch):
+    record = MagicMock()
+    monkeypatch.setattr("src.middleware.access_log.record", record)
+    monkeypatch.setattr(app.state.limiter, "enabled", True)
+    app.state.limiter.reset()
+
+    for _ in range(10):
+        response = await client.options("/login", headers={
+            "Origin": "https://app.example.com", "Access-Control-Request-Method": "POST",
+        })
+        assert response.status_code == status.HTTP_200_OK
+        assert response.headers["access-control-allow-origin"] == "https://app.example.com"
+
+    record.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_default_rate_limit_and_request_log(client: AsyncClient, monkeypatch):
+    record = MagicMock()
+    monkeypatch.setattr("src.middleware.access_log.record", record)
+    monkeypatch.setattr(app.state.limiter, "enabled", True)
+    app.state.limiter.reset()
+
+    responses = [await client.get("/verify", params={"token": "bad"}) for _ in range(6)]
+    statuses = [response.status_code for response in responses]
+
+    assert statuses[-1] == status.HTTP_429_TOO_MANY_REQUESTS
+    assert status.HTTP_429_TOO_MANY_REQUESTS not in statuses[:5]
+    assert responses[0].headers["X-RateLimit-Limit"] == "5"
+    assert responses[0].headers["X-RateLimit-Remaining"] == "4"
+    assert int(responses[-1].headers["Retry-After"]) > 0
+    assert record.call_count == 6
+    method, route, status_code, _, client, _ = record.call_args.args
+    assert (method, route, status_code, client) == ("GET", "/verify", 429, "127.0.0.1")
+    app.state.limiter.reset()
+
+
+@pytest.mark.asyncio
+async def test_access_log_records_route_template(client: AsyncClient, monkeypatch):
+    record = MagicMock()
+    monkeypatch.setattr("src.middleware.access_log.record", record)
+
+    await client.get("/billing/plans/00000000-0000-0000-0000-000000000000")
+
+    assert record.call_args.args[1] == "/billing/plans/{plan_id}"
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint_reports_routes_and_rejections(client: AsyncClient, monkeypatch):
+    monkeypatch.setattr(app.state.limiter, "enabled", True)
+    app.state.limiter.reset()
+    for _ in range(6):
+        await client.get("/verify", params={"token": "bad"})
+    app.state.limiter.reset()
+    await client.get("/no-such-page")
+
+    response = await client.get("/metrics")
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"].startswith("text/plain")
+    body = response.text
+    assert 'http_request_duration_seconds_count{method="GET",route="/verify",status="429"}' in body
+    assert 'route="<unmatched>"' in body and "/no-such-page" not in body
+    assert 'rate_limit_rejections_total{route="/verify"}' in body
+    assert "http_requests_in_progress" in body
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint_requires_allowed_network_or_token(client: AsyncClient, monkeypatch):
+    monkeypatch.setattr("src.dependencies.METRICS_ALLOWED_NETWORKS", ())
+    monkeypatch.setattr("src.dependencies.settings.metrics_token", "scrape-secret")
+
+    assert (await client.get("/metrics")).status_code == status.HTTP_403_FORBIDDEN
+    assert (await client.get("/metrics", headers={"Authorization": "Bearer wrong"})).status_code == 403
+    response = await client.get("/metrics", headers={"Authorization": "Bearer scrape-secret"})
+    assert response.status_code == status.HTTP_200_OK
+
+
+@pytest.mark.asyncio
+async def test_register_user_succeeds_when_the_broker_is_down(client: AsyncClient, mock_email_tasks):
+    mock_email_tasks["send_verification_email_task"].delay.side_effect = ConnectionError("broker down")
+
+    response = await client.post("/register", json={"email": "offline@example.com", "username": "offline",
+                                                    "password": "password123"})
+
+    assert response.status_code == 201
+    mock_email_tasks["send_verification_email_task"].delay.assert_called_once()
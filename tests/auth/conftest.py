@@ -1,4 +1,5 @@
 import pytest
+from unittest.mock import MagicMock
 from uuid import uuid4
 from sqlalchemy import select
 from src.hashing import hash_password
@@ -7,6 +8,16 @@ from src.auth.models import User, Provider
 
 
 
+@pytest.fixture(autouse=True)
+def mock_email_tasks(monkeypatch):
+    """Auth emails are queued on Celery; keep the broker out of tests."""
+    mocks = {}
+    for name in ("send_verification_email_task", "send_password_reset_email_task", "send_login_code_task"):
+        mocks[name] = MagicMock()
+        monkeypatch.setattr(f"src.auth.router.{name}", mocks[name])
+    return mocks
+
+
 @pytest.fixture()
 async def active_user():
     async with TestSessionDB() as session:
@@ -1,3 +1,7 @@
+import asyncio
+import ipaddress
+import json
+import logging
 import pytest
 from uuid import uuid4
 from datetime import datetime, timedelta, timezone, UTC
@@ -9,7 +13,19 @@ from src.hashing import verify_password, hash_password
 from src.jwt import generate_token, verify_token
 from src.auth.service import UserService
 from src.auth.models import User, Provider, LoginCode
-from src.auth.schemas import UserCreateRequest, UserLoginRequest, NewPasswordRequest, ChangePasswordRequest, LoginCodeRequest, LoginWithCodeRequest
+from aiosmtplib import SMTPException
+from src.tasks import send_login_code_task
+from src.async_task import close_worker_loop
+from src.responses import ModelResponse
+from src.access_log import AccessLog
+from limits import parse
+from redis.exceptions import ConnectionError as RedisConnectionError
+from src.config import settings
+from src.rate_limiter import LocalGCRA, RateLimiter, user_or_ip
+from src.auth.throttle import LoginAttempts, LoginThrottle
+from loguru import logger
+from src.logging import InterceptHandler, json_sink
+from src.auth.schemas import UserLoginResponse, UserCreateRequest, UserLoginRequest, NewPasswordRequest, ChangePasswordRequest, LoginCodeRequest, LoginWithCodeRequest
 
 
 @pytest.mark.asyncio
@@ -975,3 +991,222 @@ async def test_login_with_github_existing_user():
         repo.create.assert_not_called()
 
 
+
+
+@pytest.mark.asyncio
+async def test_login_code_task_retries_on_smtp_error(monkeypatch):
+    calls = []
+
+    async def _send(email, code):
+        calls.append((email, code))
+        if len(calls) < 3:
+            raise SMTPException("temporary failure")
+
+    monkeypatch.setattr("src.tasks.Emails.send_login_code", _send)
+
+    result = await asyncio.to_thread(send_login_code_task.apply, args=("user@test.com", "123456"))
+    await asyncio.to_thread(close_worker_loop)
+
+    assert result.successful()
+    assert calls == [("user@test.com", "123456")] * 3
+
+
+@pytest.mark.asyncio
+async def test_model_response_serializes_orm_objects():
+    user = User(id=uuid4(), email="jane@example.com", username="jane", provider=Provider.LOCAL)
+
+    response = ModelResponse(UserLoginResponse, {"token": "abc", "user": user}, status_code=201)
+
+    assert response.status_code == 201
+    assert response.headers["content-type"] == "application/json"
+    assert response.body == UserLoginResponse.model_validate({"token": "abc", "user": user},
+                                                             from_attributes=True).model_dump_json().encode()
+
+
+@pytest.mark.asyncio
+async def test_access_log_samples_by_status_class_and_writes_json_lines(tmp_path, monkeypatch):
+    path = tmp_path / "access.log"
+    access_log = AccessLog({2: 0.0, 4: 0.5}, str(path), flush_interval=0.01)
+    monkeypatch.setattr("src.access_log.random.random", lambda: 0.25)
+
+    access_log.record("GET", "/billing/plans", 200, 1.234, "10.0.0.1")
+    access_log.record("GET", "/verify", 404, 2.0, "10.0.0.1")
+    access_log.record("POST", "/login", 500, 3.0, "10.0.0.2")
+    access_log.close()
+
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [(line["route"], line["status"], line["sample_rate"]) for line in lines] == [
+        ("/verify", 404, 0.5), ("/login", 500, 1.0),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_stdlib_records_reach_json_sink_with_logger_name(capfd):
+    sink_id = logger.add(json_sink, format="{message}", filter=lambda record: record["extra"].get("logger") == "uvicorn.test")
+    stdlib = logging.getLogger("uvicorn.test")
+    stdlib.handlers = [InterceptHandler(caller_info=False)]
+    stdlib.propagate = False
+    try:
+        stdlib.warning("slow request %s", "/billing/plans")
+    finally:
+        logger.remove(sink_id)
+
+    lines = [json.loads(line) for line in capfd.readouterr().out.splitlines() if line.startswith("{")]
+    assert lines[-1]["logger"] == "uvicorn.test"
+    assert lines[-1]["level"] == "WARNING"
+    assert lines[-1]["msg"] == "slow request /billing/plans"
+    assert "extra" not in lines[-1]
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_allows_burst_then_reports_retry_after(monkeypatch):
+    monkeypatch.setattr("src.rate_limiter.get_redis", lambda: None)
+    limiter = RateLimiter(lambda request: "10.0.0.1", "5/minute", {"/billing/plans": "2/minute"})
+    limit = limiter.limit_for("/billing/plans")
+
+    results = [await limiter.hit("rl:/billing/plans:10.0.0.1", limit) for _ in range(3)]
+
+    assert [result.allowed for result in results] == [True, True, False]
+    assert [result.remaining for result in results] == [1, 0, 0]
+    assert results[0].headers() == {"X-RateLimit-Limit": "2", "X-RateLimit-Remaining": "1", "X-RateLimit-Reset": "30"}
+    assert results[2].headers()["Retry-After"] == "30"
+    assert (await limiter.hit("rl:/billing/plans:10.0.0.2", limit)).allowed
+    assert limiter.limit_for("/verify").amount == 5
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_falls_back_to_process_memory_when_redis_fails(monkeypatch):
+    script = AsyncMock(side_effect=RedisConnectionError("down"))
+
+    class BrokenRedis:
+        def register_script(self, source):
+            return script
+
+    monkeypatch.setattr("src.rate_limiter.get_redis", lambda: BrokenRedis())
+    limiter = RateLimiter(lambda request: "10.0.0.1", "1/minute", {})
+
+    first = await limiter.hit("rl:/verify:10.0.0.1", limiter.default_limit)
+    second = await limiter.hit("rl:/verify:10.0.0.1", limiter.default_limit)
+
+    assert (first.allowed, second.allowed) == (True, False)
+    assert script.await_count == 1  # cooling down, the second hit didn't wait on Redis
+
+    limiter._redis_retry_at = 0.0
+    await limiter.hit("rl:/verify:10.0.0.1", limiter.default_limit)
+    assert script.await_count == 2
+
+
+def _request(client: str, headers: dict[str, str] | None = None) -> StarletteRequest:
+    return StarletteRequest({
+        "type": "http", "client": (client, 50000),
+        "headers": [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()],
+    })
+
+
+@pytest.mark.asyncio
+async def test_rate_limit_key_is_token_subject_or_client_ip(monkeypatch):
+    first, _, _ = generate_token({"sub": "user-1"}, 5, settings.access_secret_key)
+    rotated, _, _ = generate_token({"sub": "user-1"}, 5, settings.access_secret_key)
+    forged, _, _ = generate_token({"sub": "user-1"}, 5, "not-the-secret")
+
+    assert user_or_ip(_request("10.0.0.1", {"Authorization": f"Bearer {first}"})) == "user:user-1"
+    assert user_or_ip(_request("10.0.0.1", {"Authorization": f"Bearer {rotated}"})) == "user:user-1"
+    assert user_or_ip(_request("10.0.0.1", {"Authorization": f"Bearer {forged}"})) == "ip:10.0.0.1"
+    assert user_or_ip(_request("2001:db8:1:2::beef")) == "ip:2001:db8:1:2::/64"
+
+    spoofed = {"X-Forwarded-For": "1.2.3.4, 203.0.113.7, 10.0.0.2"}
+    assert user_or_ip(_request("198.51.100.9", spoofed)) == "ip:198.51.100.9"
+    monkeypatch.setattr("src.rate_limiter.TRUSTED_PROXIES", (ipaddress.ip_network("10.0.0.0/8"),))
+    assert user_or_ip(_request("10.0.0.3", spoofed)) == "ip:203.0.113.7"
+    assert user_or_ip(_request("10.0.0.3", {"X-Forwarded-For": "garbage"})) == "ip:10.0.0.3"
+
+
+@pytest.mark.asyncio
+async def test_local_rate_limit_store_evicts_least_recently_used_budget():
+    local = LocalGCRA(max_keys=2)
+    limit = parse("1/minute")
+
+    local.hit("a", limit)
+    local.hit("b", limit)
+    assert not local.hit("a", limit).allowed  # "a" becomes most recently used
+    local.hit("c", limit)
+
+    assert not local.hit("a", limit).allowed
+    assert local.hit("b", limit).allowed  # evicted, so its budget is full again
+
+
+@pytest.mark.asyncio
+async def test_login_throttle_backs_off_per_email_and_ip(monkeypatch):
+    monkeypatch.setattr("src.auth.throttle.get_redis", lambda: None)
+    monkeypatch.setattr("src.auth.throttle.LOGIN_THROTTLE_FREE_FAILURES", {"email": 2, "ip": 3, "subnet": 100})
+    throttle = LoginThrottle()
+
+    for _ in range(2):
+        await throttle.failed("Sam@Example.com", "10.0.0.1")
+    await throttle.check("sam@example.com", "10.0.0.1")
+    await throttle.failed("sam@example.com ", "10.0.0.1")  # third failure for the email: locked for 1s
+
+    with pytest.raises(HTTPException) as exc:
+        await throttle.check("sam@example.com", "10.0.0.2")
+    assert exc.value.status_code == 429
+    assert exc.value.headers == {"Retry-After": "1"}
+
+    await throttle.succeeded("sam@example.com", "10.0.0.1")
+    await throttle.check("sam@example.com", "10.0.0.2")
+    await throttle.failed("other@example.com", "10.0.0.1")  # fourth failure for the IP
+    with pytest.raises(HTTPException):
+        await throttle.check("new@example.com", "10.0.0.1")
+    assert throttle.scopes("a@b.c", "10.0.0.1")["subnet"] == "10.0.0.0/24"
+    assert throttle.scopes("a@b.c", "2001:db8:1:2::/64")["subnet"] == "2001:db8:1::/48"
+
+
+@pytest.mark.asyncio
+async def test_login_throttle_reads_lock_ttls_from_redis(monkeypatch):
+    ttls = {"email": 2500, "ip": -2, "subnet": -2}
+
+    class Pipeline:
+        def __init__(self):
+            self.keys = []
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            return False
+
+        def pttl(self, key):
+            self.keys.append(key)
+
+        async def execute(self):
+            return [ttls[key.split(":")[2]] for key in self.keys]
+
+    class FakeRedis:
+        def pipeline(self, transaction=True):
+            return Pipeline()
+
+    monkeypatch.setattr("src.auth.throttle.get_redis", lambda: FakeRedis())
+    throttle = LoginThrottle()
+
+    with pytest.raises(HTTPException) as exc:
+        await throttle.check("sam@example.com", "10.0.0.1")
+    assert exc.value.headers == {"Retry-After": "3"}
+
+    ttls["email"] = -2
+    await throttle.check("sam@example.com", "10.0.0.1")
+
+
+@pytest.mark.asyncio
+async def test_login_user_rejects_locked_attempt_before_lookup():
+    repo = AsyncMock()
+    attempts = AsyncMock(spec=LoginAttempts)
+    attempts.check.side_effect = HTTPException(status_code=429, detail="Too many failed login attempts.")
+
+    with patch("src.auth.service.verify_password", new_callable=AsyncMock) as mock_verify:
+        with pytest.raises(HTTPException) as exc:
+            await UserService.login_user(UserLoginRequest(email="sam@example.com", password="123456"),
+                                         repo, AsyncMock(), attempts)
+
+    assert exc.value.status_code == 429
+    repo.get_by_email.assert_not_called()
+    mock_verify.assert_not_called()
+    attempts.failed.assert_not_called()
@@ -1,12 +1,15 @@
 import json
-from datetime import datetime, timedelta, timezone
-from types import SimpleNamespace
 import pytest
 from fastapi import status
 from httpx import AsyncClient
 from uuid import uuid4
-from unittest.mock import ANY, AsyncMock
-from src.billing.utils import serialize_subscription
+from unittest.mock import Mock
+from src.billing.models import StripeEvent
+from src.billing.quotas import plan_tier_cache
+from src.main import app
+from tests.conftest import TestSessionDB
+from src.billing.webhooks import sign_payload
+from src.config import settings
 
 
 @pytest.mark.asyncio
@@ -71,6 +74,49 @@ async def test_get_plan_by_id(client: AsyncClient, test_plan):
     assert data["code"] == test_plan.code
 
 
+@pytest.mark.asyncio
+async def test_list_plans_etag_returns_304(client: AsyncClient, test_plan):
+    first = await client.get("/billing/plans")
+    etag = first.headers["ETag"]
+
+    response = await client.get("/billing/plans", headers={"If-None-Match": etag})
+
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert response.content == b""
+    assert response.headers["ETag"] == etag
+
+
+@pytest.mark.asyncio
+async def test_get_plan_etag_returns_304(client: AsyncClient, test_plan):
+    first = await client.get(f"/billing/plans/{test_plan.id}")
+
+    response = await client.get(f"/billing/plans/{test_plan.id}", headers={"If-None-Match": f'W/{first.headers["ETag"]}'})
+
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+
+@pytest.mark.asyncio
+async def test_plans_are_cacheable_by_cdn(client: AsyncClient, test_plan):
+    listing = await client.get("/billing/plans")
+    single = await client.get(f"/billing/plans/{test_plan.id}")
+
+    assert listing.headers["Cache-Control"].startswith("public")
+    assert listing.headers["Surrogate-Key"] == "plans"
+    assert single.headers["Surrogate-Key"] == f"plans plan-{test_plan.id}"
+
+
+@pytest.mark.asyncio
+async def test_plan_changes_rebuild_catalog(client: AsyncClient, admin_headers, test_plan, plan_payload):
+    before = await client.get("/billing/plans")
+
+    created = await client.post("/billing/plans", json=plan_payload, headers=admin_headers)
+    response = await client.get("/billing/plans", headers={"If-None-Match": before.headers["ETag"]})
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["ETag"] != before.headers["ETag"]
+    assert created.json()["id"] in [plan["id"] for plan in response.json()]
+
+
 @pytest.mark.asyncio
 async def test_update_plan(client: AsyncClient, admin_headers, test_plan):
     payload = {
@@ -145,6 +191,18 @@ async def test_get_my_subscription(
     assert data["status"] == "active"
 
 
+@pytest.mark.asyncio
+async def test_get_my_subscription_etag_returns_304(client: AsyncClient, user_headers, test_subscription):
+    first = await client.get("/billing/subscriptions/me", headers=user_headers)
+    assert first.headers["Cache-Control"] == "private, no-cache"
+
+    response = await client.get("/billing/subscriptions/me",
+                                headers={**user_headers, "If-None-Match": first.headers["ETag"]})
+
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert response.content == b""
+
+
 @pytest.mark.asyncio
 async def test_cancel_subscription(
     client: AsyncClient, user_headers, test_subscription
@@ -172,76 +230,51 @@ async def test_subscribe_to_plan_starts_checkout(client: AsyncClient, logged_in_
 
 
 @pytest.mark.asyncio
-async def test_stripe_webhook_checkout_triggers_email(
+async def test_stripe_webhook_stores_event_and_acks(
     client: AsyncClient,
+    db_session,
     mock_user_subscribe,
-    monkeypatch,
+    mock_process_stripe_event_task,
 ):
     event_payload = {
+        "id": f"evt_{uuid4().hex}",
         "type": "checkout.session.completed",
         "data": {"object": {"id": "cs_test", "subscription": "sub_123", "customer": "cus_123"}},
     }
-    run_mock = AsyncMock(return_value=event_payload)
-    monkeypatch.setattr("src.billing.service.run_in_threadpool", run_mock)
+    content = json.dumps(event_payload).encode()
 
     response = await client.post(
         "/billing/stripe/webhook",
-        content=json.dumps(event_payload),
-        headers={"Stripe-Signature": "sig"},
+        content=content,
+        headers={"Stripe-Signature": sign_payload(content, settings.stripe_webhook_secret)},
     )
 
     assert response.status_code == status.HTTP_200_OK
     assert response.json() is True
-    mock_user_subscribe.assert_awaited_once_with(event_payload["data"]["object"], ANY, ANY)
+    stored = await db_session.get(StripeEvent, event_payload["id"])
+    assert stored.type == "checkout.session.completed"
+    assert stored.payload == event_payload
+    mock_process_stripe_event_task.assert_called_once_with(event_payload["id"])
+    mock_user_subscribe.assert_not_awaited()
 
 
 @pytest.mark.asyncio
-async def test_stripe_webhook_invoice_payment_triggers_update_email(
+async def test_stripe_webhook_redelivery_is_enqueued_once(
     client: AsyncClient,
-    mock_send_update_subscription_email_task,
-    monkeypatch,
+    mock_process_stripe_event_task,
 ):
-    invoice = {
-        "lines": {
-            "data": [
-                {"parent": {"subscription_item_details": {"subscription": "sub_123"}}}
-            ]
-        },
-        "billing_reason": "subscription_cycle",
-        "id": "in_test",
-        "amount_paid": 5000,
-        "currency": "usd",
-    }
-    event_payload = {"type": "invoice.payment_succeeded", "data": {"object": invoice}}
-    run_mock = AsyncMock(return_value=event_payload)
-    monkeypatch.setattr("src.billing.service.run_in_threadpool", run_mock)
-
-    updated_sub = SimpleNamespace(
-        id=uuid4(),
-        user=SimpleNamespace(email="e", username="u"),
-        plan=SimpleNamespace(name="Plan", price_cents=5000),
-        started_at=datetime.now(timezone.utc),
-        current_period_end=datetime.now(timezone.utc) + timedelta(days=30),
-    )
-    handle_payment_mock = AsyncMock(return_value=updated_sub)
-    monkeypatch.setattr(
-        "src.billing.service.StripeGateway.handle_invoice_payment_succeeded",
-        handle_payment_mock,
-    )
-    record_payment_mock = AsyncMock()
-    monkeypatch.setattr("src.billing.service.StripeGateway.record_invoice_payment", record_payment_mock)
+    event_payload = {"id": f"evt_{uuid4().hex}", "type": "invoice.payment_failed", "data": {"object": {}}}
+    content = json.dumps(event_payload).encode()
 
-    response = await client.post(
-        "/billing/stripe/webhook",
-        content=json.dumps(event_payload),
-        headers={"Stripe-Signature": "sig"},
-    )
+    for _ in range(2):
+        response = await client.post(
+            "/billing/stripe/webhook",
+            content=content,
+            headers={"Stripe-Signature": sign_payload(content, settings.stripe_webhook_secret)},
+        )
+        assert response.status_code == status.HTTP_200_OK
 
-    assert response.status_code == status.HTTP_200_OK
-    assert response.json() is True
-    handle_payment_mock.assert_awaited_once_with(invoice, ANY)
-    mock_send_update_subscription_email_task.assert_called_once_with(serialize_subscription(updated_sub))
-    record_payment_mock.assert_awaited_once_with(invoice, updated_sub, ANY)
+    mock_process_stripe_event_task.assert_called_once_with(event_payload["id"])
 
 
 @pytest.mark.asyncio
@@ -261,3 +294,51 @@ async def test_get_my_payments_not_found(client: AsyncClient, user_headers, clea
 
     assert response.status_code == status.HTTP_200_OK
     assert response.json() == []
+
+
+@pytest.mark.asyncio
+async def test_get_my_payments_etag_returns_304(client: AsyncClient, user_headers, test_payment):
+    first = await client.get("/billing/payments/me", headers=user_headers)
+    assert first.headers["Cache-Control"] == "private, no-cache"
+
+    response = await client.get("/billing/payments/me", headers={**user_headers, "If-None-Match": first.headers["ETag"]})
+
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+
+@pytest.mark.asyncio
+async def test_server_timing_reports_db_queries(client: AsyncClient, user_headers, test_payment, monkeypatch):
+    record = Mock()
+    monkeypatch.setattr("src.middleware.access_log.record", record)
+    monkeypatch.setattr("src.middleware.settings.server_timing_enabled", True)
+
+    response = await client.get("/billing/payments/me", headers=user_headers)
+
+    timing = response.headers["Server-Timing"]
+    assert timing.startswith("db;dur=") and "db-pool;dur=" in timing and "app;dur=" in timing
+    stats = record.call_args.args[5]
+    assert stats.queries >= 2  # current user, payments version, payments
+    assert f'desc="{stats.queries} queries"' in timing
+    assert stats.slowest_statement.startswith("SELECT")
+
+
+@pytest.mark.asyncio
+async def test_authenticated_requests_spend_daily_quota_of_their_tier(
+    client: AsyncClient, user_headers, test_subscription, monkeypatch
+):
+    monkeypatch.setattr("src.billing.quotas.async_session", TestSessionDB)
+    monkeypatch.setattr(app.state.limiter, "enabled", True)
+    app.state.limiter.reset()
+    plan_tier_cache.clear()
+
+    await client.get("/billing/subscriptions/me", headers=user_headers)
+    response = await client.get("/billing/subscriptions/me", headers=user_headers)
+    anonymous = await client.get("/billing/plans")
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["X-Quota-Limit"] == str(app.state.limiter.daily_quotas["FREE"])
+    assert int(response.headers["X-Quota-Remaining"]) == app.state.limiter.daily_quotas["FREE"] - 2
+    assert response.headers["X-RateLimit-Limit"] == "30"
+    assert "X-Quota-Limit" not in anonymous.headers
+    app.state.limiter.reset()
+    plan_tier_cache.clear()
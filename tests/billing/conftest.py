@@ -7,6 +7,7 @@ from sqlalchemy import select, update, delete
 from src.hashing import hash_password
 from tests.conftest import TestSessionDB
 from src.auth.models import User, Provider
+from src.billing.catalog import plan_catalog
 from src.billing.models import Plan, BillingPeriod, Subscription, SubscriptionStatus, PaymentProvider, Payment, PaymentStatus
 
 
@@ -30,9 +31,16 @@ def mock_create_checkout(monkeypatch):
 
 @pytest.fixture(autouse=True)
 def mock_stripe_product_price(monkeypatch):
-    monkeypatch.setattr("src.billing.stripe_gateway.stripe.Product.update", lambda *args, **kwargs: {"id": "prod_test"})
-    monkeypatch.setattr("src.billing.stripe_gateway.stripe.Price.create", lambda *args, **kwargs: SimpleNamespace(id="price_test_new"))
-    monkeypatch.setattr("src.billing.stripe_gateway.stripe.Price.modify", lambda *args, **kwargs: None)
+    responses = {
+        "products.update": {"id": "prod_test"},
+        "prices.create": SimpleNamespace(id="price_test_new"),
+        "prices.update": None,
+    }
+    async def _call(path, *args, **kwargs):
+        return responses[path]
+    mock = AsyncMock(side_effect=_call)
+    monkeypatch.setattr("src.billing.stripe_gateway.stripe_api.call", mock)
+    return mock
 
 
 @pytest.fixture(autouse=True)
@@ -45,19 +53,27 @@ def mock_cancel_at_period_end(monkeypatch):
 
 
 @pytest.fixture(autouse=True)
-def mock_send_subscription_email_task(monkeypatch):
-    """Stub Celery task to avoid hitting a broker and allow assertions."""
+def mock_send_subscription_emails_task(monkeypatch):
+    """Stub the task the outbox relay publishes to, so no broker is needed."""
     delay_mock = MagicMock()
     task_mock = MagicMock(delay=delay_mock)
-    monkeypatch.setattr("src.billing.service.send_subscription_email_task", task_mock)
+    monkeypatch.setattr("src.billing.outbox.send_subscription_emails_task", task_mock)
     return delay_mock
 
 
 @pytest.fixture(autouse=True)
-def mock_send_update_subscription_email_task(monkeypatch):
+def reset_plan_catalog():
+    """Plans are inserted straight into the database by fixtures, start each test from a fresh catalog."""
+    plan_catalog.invalidate()
+    yield
+    plan_catalog.invalidate()
+
+
+@pytest.fixture(autouse=True)
+def mock_process_stripe_event_task(monkeypatch):
     delay_mock = MagicMock()
     task_mock = MagicMock(delay=delay_mock)
-    monkeypatch.setattr("src.billing.service.send_update_subscription_email_task", task_mock)
+    monkeypatch.setattr("src.billing.service.process_stripe_event_task", task_mock)
     return delay_mock
 
 
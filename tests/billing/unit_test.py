@@ -1,17 +1,51 @@
+import asyncio
+import json
+import math
+import os
+import sys
+import time
+import httpx
 import pytest
+import stripe
 from uuid import uuid4
+from contextlib import asynccontextmanager
 from types import SimpleNamespace
 from datetime import datetime, timezone, timedelta
-from fastapi import HTTPException
-from unittest.mock import AsyncMock, Mock, ANY
+from fastapi import FastAPI, HTTPException, Request
+from unittest.mock import AsyncMock, Mock, MagicMock, ANY
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from src.db_stats import QueryStats, TimedAsyncAdaptedQueuePool, request_stats
 
 from src.billing.service import PlanService, SubscriptionService
-from src.billing.schemas import PlanCreate, PlanUpdate
-from src.billing.models import BillingPeriod, PaymentProvider
-from src.billing.utils import serialize_subscription
-
-
-pytestmark = pytest.mark.asyncio
+from src.billing.stripe_gateway import StripeGateway
+from src.billing.stripe_client import StripeAPI, TokenBucket
+from src.billing.schemas import PlanCreate, PlanUpdate, StripeCheckoutSession, StripeInvoice, StripeSubscription
+from src.billing.webhooks import construct_event, sign_payload, verify_signature, WebhookVerificationError
+from benchmarks.stripe_emulator import StripeEmulator
+from src.billing.models import BillingPeriod, PaymentProvider, PaymentStatus, Plan, PlanTier, Subscription, SubscriptionStatus, OutboxMessage, ApiUsage
+from src.billing.catalog import plan_catalog, VERSION_KEY
+from src.billing.constants import PLAN_CATALOG_CHECK_INTERVAL, PLAN_CATALOG_TTL
+from src.billing.repository import SubscriptionRepoistory, StripeEventRepository, PaymentRepository
+from src.billing.outbox import relay_outbox_batch
+from src.auth.models import User, Provider
+from tests.conftest import TestSessionDB, TestSyncSessionDB, test_engine
+from src.billing.tasks import (
+    send_subscription_email_task, send_subscription_emails_task, expire_subscriptions_task, persist_api_usage_task,
+)
+from src.billing.quotas import plan_tier_cache, resolve_tier
+from src.rate_limiter import RateLimiter, quota_callers_key, quota_key
+from src.jwt import generate_token
+from starlette.requests import Request as StarletteRequest
+from src.async_task import close_worker_loop
+from src.billing.emails import Emails
+from src.mail import MailTransport, templates
+from aiosmtplib import SMTPServerDisconnected
+from src.config import settings
+from src.utils import conf
+
+
+_save_plan_to_stripe = StripeGateway.save_plan_to_stripe
 
 
 def _dummy_request(payload: bytes = b"{}"):
@@ -24,14 +58,77 @@ def _dummy_request(payload: bytes = b"{}"):
     return DummyRequest(payload)
 
 
+def _plan(**overrides):
+    data = dict(id=uuid4(), name="Basic", code="BASIC", price_cents=1000, currency="USD",
+                billing_period=BillingPeriod.MONTHLY, tier=PlanTier.FREE, is_active=True,
+                stripe_product_id="prod_1", stripe_price_id="price_1")
+    data.update(overrides)
+    return Plan(**data)
+
+
 async def test_retrieve_plans():
+    basic, pro = _plan(), _plan(code="PRO", price_cents=2000)
+    retired = _plan(code="OLD", is_active=False)
     repo = Mock()
-    repo.list_plans = AsyncMock(return_value=["p1", "p2"])
+    repo.list_plans = AsyncMock(return_value=[basic, pro, retired])
+
+    catalog = await PlanService.retrive_plans(repo)
+    again = await PlanService.retrive_plans(repo)
+
+    assert again is catalog
+    repo.list_plans.assert_awaited_once_with(active_only=False)
+    assert [plan["code"] for plan in json.loads(catalog.body)] == ["BASIC", "PRO"]
+    assert set(catalog.by_code) == {"BASIC", "PRO"}
+    assert catalog.by_id[retired.id].code == "OLD"
+    assert json.loads(catalog.plan_bodies[pro.id][0])["price_cents"] == 2000
+
+
+async def test_plan_catalog_rebuild_changes_etag():
+    plan = _plan()
+    repo = Mock(list_plans=AsyncMock(return_value=[plan]))
+    before = await PlanService.retrive_plans(repo)
+
+    repo.list_plans.return_value = [_plan(id=plan.id, price_cents=1500)]
+    after = await plan_catalog.rebuild(repo)
+
+    assert await PlanService.retrive_plans(repo) is after
+    assert after.etag != before.etag
+    assert after.plan_bodies[plan.id][1] != before.plan_bodies[plan.id][1]
+
 
-    result = await PlanService.retrive_plans(repo)
+async def test_plan_catalog_reloads_after_ttl_without_redis(monkeypatch):
+    repo = Mock(list_plans=AsyncMock(return_value=[_plan()]))
+    clock = [1000.0]
+    monkeypatch.setattr("src.billing.catalog.time.monotonic", lambda: clock[0])
+    monkeypatch.setattr("src.billing.catalog.get_redis", lambda: None)
 
-    assert result == ["p1", "p2"]
-    repo.list_plans.assert_awaited_once()
+    await plan_catalog.get(repo)
+    clock[0] += PLAN_CATALOG_TTL - 1
+    await plan_catalog.get(repo)
+    assert repo.list_plans.await_count == 1
+
+    clock[0] += 1
+    await plan_catalog.get(repo)
+    assert repo.list_plans.await_count == 2
+
+
+async def test_plan_catalog_follows_version_published_in_redis(monkeypatch):
+    redis = _FakeRedis()
+    repo = Mock(list_plans=AsyncMock(return_value=[_plan()]))
+    clock = [1000.0]
+    monkeypatch.setattr("src.billing.catalog.time.monotonic", lambda: clock[0])
+    monkeypatch.setattr("src.billing.catalog.get_redis", lambda: redis)
+
+    catalog = await plan_catalog.rebuild(repo)
+    assert redis.store[VERSION_KEY] == catalog.version
+
+    clock[0] += PLAN_CATALOG_CHECK_INTERVAL
+    assert await plan_catalog.get(repo) is catalog
+
+    redis.store[VERSION_KEY] = b"published-by-another-process"
+    clock[0] += PLAN_CATALOG_CHECK_INTERVAL
+    assert await plan_catalog.get(repo) is not catalog
+    assert repo.list_plans.await_count == 2
 
 
 async def test_create_plan_updates_stripe_ids(monkeypatch):
@@ -41,6 +138,7 @@ async def test_create_plan_updates_stripe_ids(monkeypatch):
     repo.create = AsyncMock(return_value=created_plan)
     updated_plan = SimpleNamespace(id=created_plan.id, stripe_product_id="prod_1", stripe_price_id="price_1")
     repo.update = AsyncMock(return_value=updated_plan)
+    repo.list_plans = AsyncMock(return_value=[])
 
     stripe_mock = AsyncMock(return_value=SimpleNamespace(stripe_product_id="prod_1", stripe_price_id="price_1"))
     monkeypatch.setattr("src.billing.service.StripeGateway.save_plan_to_stripe", stripe_mock)
@@ -51,6 +149,7 @@ async def test_create_plan_updates_stripe_ids(monkeypatch):
 
     assert result == updated_plan
     repo.update.assert_awaited_once_with(created_plan, {"stripe_product_id": "prod_1", "stripe_price_id": "price_1"})
+    repo.list_plans.assert_awaited_once_with(active_only=False)
 
 
 async def test_create_plan_skips_stripe_when_failing(monkeypatch):
@@ -59,6 +158,7 @@ async def test_create_plan_skips_stripe_when_failing(monkeypatch):
     created_plan = SimpleNamespace(id=uuid4())
     repo.create = AsyncMock(return_value=created_plan)
     repo.update = AsyncMock()
+    repo.list_plans = AsyncMock(return_value=[])
 
     monkeypatch.setattr("src.billing.service.StripeGateway.save_plan_to_stripe", AsyncMock(return_value=None))
 
@@ -85,7 +185,7 @@ async def test_create_plan_duplicate_code():
 
 async def test_get_plan_not_found():
     repo = Mock()
-    repo.get_by_id = AsyncMock(return_value=None)
+    repo.list_plans = AsyncMock(return_value=[_plan()])
 
     with pytest.raises(HTTPException):
         await PlanService.get_plan_by_id(uuid4(), repo)
@@ -96,6 +196,7 @@ async def test_update_plan_success(monkeypatch):
     repo = Mock()
     repo.get_by_id = AsyncMock(return_value=plan)
     repo.update = AsyncMock(return_value={"updated": True})
+    repo.list_plans = AsyncMock(return_value=[])
 
     update_data = {"price_cents": 25}
     monkeypatch.setattr("src.billing.service.StripeGateway.update_plan_in_stripe", AsyncMock(return_value=update_data))
@@ -106,6 +207,7 @@ async def test_update_plan_success(monkeypatch):
 
     assert result == {"updated": True}
     repo.update.assert_awaited_once_with(plan, update_data)
+    repo.list_plans.assert_awaited_once_with(active_only=False)
 
 
 async def test_soft_delete_plan_success():
@@ -113,10 +215,30 @@ async def test_soft_delete_plan_success():
     repo = Mock()
     repo.get_by_id = AsyncMock(return_value=plan)
     repo.soft_delete = AsyncMock()
+    repo.list_plans = AsyncMock(return_value=[])
 
     await PlanService.soft_delete_plan(uuid4(), repo)
 
     repo.soft_delete.assert_awaited_once()
+    repo.list_plans.assert_awaited_once_with(active_only=False)
+
+
+async def test_plan_changes_purge_cdn_when_configured(monkeypatch):
+    plan_id = uuid4()
+    repo = Mock()
+    repo.get_by_id = AsyncMock(return_value=Mock(is_active=True))
+    repo.soft_delete = AsyncMock()
+    repo.list_plans = AsyncMock(return_value=[])
+    purge = Mock()
+    monkeypatch.setattr("src.billing.service.purge_surrogate_keys_task.delay", purge)
+
+    monkeypatch.setattr("src.billing.service.settings.cdn_purge_url", None)
+    await PlanService.soft_delete_plan(plan_id, repo)
+    purge.assert_not_called()
+
+    monkeypatch.setattr("src.billing.service.settings.cdn_purge_url", "https://cdn.example.com/purge")
+    await PlanService.soft_delete_plan(plan_id, repo)
+    purge.assert_called_once_with(["plans", f"plan-{plan_id}"])
 
 
 async def test_soft_delete_already_deleted():
@@ -168,7 +290,7 @@ async def test_subscribe_user_success(monkeypatch):
 
     plan = SimpleNamespace()
     plan_repo = Mock()
-    plan_repo.get_by_code = AsyncMock(return_value=plan)
+    monkeypatch.setattr("src.billing.service.plan_catalog.get_by_code", AsyncMock(return_value=plan))
 
     user_repo = Mock()
 
@@ -195,12 +317,12 @@ async def test_subscribe_user_already_has_subscription():
     assert exc.value.detail == "User already has an active subscription."
 
 
-async def test_subscribe_user_plan_not_found():
+async def test_subscribe_user_plan_not_found(monkeypatch):
     sub_repo = Mock()
     sub_repo.get_subscription_with_access = AsyncMock(return_value=None)
 
     plan_repo = Mock()
-    plan_repo.get_by_code = AsyncMock(return_value=None)
+    monkeypatch.setattr("src.billing.service.plan_catalog.get_by_code", AsyncMock(return_value=None))
 
     with pytest.raises(HTTPException) as exc:
         await SubscriptionService.subscribe_user_to_plan(
@@ -294,7 +416,7 @@ async def test_upgrade_subscription_success(monkeypatch):
 
     new_plan = SimpleNamespace(id=uuid4(), code="NEW")
     plan_repo = Mock()
-    plan_repo.get_by_code = AsyncMock(return_value=new_plan)
+    monkeypatch.setattr("src.billing.service.plan_catalog.get_by_code", AsyncMock(return_value=new_plan))
 
     user_repo = Mock()
     checkout_mock = AsyncMock(return_value="https://stripe.test/upgrade")
@@ -306,14 +428,14 @@ async def test_upgrade_subscription_success(monkeypatch):
     checkout_mock.assert_awaited_once_with(user, new_plan, user_repo, current_sub.provider_subscription_id)
 
 
-async def test_upgrade_subscription_same_plan():
+async def test_upgrade_subscription_same_plan(monkeypatch):
     plan_id = uuid4()
     current_sub = SimpleNamespace(plan_id=plan_id)
     sub_repo = Mock()
     sub_repo.get_subscription_with_access = AsyncMock(return_value=current_sub)
 
     plan_repo = Mock()
-    plan_repo.get_by_code = AsyncMock(return_value=SimpleNamespace(id=plan_id))
+    monkeypatch.setattr("src.billing.service.plan_catalog.get_by_code", AsyncMock(return_value=SimpleNamespace(id=plan_id)))
 
     with pytest.raises(HTTPException) as exc:
         await SubscriptionService.upgrade_subscription(SimpleNamespace(id=uuid4()), "CODE", sub_repo, plan_repo, Mock())
@@ -321,12 +443,12 @@ async def test_upgrade_subscription_same_plan():
     assert exc.value.detail == "You are already on this plan."
 
 
-async def test_upgrade_subscription_plan_not_found():
+async def test_upgrade_subscription_plan_not_found(monkeypatch):
     sub_repo = Mock()
     sub_repo.get_subscription_with_access = AsyncMock(return_value=SimpleNamespace(plan_id=uuid4()))
 
     plan_repo = Mock()
-    plan_repo.get_by_code = AsyncMock(return_value=None)
+    monkeypatch.setattr("src.billing.service.plan_catalog.get_by_code", AsyncMock(return_value=None))
 
     with pytest.raises(HTTPException) as exc:
         await SubscriptionService.upgrade_subscription(SimpleNamespace(id=uuid4()), "CODE", sub_repo, plan_repo, Mock())
@@ -344,26 +466,23 @@ async def test_upgrade_subscription_no_active():
     assert exc.value.detail == "No active subscription to upgrade."
 
 
-async def test_stripe_webhook_checkout_creates_subscription(monkeypatch, mock_user_subscribe):
+async def test_handle_stripe_event_checkout_creates_subscription(mock_user_subscribe):
     event = {
         "type": "checkout.session.completed",
         "data": {"object": {"id": "cs_test", "subscription": "sub_123", "customer": "cus_123"}},
     }
-    run_mock = AsyncMock(return_value=event)
-    monkeypatch.setattr("src.billing.service.run_in_threadpool", run_mock)
-
-    request = _dummy_request(b"{}")
     sub_repo = Mock()
     plan_repo = Mock()
     payment_repo = Mock()
 
-    result = await SubscriptionService.stripe_webhook(request, "sig", sub_repo, plan_repo, payment_repo)
+    result = await SubscriptionService.handle_stripe_event(event, sub_repo, plan_repo, payment_repo)
 
     assert result is None
-    mock_user_subscribe.assert_awaited_once_with(event["data"]["object"], sub_repo, plan_repo)
+    mock_user_subscribe.assert_awaited_once_with(
+        StripeCheckoutSession(subscription="sub_123", customer="cus_123"), sub_repo, plan_repo)
 
 
-async def test_stripe_webhook_invoice_payment(monkeypatch, mock_send_update_subscription_email_task):
+async def test_handle_stripe_event_invoice_payment(monkeypatch):
     invoice = {
         "lines": {
             "data": [
@@ -376,8 +495,6 @@ async def test_stripe_webhook_invoice_payment(monkeypatch, mock_send_update_subs
         "currency": "usd",
     }
     event = {"type": "invoice.payment_succeeded", "data": {"object": invoice}}
-    run_mock = AsyncMock(return_value=event)
-    monkeypatch.setattr("src.billing.service.run_in_threadpool", run_mock)
 
     updated_sub = SimpleNamespace(
         id=uuid4(),
@@ -397,42 +514,935 @@ async def test_stripe_webhook_invoice_payment(monkeypatch, mock_send_update_subs
         record_payment_mock,
     )
 
-    request = _dummy_request(b"{}")
     sub_repo = Mock()
     payment_repo = Mock()
 
-    result = await SubscriptionService.stripe_webhook(request, "sig", sub_repo, Mock(), payment_repo)
+    result = await SubscriptionService.handle_stripe_event(event, sub_repo, Mock(), payment_repo)
 
     assert result is None
-    handle_payment_mock.assert_awaited_once_with(invoice, sub_repo)
-    mock_send_update_subscription_email_task.assert_called_once_with(serialize_subscription(updated_sub))
-    record_payment_mock.assert_awaited_once_with(invoice, updated_sub, payment_repo)
+    invoice_view = StripeInvoice(id="in_test", billing_reason="subscription_cycle", amount_paid=5000,
+                                 currency="usd", has_lines=True, subscription_id="sub_123")
+    handle_payment_mock.assert_awaited_once_with(invoice_view, sub_repo)
+    record_payment_mock.assert_awaited_once_with(invoice_view, updated_sub, payment_repo)
 
 
-async def test_stripe_webhook_subscription_deleted(monkeypatch):
+async def test_handle_stripe_event_subscription_deleted(monkeypatch):
     event = {"type": "customer.subscription.deleted", "data": {"object": {"id": "sub_123"}}}
-    run_mock = AsyncMock(return_value=event)
-    monkeypatch.setattr("src.billing.service.run_in_threadpool", run_mock)
 
     handler = AsyncMock()
     monkeypatch.setattr("src.billing.service.StripeGateway.handle_subscription_deleted", handler)
 
-    request = _dummy_request(b"{}")
     sub_repo = Mock()
     payment_repo = Mock()
 
-    result = await SubscriptionService.stripe_webhook(request, "sig", sub_repo, Mock(), payment_repo)
+    result = await SubscriptionService.handle_stripe_event(event, sub_repo, Mock(), payment_repo)
+
+    assert result is None
+    handler.assert_awaited_once_with(StripeSubscription(id="sub_123"), sub_repo)
+
+
+def _invoice(period: dict | None = None):
+    line = {"parent": {"subscription_item_details": {"subscription": "sub_123"}}}
+    if period is not None:
+        line["period"] = period
+    return StripeInvoice.model_validate({"lines": {"data": [line]}, "billing_reason": "subscription_cycle"})
+
+
+async def test_invoice_payment_succeeded_reads_period_from_invoice_line(monkeypatch):
+    retrieve = AsyncMock(side_effect=AssertionError("should not call Stripe"))
+    monkeypatch.setattr("src.billing.stripe_gateway.stripe_api.call", retrieve)
+    sub_repo = Mock(update_subscription_period=AsyncMock(return_value="sub"))
+
+    result = await StripeGateway.handle_invoice_payment_succeeded(_invoice({"start": 1700000000, "end": 1702592000}), sub_repo)
+
+    assert result == "sub"
+    kwargs = sub_repo.update_subscription_period.await_args.kwargs
+    assert kwargs["current_period_start"] == datetime.fromtimestamp(1700000000, tz=timezone.utc)
+    assert kwargs["current_period_end"] == datetime.fromtimestamp(1702592000, tz=timezone.utc)
+    assert kwargs["notify"] == "subscription_update"
+
+
+async def test_invoice_payment_succeeded_falls_back_to_cached_retrieve(monkeypatch):
+    stripe_subscription = {"items": {"data": [{"current_period_start": 1700000000, "current_period_end": 1702592000}]}}
+    retrieve = AsyncMock(return_value=stripe_subscription)
+    monkeypatch.setattr("src.billing.stripe_gateway.stripe_api.call", retrieve)
+    monkeypatch.setattr("src.billing.stripe_gateway._subscription_cache", {})
+    sub_repo = Mock(update_subscription_period=AsyncMock(return_value="sub"))
+
+    await StripeGateway.handle_invoice_payment_succeeded(_invoice(), sub_repo)
+    await StripeGateway.handle_invoice_payment_succeeded(_invoice(), sub_repo)
+
+    retrieve.assert_awaited_once_with("subscriptions.retrieve", "sub_123")
+    kwargs = sub_repo.update_subscription_period.await_args.kwargs
+    assert kwargs["current_period_end"] == datetime.fromtimestamp(1702592000, tz=timezone.utc)
+
+
+async def test_user_subscribe_reads_metadata_from_session(monkeypatch):
+    retrieve = AsyncMock(side_effect=AssertionError("should not call Stripe"))
+    monkeypatch.setattr("src.billing.stripe_gateway.stripe_api.call", retrieve)
+    plan = SimpleNamespace(id=uuid4())
+    plan_repo = Mock(get_by_id=AsyncMock(return_value=plan))
+    sub_repo = Mock(create_subscription=AsyncMock(return_value="sub"))
+    session = StripeCheckoutSession(client_reference_id="user-1", subscription="sub_123", customer="cus_1",
+                                    metadata={"plan_id": str(plan.id)})
+
+    result = await StripeGateway.user_subscribe(session, sub_repo, plan_repo)
+
+    assert result == "sub"
+    plan_repo.get_by_id.assert_awaited_once_with(str(plan.id))
+    sub_repo.create_subscription.assert_awaited_once_with("user-1", plan, PaymentProvider.STRIPE, "sub_123", "cus_1")
+
+
+
+async def test_soft_delete_plan_in_stripe_updates_product_and_price_concurrently(monkeypatch):
+    in_flight, peak = 0, 0
+
+    async def call(path, *args, **kwargs):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+
+    monkeypatch.setattr("src.billing.stripe_gateway.stripe_api.call", call)
+    plan = SimpleNamespace(stripe_product_id="prod_1", stripe_price_id="price_1")
+
+    await StripeGateway.soft_delete_plan_in_stripe(plan)
+
+    assert peak == 2
+
+
+async def test_save_plan_to_stripe_sends_idempotency_keys(monkeypatch):
+    call = AsyncMock(side_effect=[SimpleNamespace(id="prod_1"), SimpleNamespace(id="price_1")])
+    monkeypatch.setattr("src.billing.stripe_gateway.stripe_api.call", call)
+    plan = SimpleNamespace(id=uuid4(), name="Pro", price_cents=1000, currency="usd",
+                           stripe_product_id=None, stripe_price_id=None)
+
+    # the autouse mock_save_stripe_plan fixture replaces the method on the class
+    result = await _save_plan_to_stripe(plan)
+
+    assert (result.stripe_product_id, result.stripe_price_id) == ("prod_1", "price_1")
+    product_call, price_call = call.await_args_list
+    assert product_call.kwargs["idempotency_key"] == f"plan:{plan.id}:product"
+    assert price_call.kwargs["idempotency_key"] == f"plan:{plan.id}:price:1000:usd:month"
+
+
+async def test_token_bucket_throttles_after_burst(monkeypatch):
+    sleeps = []
+
+    async def fake_sleep(seconds):
+        sleeps.append(seconds)
+        bucket._tokens += seconds * bucket.rate
+
+    monkeypatch.setattr("src.billing.stripe_client.asyncio.sleep", fake_sleep)
+    bucket = TokenBucket(rate=10, capacity=2)
+
+    for _ in range(3):
+        await bucket.acquire()
+
+    assert len(sleeps) == 1
+    assert sleeps[0] == pytest.approx(0.1, abs=0.01)
+
+
+async def test_stripe_api_retries_rate_limited_calls(monkeypatch):
+    api = StripeAPI("sk_test", max_concurrency=2, rate=1000, max_retries=2, timeout=1)
+    method = AsyncMock(side_effect=[stripe.RateLimitError("slow down"), {"id": "cus_1"}])
+    monkeypatch.setattr(api, "_method", lambda client, path: method)
+    monkeypatch.setattr("src.billing.stripe_client.random.uniform", lambda a, b: 0)
+
+    result = await api.call("customers.create", params={"email": "a@b.c"}, idempotency_key="user:1:customer")
+
+    assert result == {"id": "cus_1"}
+    assert method.await_count == 2
+    method.assert_awaited_with(params={"email": "a@b.c"}, options={"idempotency_key": "user:1:customer"})
+    await api.close()
+
+
+async def test_stripe_api_gives_up_after_max_retries(monkeypatch):
+    api = StripeAPI("sk_test", max_concurrency=2, rate=1000, max_retries=1, timeout=1)
+    method = AsyncMock(side_effect=stripe.RateLimitError("slow down"))
+    monkeypatch.setattr(api, "_method", lambda client, path: method)
+    monkeypatch.setattr("src.billing.stripe_client.random.uniform", lambda a, b: 0)
+
+    with pytest.raises(stripe.RateLimitError):
+        await api.call("customers.create")
+
+    assert method.await_count == 2
+    await api.close()
+
+
+def test_stripe_api_closes_the_previous_pool_on_a_new_loop(monkeypatch):
+    api = StripeAPI("sk_test", max_concurrency=2, rate=1000, max_retries=0, timeout=1)
+    monkeypatch.setattr(api, "_method", lambda client, path: AsyncMock(return_value={"id": "cus_1"}))
+
+    asyncio.run(api.call("customers.create"))
+    first = api._http
+    close_async = AsyncMock()
+    monkeypatch.setattr(first, "close_async", close_async)
+    asyncio.run(api.call("customers.create"))
+
+    close_async.assert_awaited_once()
+    assert api._http is not first
+    asyncio.run(api.close())
+
+
+async def test_gateway_against_stripe_emulator(monkeypatch):
+    received = []
+    receiver = FastAPI()
+
+    @receiver.post("/webhook")
+    async def webhook(request: Request):
+        received.append(construct_event(await request.body(), request.headers["Stripe-Signature"],
+                                        settings.stripe_webhook_secret))
+
+    emulator = StripeEmulator(webhook_url="http://app/webhook", webhook_transport=httpx.ASGITransport(receiver))
+    async with emulator.serve() as base_url:
+        api = StripeAPI("sk_test", max_concurrency=4, rate=1000, max_retries=0, timeout=5, base_url=base_url)
+        monkeypatch.setattr("src.billing.stripe_gateway.stripe_api", api)
+        plan = SimpleNamespace(id=uuid4(), name="Pro", price_cents=1500, currency="usd",
+                               stripe_product_id=None, stripe_price_id=None)
+        user = SimpleNamespace(id=uuid4(), email="jane@test.com", stripe_customer_id=None)
+
+        async def _update(user, **data):
+            user.stripe_customer_id = data["stripe_customer_id"]
+            return user
+
+        await _save_plan_to_stripe(plan)
+        await StripeGateway.ensure_customer(user, Mock(update=AsyncMock(side_effect=_update)))
+        session = await api.call("checkout.sessions.create", params={
+            "mode": "subscription", "customer": user.stripe_customer_id, "client_reference_id": str(user.id),
+            "line_items": [{"price": plan.stripe_price_id, "quantity": 1}], "metadata": {"plan_id": str(plan.id)},
+        })
+        await emulator.drain()
+        await StripeGateway.soft_delete_plan_in_stripe(plan)
+        await api.close()
+    await emulator.close()
+
+    assert [event["type"] for event in received] == ["checkout.session.completed", "invoice.payment_succeeded"]
+    completed = StripeCheckoutSession.model_validate(received[0]["data"]["object"])
+    invoice = StripeInvoice.model_validate(received[1]["data"]["object"])
+    assert completed.metadata == {"plan_id": str(plan.id)}
+    assert completed.customer == user.stripe_customer_id
+    assert invoice.subscription_id == completed.subscription
+    assert invoice.amount_paid == 1500
+    assert session.url.endswith(session.id)
+    assert emulator.objects[plan.stripe_product_id]["active"] is False
+    assert emulator.objects[plan.stripe_price_id]["active"] is False
+
+
+async def test_stripe_emulator_replays_idempotent_creates():
+    emulator = StripeEmulator()
+    async with emulator.serve() as base_url:
+        api = StripeAPI("sk_test", max_concurrency=4, rate=1000, max_retries=0, timeout=5, base_url=base_url)
+        first = await api.call("customers.create", params={"email": "a@b.c"}, idempotency_key="user:1:customer")
+        second = await api.call("customers.create", params={"email": "a@b.c"}, idempotency_key="user:1:customer")
+        await api.close()
+
+    assert first.id == second.id
+    assert len(emulator.objects) == 1
+
+def _event_repo(**overrides):
+    processing = MagicMock()
+    processing.return_value.__aenter__.return_value = SimpleNamespace(payload={"type": "x", "data": {"object": {}}})
+    methods = {
+        "save": AsyncMock(return_value=True),
+        "get": AsyncMock(return_value=None),
+        "is_processed_cached": AsyncMock(return_value=False),
+        "claim": AsyncMock(return_value=True),
+        "release": AsyncMock(),
+        "processing": processing,
+        "mark_failed": AsyncMock(),
+    }
+    methods.update(overrides)
+    return Mock(**methods)
+
+
+def _signed(event: dict) -> tuple[bytes, str]:
+    payload = json.dumps(event).encode()
+    return payload, sign_payload(payload, settings.stripe_webhook_secret)
+
+
+async def test_stripe_webhook_stores_event_and_enqueues(mock_process_stripe_event_task):
+    event = {"id": "evt_1", "type": "invoice.payment_failed", "data": {"object": {}}}
+    payload, signature = _signed(event)
+    event_repo = _event_repo()
+
+    result = await SubscriptionService.stripe_webhook(_dummy_request(payload), signature, event_repo)
+
+    assert result is None
+    event_repo.save.assert_awaited_once_with("evt_1", "invoice.payment_failed", event)
+    mock_process_stripe_event_task.assert_called_once_with("evt_1")
+
+
+async def test_stripe_webhook_acks_when_the_broker_is_down(mock_process_stripe_event_task):
+    event = {"id": "evt_1", "type": "invoice.payment_failed", "data": {"object": {}}}
+    payload, signature = _signed(event)
+    event_repo = _event_repo()
+    mock_process_stripe_event_task.side_effect = ConnectionError("broker down")
+
+    result = await SubscriptionService.stripe_webhook(_dummy_request(payload), signature, event_repo)
 
     assert result is None
-    handler.assert_awaited_once_with(event["data"]["object"], sub_repo)
+    event_repo.save.assert_awaited_once()
+
+
+async def test_stripe_webhook_duplicate_event_is_not_enqueued(mock_process_stripe_event_task):
+    event = {"id": "evt_1", "type": "invoice.payment_failed", "data": {"object": {}}}
+    payload, signature = _signed(event)
+    event_repo = _event_repo(save=AsyncMock(return_value=False))
+
+    await SubscriptionService.stripe_webhook(_dummy_request(payload), signature, event_repo)
+
+    mock_process_stripe_event_task.assert_not_called()
+
+
+async def test_process_stripe_event_marks_processed(monkeypatch):
+    event = SimpleNamespace(payload={"type": "x", "data": {"object": {}}}, processed_at=None)
+    event_repo = _event_repo(get=AsyncMock(return_value=event))
+    handler = AsyncMock()
+    monkeypatch.setattr("src.billing.service.SubscriptionService.handle_stripe_event", handler)
+
+    await SubscriptionService.process_stripe_event("evt_1", event_repo, Mock(), Mock(), Mock())
+
+    handler.assert_awaited_once()
+    event_repo.processing.assert_called_once_with("evt_1")
+    event_repo.processing.return_value.__aexit__.assert_awaited_once_with(None, None, None)
+    event_repo.mark_failed.assert_not_awaited()
+
+
+async def test_process_stripe_event_records_failure(monkeypatch):
+    event = SimpleNamespace(payload={"type": "x", "data": {"object": {}}}, processed_at=None)
+    event_repo = _event_repo(get=AsyncMock(return_value=event))
+    monkeypatch.setattr("src.billing.service.SubscriptionService.handle_stripe_event",
+                        AsyncMock(side_effect=RuntimeError("stripe down")))
+
+    with pytest.raises(RuntimeError):
+        await SubscriptionService.process_stripe_event("evt_1", event_repo, Mock(), Mock(), Mock())
+
+    event_repo.mark_failed.assert_awaited_once_with("evt_1", "RuntimeError('stripe down')")
+    exc_type, _, _ = event_repo.processing.return_value.__aexit__.await_args.args
+    assert exc_type is RuntimeError  # the transaction with processed_at is rolled back
+    event_repo.release.assert_awaited_once_with("evt_1")
+
+
+async def test_process_stripe_event_skips_processed_event(monkeypatch):
+    event = SimpleNamespace(payload={}, processed_at=datetime.now(timezone.utc))
+    event_repo = _event_repo(get=AsyncMock(return_value=event))
+    handler = AsyncMock()
+    monkeypatch.setattr("src.billing.service.SubscriptionService.handle_stripe_event", handler)
+
+    await SubscriptionService.process_stripe_event("evt_1", event_repo, Mock(), Mock(), Mock())
+
+    handler.assert_not_awaited()
+    event_repo.processing.assert_not_called()
+
+
+async def test_process_stripe_event_redelivery_hits_fast_path(monkeypatch):
+    event_repo = _event_repo(is_processed_cached=AsyncMock(return_value=True))
+    handler = AsyncMock()
+    monkeypatch.setattr("src.billing.service.SubscriptionService.handle_stripe_event", handler)
+
+    await SubscriptionService.process_stripe_event("evt_1", event_repo, Mock(), Mock(), Mock())
+
+    event_repo.get.assert_not_awaited()
+    handler.assert_not_awaited()
+
+
+async def test_process_stripe_event_skips_event_claimed_elsewhere(monkeypatch):
+    event = SimpleNamespace(payload={}, processed_at=None)
+    event_repo = _event_repo(get=AsyncMock(return_value=event), claim=AsyncMock(return_value=False))
+    handler = AsyncMock()
+    monkeypatch.setattr("src.billing.service.SubscriptionService.handle_stripe_event", handler)
+
+    await SubscriptionService.process_stripe_event("evt_1", event_repo, Mock(), Mock(), Mock())
+
+    handler.assert_not_awaited()
+    event_repo.release.assert_not_awaited()
+
+
+async def test_create_payment_ignores_duplicate_invoice(normal_user):
+    invoice_id = f"in_{uuid4().hex}"
+    async with TestSessionDB() as session:
+        repo = PaymentRepository(session)
+        first = await repo.create_payment(user_id=normal_user.id, subscription_id=None, provider_invoice_id=invoice_id,
+                                          amount_cents=5000, currency="USD", status=PaymentStatus.SUCCEEDED)
+        second = await repo.create_payment(user_id=normal_user.id, subscription_id=None, provider_invoice_id=invoice_id,
+                                           amount_cents=5000, currency="USD", status=PaymentStatus.SUCCEEDED)
+
+    assert second.id == first.id
+
+
+class _FakeRedis:
+    def __init__(self):
+        self.store = {}
+
+    async def exists(self, key):
+        return int(key in self.store)
+
+    async def get(self, key):
+        value = self.store.get(key)
+        return value.encode() if isinstance(value, str) else value
+
+    async def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.store:
+            return None
+        self.store[key] = value
+        return True
+
+    async def delete(self, key):
+        self.store.pop(key, None)
+
+    async def smembers(self, key):
+        return {member.encode() for member in self.store.get(key, set())}
+
+    async def mget(self, keys):
+        return [await self.get(key) for key in keys]
+
+
+@asynccontextmanager
+async def _event_session():
+    """A session set up like process_stripe_event_task's, on the test database."""
+    async with test_engine.connect() as connection:
+        async with AsyncSession(bind=connection, join_transaction_mode="create_savepoint",
+                                expire_on_commit=False) as session:
+            yield session
+
+
+async def test_stripe_event_repository_redis_fast_path():
+    event_id = f"evt_{uuid4().hex}"
+    async with _event_session() as session:
+        repo = StripeEventRepository(session)
+        repo.redis = _FakeRedis()
+        await repo.save(event_id, "invoice.paid", {"id": event_id})
+
+        assert await repo.is_processed_cached(event_id) is False
+        assert await repo.claim(event_id) is True
+        assert await repo.claim(event_id) is False
+        async with repo.processing(event_id) as event:
+            assert event.id == event_id
+        await repo.release(event_id)
+
+        assert await repo.is_processed_cached(event_id) is True
+        assert await repo.claim(event_id) is True
+        assert (await repo.get(event_id)).processed_at is not None
+        async with repo.processing(event_id) as event:
+            assert event is None
+
+
+async def test_process_stripe_event_failure_after_handler_leaves_no_duplicate_email(monkeypatch):
+    async with TestSessionDB() as session:
+        user, plan = await _create_user_and_plan(session, "stripe-event")
+        sub = Subscription(id=uuid4(), user_id=user.id, plan_id=plan.id, status=SubscriptionStatus.ACTIVE,
+                           provider=PaymentProvider.STRIPE, provider_subscription_id=f"sub_{uuid4().hex}",
+                           current_period_end=datetime.now(timezone.utc) + timedelta(days=10))
+        session.add(sub)
+        await session.commit()
+    event_id = f"evt_{uuid4().hex}"
+    line = {"parent": {"subscription_item_details": {"subscription": sub.provider_subscription_id}}}
+    event = {"id": event_id, "type": "invoice.payment_failed", "data": {"object": {"lines": {"data": [line]}}}}
+
+    handle_stripe_event = SubscriptionService.handle_stripe_event
+    crashes = [RuntimeError("worker lost")]
+
+    async def crash_after_handler(*args):
+        await handle_stripe_event(*args)
+        if crashes:
+            raise crashes.pop()
+
+    monkeypatch.setattr("src.billing.service.SubscriptionService.handle_stripe_event", crash_after_handler)
 
+    async def process():
+        async with _event_session() as session:
+            await SubscriptionService.process_stripe_event(
+                event_id, StripeEventRepository(session), SubscriptionRepoistory(session), Mock(),
+                PaymentRepository(session),
+            )
 
-async def test_stripe_webhook_invalid_signature(monkeypatch):
-    error = Exception("bad signature")
-    run_mock = AsyncMock(side_effect=error)
-    monkeypatch.setattr("src.billing.service.run_in_threadpool", run_mock)
+    async with _event_session() as session:
+        await StripeEventRepository(session).save(event_id, event["type"], event)
+    with pytest.raises(RuntimeError):
+        await process()
+    assert await _outbox_rows([sub.id]) == []
+    await process()
 
-    request = _dummy_request(b"{}")
-    response = await SubscriptionService.stripe_webhook(request, "sig", Mock(), Mock(), Mock())
+    rows = await _outbox_rows([sub.id])
+    assert [row.topic for row in rows] == ["payment_failed"]
+    async with TestSessionDB() as session:
+        stored = await StripeEventRepository(session).get(event_id)
+        assert stored.processed_at is not None and stored.attempts == 1
+        assert (await session.get(Subscription, sub.id)).status == SubscriptionStatus.PAST_DUE
+
+
+async def test_stripe_event_repository_saves_each_event_once():
+    event_id = f"evt_{uuid4().hex}"
+    async with TestSessionDB() as session:
+        repo = StripeEventRepository(session)
+        assert await repo.save(event_id, "invoice.paid", {"id": event_id}) is True
+        assert await repo.save(event_id, "invoice.paid", {"id": event_id}) is False
+        stored = await repo.get(event_id)
+
+    assert stored.type == "invoice.paid"
+    assert stored.processed_at is None
+
+
+async def test_stripe_webhook_invalid_signature():
+    payload, _ = _signed({"id": "evt_1", "type": "invoice.paid"})
+    signature = sign_payload(payload, "whsec_other")
+
+    request = _dummy_request(payload)
+    response = await SubscriptionService.stripe_webhook(request, signature, Mock())
+
+    assert response == {"error": "No signatures found matching the expected signature for payload"}
+
+
+async def test_verify_signature_accepts_any_v1_signature():
+    payload = b'{"id": "evt_1"}'
+    valid = sign_payload(payload, "whsec_test").split(",")[1]
+
+    verify_signature(payload, f"t={int(time.time())},v1=deadbeef,{valid}", "whsec_test")
+
+
+async def test_verify_signature_rejects_stale_timestamp():
+    payload = b'{"id": "evt_1"}'
+    signature = sign_payload(payload, "whsec_test", timestamp=int(time.time()) - 600)
+
+    with pytest.raises(WebhookVerificationError, match="tolerance"):
+        verify_signature(payload, signature, "whsec_test")
+
+
+async def test_verify_signature_rejects_malformed_header():
+    with pytest.raises(WebhookVerificationError):
+        verify_signature(b"{}", "garbage", "whsec_test")
+
+
+async def test_stripe_invoice_view_reads_first_line():
+    invoice = StripeInvoice.model_validate({
+        "id": "in_1", "object": "invoice", "amount_paid": 900, "currency": "usd",
+        "billing_reason": "subscription_create", "customer_email": "a@b.c",
+        "lines": {"object": "list", "data": [
+            {"parent": {"subscription_item_details": {"subscription": "sub_1"}},
+             "period": {"start": 1, "end": 2}, "amount": 900},
+            {"parent": {"subscription_item_details": {"subscription": "sub_2"}}},
+        ]},
+    })
+
+    assert invoice == StripeInvoice(id="in_1", billing_reason="subscription_create", amount_paid=900, currency="usd",
+                                    has_lines=True, subscription_id="sub_1", period_start=1, period_end=2)
+
+
+async def test_async_task_reuses_worker_loop(monkeypatch):
+    loops = []
+
+    async def _send(subscription):
+        loops.append(asyncio.get_running_loop())
+
+    monkeypatch.setattr("src.billing.tasks.email_service.send_subscription_email", _send)
+
+    await asyncio.to_thread(send_subscription_email_task.apply, args=({"id": "1"},))
+    await asyncio.to_thread(send_subscription_email_task.apply, args=({"id": "2"},))
+    await asyncio.to_thread(close_worker_loop)
+
+    assert len(loops) == 2
+    assert loops[0] is loops[1]
+
+
+class _FakeSMTP:
+    def __init__(self):
+        self.is_connected = True
+        self.sent = []
+
+    async def send_message(self, message):
+        self.sent.append(message["To"])
+
+    async def noop(self):
+        pass
+
+    async def quit(self):
+        self.is_connected = False
+
+    def close(self):
+        self.is_connected = False
+
+
+async def test_bulk_subscription_emails_share_one_smtp_connection(monkeypatch):
+    connections = []
+
+    async def _connect(self):
+        connections.append(_FakeSMTP())
+        return connections[-1]
+
+    transport = MailTransport(conf, templates, pool_size=2, max_idle=30)
+    monkeypatch.setattr(transport.pool, "_connect", _connect.__get__(transport.pool))
+    monkeypatch.setattr("src.billing.emails.mailer", transport)
+
+    subscriptions = [
+        {"id": str(i), "price": 10, "start_date": "2025-01-01", "end_date": None,
+         "user": {"email": f"user{i}@test.com", "username": f"user{i}"}, "plan": {"name": "Pro"}}
+        for i in range(3)
+    ]
+    await Emails.send_bulk("cancel_subscription", subscriptions)
+    await Emails.send_payment_failed_email(subscriptions[0])
+
+    assert len(connections) == 1
+    sent = connections[0].sent
+    assert len(sent) == 4
+    assert all(f"user{i}@test.com" in to for i, to in zip([0, 1, 2, 0], sent))
+
+
+async def test_bulk_email_task_retries_only_undelivered_recipients(monkeypatch):
+    connections = []
+    attempts = []
+
+    class _DroppingSMTP(_FakeSMTP):
+        async def send_message(self, message):
+            if self.sent:
+                raise SMTPServerDisconnected("connection lost")
+            await super().send_message(message)
+
+    async def _connect(self):
+        attempts.append(1)
+        if len(attempts) == 2:
+            raise OSError("connection refused")  # the fresh reconnect fails too
+        connections.append(_DroppingSMTP() if not connections else _FakeSMTP())
+        return connections[-1]
+
+    transport = MailTransport(conf, templates, pool_size=2, max_idle=30)
+    monkeypatch.setattr(transport.pool, "_connect", _connect.__get__(transport.pool))
+    monkeypatch.setattr("src.billing.emails.mailer", transport)
+    subscriptions = [
+        {"id": str(i), "price": 10, "start_date": "2025-01-01", "end_date": None,
+         "user": {"email": f"user{i}@test.com", "username": f"user{i}"}, "plan": {"name": "Pro"}}
+        for i in range(3)
+    ]
+
+    result = await asyncio.to_thread(send_subscription_emails_task.apply, args=("cancel_subscription", subscriptions))
+    await asyncio.to_thread(close_worker_loop)
+
+    assert result.successful()
+    assert [len(smtp.sent) for smtp in connections] == [1, 2]
+    delivered = connections[0].sent + connections[1].sent
+    assert all(f"user{i}@test.com" in to for i, to in zip(range(3), delivered))
+
+    await transport.close()
+    assert not connections[0].is_connected
+
+
+async def test_email_templates_render_with_static_context():
+    templates.load()
+    html = templates.render("payment_failed.html", {"plan": "Pro", "price": 10, "start_date": "2025-01-01",
+                                                    "end_date": "N/A", "user_name": "jane"})
+
+    assert "jane" in html
+    assert settings.app_name in html
+    assert "support@fast_api.com" in html
+    assert str(datetime.now().year) in html
+
+
+async def _create_user_and_plan(session, prefix: str):
+    user = User(id=uuid4(), email=f"{prefix}-{uuid4().hex[:6]}@test.com", username=f"{prefix}-{uuid4().hex[:6]}",
+                is_active=True, is_verified=True, provider=Provider.LOCAL)
+    plan = Plan(id=uuid4(), name=f"{prefix} plan", code=f"{prefix}-{uuid4().hex[:6]}", price_cents=1000,
+                billing_period=BillingPeriod.MONTHLY, currency="USD", is_active=True)
+    session.add_all([user, plan])
+    await session.flush()
+    return user, plan
+
+
+async def _outbox_rows(subscription_ids):
+    ids = [str(sub_id) for sub_id in subscription_ids]
+    async with TestSessionDB() as session:
+        result = await session.execute(select(OutboxMessage).where(OutboxMessage.payload["id"].astext.in_(ids)))
+        return list(result.scalars().all())
+
+
+async def test_expire_subscriptions_task_cancels_overdue_in_batches(monkeypatch):
+    monkeypatch.setattr("src.billing.tasks.SyncSessionLocal", TestSyncSessionDB)
+    now = datetime.now(timezone.utc)
+    async with TestSessionDB() as session:
+        user, plan = await _create_user_and_plan(session, "expire")
+        overdue = [
+            Subscription(id=uuid4(), user_id=user.id, plan_id=plan.id, status=SubscriptionStatus.ACTIVE,
+                         provider=PaymentProvider.MANUAL, current_period_end=now - timedelta(days=i + 2))
+            for i in range(3)
+        ]
+        current = Subscription(id=uuid4(), user_id=user.id, plan_id=plan.id, status=SubscriptionStatus.ACTIVE,
+                               provider=PaymentProvider.STRIPE, current_period_end=now + timedelta(days=10))
+        session.add_all([*overdue, current])
+        await session.commit()
+
+    expired = await asyncio.to_thread(expire_subscriptions_task, 2)
+
+    assert expired >= 3
+    async with TestSessionDB() as session:
+        result = await session.execute(select(Subscription).where(Subscription.user_id == user.id))
+        statuses = {sub.id: sub.status for sub in result.scalars().all()}
+    assert all(statuses[sub.id] == SubscriptionStatus.CANCELED for sub in overdue)
+    assert statuses[current.id] == SubscriptionStatus.ACTIVE
+
+    rows = await _outbox_rows([sub.id for sub in overdue + [current]])
+    assert sorted(row.payload["id"] for row in rows) == sorted(str(sub.id) for sub in overdue)
+    assert all(row.topic == "cancel_subscription" for row in rows)
+
+
+async def test_expire_subscriptions_task_leaves_stripe_renewals_and_grace_period_alone(monkeypatch):
+    monkeypatch.setattr("src.billing.tasks.SyncSessionLocal", TestSyncSessionDB)
+    now = datetime.now(timezone.utc)
+    async with TestSessionDB() as session:
+        user, plan = await _create_user_and_plan(session, "renewing")
+        renewing = Subscription(id=uuid4(), user_id=user.id, plan_id=plan.id, status=SubscriptionStatus.ACTIVE,
+                                provider=PaymentProvider.STRIPE, provider_subscription_id=f"sub_{uuid4().hex}",
+                                current_period_end=now - timedelta(minutes=5))
+        unpaid = Subscription(id=uuid4(), user_id=user.id, plan_id=plan.id, status=SubscriptionStatus.PAST_DUE,
+                              provider=PaymentProvider.STRIPE, provider_subscription_id=f"sub_{uuid4().hex}",
+                              current_period_end=now - timedelta(days=5))
+        in_grace = Subscription(id=uuid4(), user_id=user.id, plan_id=plan.id, status=SubscriptionStatus.ACTIVE,
+                                provider=PaymentProvider.MANUAL, current_period_end=now - timedelta(hours=1))
+        session.add_all([renewing, unpaid, in_grace])
+        await session.commit()
+
+    await asyncio.to_thread(expire_subscriptions_task)
+
+    async with TestSessionDB() as session:
+        result = await session.execute(select(Subscription).where(Subscription.user_id == user.id))
+        subs = {sub.id: sub for sub in result.scalars().all()}
+    assert subs[renewing.id].status == SubscriptionStatus.ACTIVE and subs[renewing.id].canceled_at is None
+    assert subs[unpaid.id].status == SubscriptionStatus.PAST_DUE
+    assert subs[in_grace.id].status == SubscriptionStatus.ACTIVE
+    assert await _outbox_rows([renewing.id, unpaid.id, in_grace.id]) == []
+
+
+async def test_repository_stages_outbox_message_with_subscription_change():
+    async with TestSessionDB() as session:
+        user, plan = await _create_user_and_plan(session, "outbox")
+        sub = Subscription(id=uuid4(), user_id=user.id, plan_id=plan.id, status=SubscriptionStatus.ACTIVE,
+                           provider=PaymentProvider.STRIPE, provider_subscription_id=f"sub_{uuid4().hex}",
+                           current_period_end=datetime.now(timezone.utc) + timedelta(days=10))
+        session.add(sub)
+        await session.commit()
+
+        updated = await SubscriptionRepoistory(session).update_sub_status(
+            provider=PaymentProvider.STRIPE,
+            provider_subscription_id=sub.provider_subscription_id,
+            sub_status=SubscriptionStatus.PAST_DUE,
+            notify="payment_failed",
+        )
 
-    assert response == {"error": "bad signature"}
+    assert updated.status == SubscriptionStatus.PAST_DUE
+    rows = await _outbox_rows([sub.id])
+    assert len(rows) == 1
+    assert rows[0].topic == "payment_failed"
+    assert rows[0].payload["user"]["email"] == user.email
+
+
+async def test_outbox_relay_publishes_one_task_per_topic(mock_send_subscription_emails_task):
+    payloads = [{"id": str(uuid4())} for _ in range(3)]
+    async with TestSessionDB() as session:
+        session.add_all([
+            OutboxMessage(topic="payment_failed", payload=payloads[0]),
+            OutboxMessage(topic="cancel_subscription", payload=payloads[1]),
+            OutboxMessage(topic="payment_failed", payload=payloads[2]),
+        ])
+        await session.commit()
+
+    def _drain():
+        with TestSyncSessionDB() as db:
+            while relay_outbox_batch(db, limit=100):
+                pass
+
+    await asyncio.to_thread(_drain)
+
+    published = {}
+    for call in mock_send_subscription_emails_task.call_args_list:
+        topic, batch = call.args
+        published.setdefault(topic, []).extend(batch)
+    assert payloads[0] in published["payment_failed"] and payloads[2] in published["payment_failed"]
+    assert payloads[1] in published["cancel_subscription"]
+    assert await _outbox_rows([p["id"] for p in payloads]) == []
+
+
+async def test_pool_checkout_wait_is_added_to_request_stats():
+    engine = create_async_engine(settings.test_database_url, poolclass=TimedAsyncAdaptedQueuePool,
+                                 pool_size=1, max_overflow=0)
+    stats = QueryStats()
+    token = request_stats.set(stats)
+    try:
+        async with engine.connect() as first:
+            await first.execute(select(1))
+
+            async def release_later():
+                await asyncio.sleep(0.05)
+                await first.close()
+
+            release = asyncio.create_task(release_later())
+            async with engine.connect() as second:
+                await second.execute(select(1))
+            await release
+    finally:
+        request_stats.reset(token)
+        await engine.dispose()
+
+    assert stats.queries == 2
+    assert stats.pool_ms >= 40
+
+
+async def test_celery_signals_record_queue_latency_and_duration():
+    from src.metrics import CELERY_QUEUE_LATENCY, CELERY_TASK_DURATION, _stamp_publish_time, _task_prerun, _task_postrun
+
+    headers = {}
+    _stamp_publish_time(headers=headers)
+    headers["published_at"] -= 2
+    task = SimpleNamespace(name="process_stripe_event_task", request=SimpleNamespace(**headers))
+    latency_before = CELERY_QUEUE_LATENCY.labels(task.name)._sum.get()
+
+    _task_prerun(task_id="t1", task=task)
+    _task_postrun(task_id="t1", task=task, state="SUCCESS")
+
+    assert CELERY_QUEUE_LATENCY.labels(task.name)._sum.get() - latency_before >= 2
+    assert CELERY_TASK_DURATION.labels(task.name, "SUCCESS")._sum.get() > 0
+
+
+async def test_password_hash_metrics():
+    from src.hashing import hash_password
+    from src.metrics import PASSWORD_HASH_DURATION, PASSWORD_HASH_IN_PROGRESS
+
+    before = PASSWORD_HASH_DURATION.labels("hash")._sum.get()
+    await hash_password("password123")
+
+    assert PASSWORD_HASH_DURATION.labels("hash")._sum.get() > before
+    assert PASSWORD_HASH_IN_PROGRESS._value.get() == 0
+
+
+TRACE_SCRIPT = """
+import asyncio, httpx
+from sqlalchemy import text
+from src.billing.stripe_client import StripeAPI
+from benchmarks.stripe_emulator import StripeEmulator
+from src.database import db_dependency
+from src.main import app
+from src.tracing import shutdown_tracing
+
+emulator = StripeEmulator(webhook_url=None)
+api = None
+
+@app.get("/trace-check")
+async def trace_check(db: db_dependency):
+    await db.execute(text("select 1"))
+    await api.call("customers.create", params={"email": "jane@test.com"})
+
+async def main():
+    global api
+    async with emulator.serve() as base_url:
+        api = StripeAPI("sk_test", max_concurrency=1, rate=1000, max_retries=0, timeout=5, base_url=base_url)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app), base_url="http://app") as client:
+            assert (await client.get("/trace-check")).status_code == 200
+        await api.close()
+    await emulator.close()
+    shutdown_tracing()
+
+asyncio.run(main())
+"""
+
+
+async def test_request_trace_covers_sql_and_stripe_calls(tmp_path):
+    trace_file = tmp_path / "traces.jsonl"
+    env = {**os.environ, "TRACING_EXPORTER": "file", "TRACING_FILE": str(trace_file), "TRACING_SAMPLE_RATIO": "1"}
+    process = await asyncio.create_subprocess_exec(sys.executable, "-c", TRACE_SCRIPT, env=env,
+                                                   stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    _, stderr = await process.communicate()
+    assert process.returncode == 0, stderr.decode()[-2000:]
+
+    spans = {span["name"]: span for span in map(json.loads, trace_file.read_text().splitlines())}
+    server = spans["GET /trace-check"]
+    stripe_span = spans["stripe customers.create"]
+    assert "select" in {name.split()[0].lower() for name in spans}
+    assert {span["context"]["trace_id"] for span in spans.values()} == {server["context"]["trace_id"]}
+    assert stripe_span["parent_id"] == server["context"]["span_id"]
+    assert stripe_span["attributes"]["stripe.operation"] == "customers.create"
+
+
+def _bearer_request(user_id=None) -> StarletteRequest:
+    headers = []
+    if user_id is not None:
+        token, _, _ = generate_token({"sub": str(user_id)}, 5, settings.access_secret_key)
+        headers.append((b"authorization", f"Bearer {token}".encode()))
+    return StarletteRequest({"type": "http", "headers": headers})
+
+
+async def test_resolve_tier_queries_each_user_once_per_ttl(monkeypatch):
+    async with TestSessionDB() as session:
+        user, plan = await _create_user_and_plan(session, "tier")
+        plan.tier = PlanTier.PRO
+        free_user, _ = await _create_user_and_plan(session, "tier-free")
+        session.add(Subscription(id=uuid4(), user_id=user.id, plan_id=plan.id, status=SubscriptionStatus.ACTIVE,
+                                 provider=PaymentProvider.STRIPE,
+                                 current_period_end=datetime.now(timezone.utc) + timedelta(days=10)))
+        await session.commit()
+
+    lookups = []
+    get_access_tier = SubscriptionRepoistory.get_access_tier
+
+    async def _get_access_tier(self, user_id):
+        lookups.append(user_id)
+        return await get_access_tier(self, user_id)
+
+    monkeypatch.setattr(SubscriptionRepoistory, "get_access_tier", _get_access_tier)
+    monkeypatch.setattr("src.billing.quotas.async_session", TestSessionDB)
+    plan_tier_cache.clear()
+
+    assert await resolve_tier(_bearer_request(user.id)) == "PRO"
+    assert await resolve_tier(_bearer_request(user.id)) == "PRO"
+    assert await resolve_tier(_bearer_request(free_user.id)) == "FREE"
+    assert await resolve_tier(_bearer_request()) is None
+    assert lookups == [user.id, free_user.id]
+    plan_tier_cache.clear()
+
+
+async def test_rate_limiter_applies_tier_limits_and_daily_quota(monkeypatch):
+    monkeypatch.setattr("src.rate_limiter.get_redis", lambda: None)
+
+    async def _tier(request):
+        return "FREE"
+
+    limiter = RateLimiter(lambda request: "user:u1", "5/minute", {"/billing/plans": "60/minute"},
+                          tier_func=_tier, tier_limits={"PRO": {"*": "100/minute", "/billing/plans": "300/minute"}},
+                          daily_quotas={"FREE": 2, "PRO": 0})
+
+    assert limiter.limit_for("/billing/plans", "PRO").amount == 300
+    assert limiter.limit_for("/verify", "PRO").amount == 100
+    assert limiter.limit_for("/billing/plans", "FREE").amount == 60
+    assert limiter.limit_for("/verify").amount == 5
+    assert "PRO" not in limiter.daily_quotas
+
+    results = [await limiter.check(_bearer_request(), "/billing/plans") for _ in range(3)]
+
+    assert [result.allowed for result in results] == [True, True, False]
+    assert results[1].headers()["X-Quota-Remaining"] == "0"
+    assert results[1].headers()["X-RateLimit-Remaining"] == "58"
+    rejected = results[2].headers()
+    assert rejected["X-Quota-Limit"] == "2" and "X-RateLimit-Limit" not in rejected
+    assert rejected["Retry-After"] == str(math.ceil(results[2].quota.reset_after))
+    assert results[2].error() == "Daily quota exceeded: 2 per day"
+
+
+async def test_persist_api_usage_task_copies_redis_counters(monkeypatch):
+    async with TestSessionDB() as session:
+        user, _ = await _create_user_and_plan(session, "usage")
+        await session.commit()
+
+    now = datetime.now(timezone.utc)
+    day = now.strftime("%Y%m%d")
+    redis = _FakeRedis()
+    redis.store[quota_callers_key(day)] = {f"user:{user.id}"}
+    redis.store[quota_key(day, f"user:{user.id}")] = "7"
+    monkeypatch.setattr("src.billing.tasks.get_redis", lambda: redis)
+    monkeypatch.setattr("src.billing.tasks.async_session", TestSessionDB)
+
+    await asyncio.to_thread(persist_api_usage_task.apply)
+    redis.store[quota_key(day, f"user:{user.id}")] = "9"
+    saved = (await asyncio.to_thread(persist_api_usage_task.apply)).result
+    await asyncio.to_thread(close_worker_loop)
+
+    assert saved == 1
+    async with TestSessionDB() as session:
+        usage = (await session.execute(select(ApiUsage).where(ApiUsage.user_id == user.id))).scalar_one()
+    assert (usage.day, usage.requests) == (now.date(), 9)
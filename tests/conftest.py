@@ -1,17 +1,32 @@
 # conftest.py
+import os
+
+# no file logging from test runs (read by src.config, so set before importing the app)
+os.environ["LOG_FILE"] = ""
+
 import pytest
 from httpx import AsyncClient, ASGITransport
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
 from sqlalchemy.pool import NullPool
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from src.database import get_db
 from src.main import app 
+from src.auth.throttle import login_throttle
 from src.config import settings
 
 # DB setup
 test_engine = create_async_engine(settings.test_database_url, poolclass=NullPool)
 TestSessionDB = sessionmaker(bind=test_engine, class_=AsyncSession, autoflush=False, autocommit=False, expire_on_commit=False)
 
+# Celery beat tasks and the outbox relay use sync sessions; same test database, sync driver
+test_sync_engine = create_engine(
+    make_url(settings.test_database_url).set(drivername=make_url(settings.sync_database_url).drivername),
+    poolclass=NullPool,
+)
+TestSyncSessionDB = sessionmaker(bind=test_sync_engine, autoflush=False, autocommit=False, expire_on_commit=False)
+
 @pytest.fixture(scope="session", autouse=True)
 async def init_db():
     from src.database import Base
@@ -38,14 +53,19 @@ async def db_session(init_db):
         yield session
 
 @pytest.fixture()
-async def client(db_session):
+async def client(db_session, monkeypatch):
     async def _get_test_db():
         yield db_session  # FastAPI routes get the same session
 
     app.dependency_overrides[get_db] = _get_test_db
 
+    # keep throttle and rate limit state in process memory, where reset() clears it between tests
+    monkeypatch.setattr("src.auth.throttle.get_redis", lambda: None)
+    monkeypatch.setattr("src.rate_limiter.get_redis", lambda: None)
     if hasattr(app.state, "limiter"):
         app.state.limiter.enabled = False
+        app.state.limiter.reset()
+    login_throttle.reset()
 
     async with AsyncClient(transport = ASGITransport(app=app), base_url="http://testserver") as ac:
         yield ac